@@ -0,0 +1,78 @@
+import argparse
+import subprocess
+import sys
+import tarfile
+
+
+zstd_magic = b'\x28\xb5\x2f\xfd'
+
+
+def open_zstd(path):
+    try:
+        from compression import zstd
+    except ImportError:
+        pass
+    else:
+        return zstd.ZstdFile(path)
+
+    try:
+        import zstandard
+    except ImportError:
+        pass
+    else:
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+
+    process = subprocess.Popen(
+        ['zstd', '--decompress', '--stdout', path],
+        stdout=subprocess.PIPE,
+    )
+
+    return process.stdout
+
+
+def extract(path, target):
+    with open(path, 'rb') as f:
+        magic = f.read(len(zstd_magic))
+
+    if magic == zstd_magic:
+        print('format: zstd')
+        archive = tarfile.open(fileobj=open_zstd(path), mode='r|')
+    else:
+        # tarfile detects uncompressed, gzip, bz2 and xz itself
+        archive = tarfile.open(name=path, mode='r:*')
+
+    with archive:
+        for info in archive:
+            print(info.name)
+            archive.extract(info, path=target)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.set_defaults(func=parser.print_help)
+
+    parser.add_argument(
+        '--target',
+    )
+
+    parser.add_argument(
+        'archives',
+        help='Extracted in order so later archives take precedence',
+        nargs='+',
+    )
+
+    args = parser.parse_args()
+
+    for path in args.archives:
+        print('extracting: {}'.format(path))
+        try:
+            extract(path=path, target=args.target)
+        except tarfile.ReadError as e:
+            print('unable to extract {}: {}'.format(path, e), file=sys.stderr)
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,643 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import itertools
+import logging
+import shutil
+import signal
+import tempfile
+import time
+
+import romp._coalesce
+import romp._core
+
+
+logger = logging.getLogger(__name__)
+
+
+succeeded_results = ('succeeded', 'succeededWithIssues')
+
+
+interrupt_signals = tuple(
+    getattr(signal, name)
+    for name in ('SIGINT', 'SIGTERM', 'SIGHUP', 'SIGBREAK')
+    if hasattr(signal, name)
+)
+
+
+class Interrupted(Exception):
+    def __init__(self, signal_number):
+        Exception.__init__(
+            self,
+            'interrupted by signal {}'.format(signal_number),
+        )
+        self.signal_number = signal_number
+
+
+def run(coroutine, signals=(), timeout=None):
+    # The signals and the timeout cancel the coroutine rather than
+    # interrupting wherever the loop happens to be, and the loop runs on
+    # until the coroutine has finished cancelling its builds on the way out.
+    # asyncio.wait_for() only waits for that from Python 3.8.
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(coroutine)
+    received = []
+    expired = []
+
+    def interrupt(signal_number, frame):
+        received.append(signal_number)
+        loop.call_soon_threadsafe(task.cancel)
+
+    def expire():
+        expired.append(timeout)
+        task.cancel()
+
+    if timeout is not None:
+        loop.call_later(timeout, expire)
+
+    previous_handlers = [
+        (signal_number, signal.signal(signal_number, interrupt))
+        for signal_number in signals
+    ]
+
+    try:
+        return loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        if len(received) > 0:
+            raise Interrupted(received[0])
+
+        if len(expired) > 0:
+            raise asyncio.TimeoutError()
+
+        raise
+    finally:
+        for signal_number, handler in previous_handlers:
+            signal.signal(signal_number, handler)
+
+        loop.close()
+
+
+class BuildTracker:
+    # Waits on any number of builds with one list request per poll for all
+    # the builds sharing a project rather than one request per build.  The
+    # poll period is the shortest any of the outstanding builds' schedules
+    # asks for.
+    def __init__(self, engine, clock=time.perf_counter):
+        self.engine = engine
+        self.clock = clock
+        self.waiters = collections.OrderedDict()
+        self.pollers = {}
+        self.conditional = {}
+
+    async def wait(self, build, schedule=None):
+        if schedule is None:
+            schedule = romp._core.PollSchedule()
+
+        list_url = build.url.rsplit('/', 1)[0]
+        future = asyncio.get_event_loop().create_future()
+
+        waiters = self.waiters.get(list_url)
+        if waiters is None:
+            waiters = collections.OrderedDict()
+            self.waiters[list_url] = waiters
+            self.pollers[list_url] = asyncio.ensure_future(
+                self._poll(list_url, waiters),
+            )
+
+        waiters[build.id] = (build, schedule, future)
+
+        try:
+            return await future
+        finally:
+            waiters.pop(build.id, None)
+            if len(waiters) == 0 and self.waiters.get(list_url) is waiters:
+                # nobody is left waiting so there is no need to sleep on
+                self.pollers[list_url].cancel()
+
+    def _list(self, list_url, build_ids):
+        # the last response is reused when the set of builds and their
+        # states are unchanged
+        headers = {}
+        previous = self.conditional.get(list_url)
+        if previous is not None and previous[0] == build_ids:
+            headers['If-None-Match'] = previous[1]
+
+        response = self.engine.session.get(
+            list_url,
+            params={
+                'buildIds': ','.join(str(id) for id in build_ids),
+                'api-version': '5.0',
+            },
+            headers=headers,
+        )
+
+        if response.status_code == 304 and 'If-None-Match' in headers:
+            logger.debug('builds unchanged: %s', build_ids)
+            return previous[2]
+
+        response.raise_for_status()
+        logger.debug(response.content)
+
+        response_json = response.json()
+        etag = response.headers.get('ETag')
+        if etag is not None:
+            self.conditional[list_url] = (build_ids, etag, response_json)
+
+        return response_json
+
+    async def _poll(self, list_url, waiters):
+        try:
+            while True:
+                for build_id, (_, _, future) in list(waiters.items()):
+                    if future.done():
+                        del waiters[build_id]
+
+                if len(waiters) == 0:
+                    return
+
+                build_ids = list(waiters)
+                response_json = await self.engine._call(
+                    self._list,
+                    list_url=list_url,
+                    build_ids=build_ids,
+                )
+                builds_json = {
+                    build_json['id']: build_json
+                    for build_json in response_json['value']
+                }
+
+                delays = []
+                for build_id in build_ids:
+                    build, schedule, future = waiters[build_id]
+                    if future.done():
+                        # given up on while the request was made
+                        del waiters[build_id]
+                        continue
+
+                    build_json = builds_json.get(build_id)
+
+                    if build_json is None:
+                        del waiters[build_id]
+                        future.set_exception(Exception(
+                            'build not found: {}'.format(build.url),
+                        ))
+                        continue
+
+                    delay = build.observe(
+                        response_json=build_json,
+                        schedule=schedule,
+                        clock=self.clock,
+                    )
+
+                    if delay is None:
+                        del waiters[build_id]
+                        if not future.done():
+                            future.set_result(build_json)
+                    else:
+                        delays.append(delay)
+
+                if len(delays) > 0:
+                    await asyncio.sleep(min(delays))
+        except Exception as e:
+            for _, _, future in waiters.values():
+                if not future.done():
+                    future.set_exception(e)
+            waiters.clear()
+        finally:
+            if self.waiters.get(list_url) is waiters:
+                del self.waiters[list_url]
+                del self.pollers[list_url]
+
+
+class Engine:
+    # Drives many builds from one event loop.  The blocking requests run on a
+    # small thread pool sharing the session while the waits between polls
+    # are asyncio sleeps so idle builds cost no threads.  At most concurrency
+    # builds are in flight and the rest wait their turn.
+    def __init__(
+            self,
+            session,
+            concurrency=100,
+            http_workers=16,
+            leases=None,
+    ):
+        self.session = session
+        self.leases = leases
+        self.concurrency = concurrency
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=http_workers,
+        )
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self._semaphore = None
+        self.tracker = BuildTracker(engine=self)
+
+    @property
+    def semaphore(self):
+        # created on first use so it belongs to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        return self._semaphore
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def _call(self, function, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(function, *args, **kwargs),
+        )
+
+    async def request_remote_lock_build(self, **kwargs):
+        return await self._call(
+            romp._core.request_remote_lock_build,
+            session=self.session,
+            **kwargs
+        )
+
+    async def wait_for_lock_build(
+            self,
+            build,
+            schedule=None,
+            clock=time.perf_counter,
+    ):
+        if schedule is None:
+            schedule = romp._core.PollSchedule()
+
+        logger.info("build url: %s", build.url)
+
+        while True:
+            response_json, delay = await self._call(
+                build.check,
+                schedule=schedule,
+                clock=clock,
+            )
+
+            if delay is None:
+                return response_json
+
+            await asyncio.sleep(delay)
+
+    async def follow_timeline(
+            self,
+            build,
+            on_job_event,
+            schedule=None,
+            completed=None,
+            clock=time.perf_counter,
+    ):
+        # reports the romp on jobs while something else, such as the tracker,
+        # keeps the build status current and sets completed when it is done
+        if schedule is None:
+            schedule = romp._core.PollSchedule()
+
+        if completed is None:
+            completed = asyncio.Event()
+
+        timeline = romp._core.Timeline(build=build)
+
+        while True:
+            status = (build.response_json or {}).get('status')
+            finished = completed.is_set() or status == 'completed'
+
+            for event in await self._call(timeline.poll):
+                on_job_event(event)
+
+            if finished:
+                return
+
+            running = 0
+            if build.started is not None:
+                running = clock() - build.started
+
+            try:
+                await asyncio.wait_for(
+                    completed.wait(),
+                    timeout=schedule.delay(status=status, running=running),
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def get_lock_build_artifact(
+            self,
+            build,
+            artifact_file,
+            compression='gzip',
+    ):
+        return await self._call(
+            build.get_lock_build_artifact,
+            artifact_file=artifact_file,
+            compression=compression,
+        )
+
+    async def run_build(
+            self,
+            schedule=None,
+            artifact_file=None,
+            requested=None,
+            on_job_event=None,
+            artifact_mode='coalesced',
+            fail_fast=False,
+            artifact_extractor=None,
+            artifact_compression='gzip',
+            artifact_compression_level=None,
+            artifact_deduplicate=False,
+            artifact_namespace=False,
+            **kwargs
+    ):
+        # request, wait for and optionally download the artifact of a build
+        # while holding one of the in flight slots
+        async with self.semaphore:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+            build = None
+            lease = None
+            renewing = None
+            requesting = None
+
+            try:
+                if self.leases is not None:
+                    lease = self.leases.acquire(
+                        request_url=kwargs['build_request_url'],
+                    )
+                    renewing = asyncio.ensure_future(self._renew(lease))
+
+                requesting = asyncio.ensure_future(
+                    self.request_remote_lock_build(
+                        artifact_mode=artifact_mode,
+                        artifact_compression=artifact_compression,
+                        artifact_compression_level=artifact_compression_level,
+                        artifact_deduplicate=artifact_deduplicate,
+                        artifact_namespace=artifact_namespace,
+                        **kwargs
+                    ),
+                )
+                # the request carries on in its thread when cancelled
+                build = await asyncio.shield(requesting)
+
+                if lease is not None:
+                    self.leases.attach(lease, build)
+
+                if requested is not None:
+                    requested(build)
+
+                response_json = await self._run(
+                    build=build,
+                    schedule=schedule,
+                    artifact_file=artifact_file,
+                    on_job_event=on_job_event,
+                    artifact_mode=artifact_mode,
+                    fail_fast=fail_fast,
+                    artifact_extractor=artifact_extractor,
+                    artifact_compression=artifact_compression,
+                    artifact_compression_level=artifact_compression_level,
+                    artifact_deduplicate=artifact_deduplicate,
+                    artifact_namespace=artifact_namespace,
+                )
+            except BaseException:
+                # cancelled by a timeout or a signal or failed while waiting
+                pending = requesting is not None and not requesting.done()
+                if build is None and pending:
+                    # cancelled mid request, the build may yet be started
+                    try:
+                        build = await requesting
+                    except Exception:
+                        logger.exception('failed to request build')
+                    else:
+                        if lease is not None:
+                            self.leases.attach(lease, build)
+
+                if build is not None:
+                    await self._abandon(build=build, lease=lease)
+                elif lease is not None:
+                    self.leases.release(lease)
+
+                raise
+            finally:
+                self.in_flight -= 1
+
+                if renewing is not None:
+                    renewing.cancel()
+                    await asyncio.wait([renewing])
+
+            if lease is not None:
+                self.leases.release(lease)
+
+        return build, response_json
+
+    async def _renew(self, lease):
+        while True:
+            await asyncio.sleep(self.leases.duration / 3.0)
+            self.leases.renew(lease)
+
+    async def _abandon(self, build, lease):
+        # the build is cancelled rather than left holding agents, if that
+        # fails the lease stays for romp cleanup to find
+        try:
+            status = (build.response_json or {}).get('status')
+            if not build.cancelled and status != 'completed':
+                await self._call(build.cancel)
+        except Exception:
+            logger.exception('failed to cancel build: %s', build.human_url)
+            return
+
+        if lease is not None:
+            self.leases.release(lease)
+
+    async def _wait(self, build, schedule, on_job_event, failed=None):
+        # returns the final build or, once failed is set, cancels the build
+        # and returns without waiting for it to finish
+        waiting = asyncio.ensure_future(
+            self.tracker.wait(build=build, schedule=schedule),
+        )
+        racing = [waiting]
+
+        if failed is not None:
+            racing.append(asyncio.ensure_future(failed.wait()))
+
+        completed = asyncio.Event()
+        following = None
+        if on_job_event is not None:
+            following = asyncio.ensure_future(self.follow_timeline(
+                build=build,
+                on_job_event=on_job_event,
+                schedule=schedule,
+                completed=completed,
+            ))
+
+        try:
+            await asyncio.wait(racing, return_when=asyncio.FIRST_COMPLETED)
+
+            if waiting.done():
+                return waiting.result()
+
+            waiting.cancel()
+            await self._call(build.cancel)
+
+            return build.response_json
+        finally:
+            for future in racing:
+                future.cancel()
+            await asyncio.wait(racing)
+
+            # one last look at the timeline to catch the final jobs
+            completed.set()
+            if following is not None:
+                await following
+
+    async def _collect_job(self, build, environment, directory, extractor):
+        # saves and or extracts the artifact of one finished job
+        artifact_name = romp._core.job_artifact_name(environment)
+
+        if directory is None:
+            await self._call(
+                build.extract_artifacts,
+                artifact_name=artifact_name,
+                extractor=extractor,
+                environment=environment,
+            )
+            return []
+
+        paths = await self._call(
+            build.save_artifact_tarballs,
+            artifact_name=artifact_name,
+            directory=directory,
+        )
+
+        if extractor is not None:
+            for path in paths:
+                await self._call(
+                    extractor.extract_path,
+                    path=path,
+                    environment=environment,
+                )
+
+        return paths
+
+    async def _run(
+            self,
+            build,
+            schedule,
+            artifact_file,
+            on_job_event,
+            artifact_mode,
+            fail_fast,
+            artifact_extractor=None,
+            artifact_compression='gzip',
+            artifact_compression_level=None,
+            artifact_deduplicate=False,
+            artifact_namespace=False,
+    ):
+        # In per job mode each job's artifact is downloaded as soon as the
+        # job finishes so the transfers overlap the jobs still running and no
+        # coalesce job has to be waited for.  When failing fast the artifacts
+        # of the jobs that did finish are collected.
+        wanted = artifact_file is not None or artifact_extractor is not None
+        per_job = wanted and artifact_mode == 'per-job'
+        directory = None
+        if artifact_file is not None:
+            directory = tempfile.mkdtemp()
+        downloads = []
+        failed = asyncio.Event()
+
+        def job_event(event):
+            if event.kind == 'finished':
+                succeeded = event.result in succeeded_results
+
+                if per_job and succeeded:
+                    downloads.append(asyncio.ensure_future(self._collect_job(
+                        build=build,
+                        environment=event.environment,
+                        directory=directory,
+                        extractor=artifact_extractor,
+                    )))
+
+                if fail_fast and not succeeded and build.failed_job is None:
+                    build.failed_job = event
+                    failed.set()
+
+            if on_job_event is not None:
+                on_job_event(event)
+
+        follow = per_job or fail_fast or on_job_event is not None
+
+        try:
+            response_json = await self._wait(
+                build=build,
+                schedule=schedule,
+                on_job_event=job_event if follow else None,
+                failed=failed if fail_fast else None,
+            )
+
+            if not wanted:
+                return response_json
+
+            if per_job:
+                paths = await asyncio.gather(*downloads)
+            else:
+                if artifact_extractor is not None:
+                    # the jobs' own archives rather than the coalesced one
+                    # so they can be laid out by environment
+                    await self._call(
+                        build.extract_artifacts,
+                        artifact_name='coalesce',
+                        extractor=artifact_extractor,
+                        required=not build.cancelled,
+                    )
+
+                if artifact_file is None:
+                    return response_json
+
+                if not build.cancelled:
+                    await self.get_lock_build_artifact(
+                        build=build,
+                        artifact_file=artifact_file,
+                        compression=artifact_compression,
+                    )
+                    return response_json
+
+                # the coalesce job will not run but the finished jobs have
+                # already published their pieces
+                paths = [await self._call(
+                    build.save_artifact_tarballs,
+                    artifact_name='coalesce',
+                    directory=directory,
+                    required=False,
+                )]
+
+            if artifact_file is None:
+                return response_json
+
+            await self._call(
+                romp._coalesce.coalesce,
+                source_paths=list(itertools.chain.from_iterable(paths)),
+                target_file=artifact_file,
+                compression=artifact_compression,
+                compression_level=artifact_compression_level,
+                deduplicate=artifact_deduplicate,
+                namespace=artifact_namespace,
+            )
+        finally:
+            await asyncio.gather(*downloads, return_exceptions=True)
+            if directory is not None:
+                shutil.rmtree(directory)
+
+        return response_json
+
+    async def run_builds(self, requests):
+        # each request is the keyword arguments for run_build, the results
+        # are in the same order
+        return await asyncio.gather(*(
+            self.run_build(**request)
+            for request in requests
+        ))
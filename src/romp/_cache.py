@@ -0,0 +1,185 @@
+import errno
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+def default_directory():
+    base = os.environ.get('XDG_CACHE_HOME')
+    if base is None:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+
+    return os.path.join(base, 'romp')
+
+
+def _ignore_missing(function, *args):
+    try:
+        return function(*args)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class Cache:
+    # One JSON file per entry, written atomically via rename, so several romp
+    # processes can share a directory without locking.  The file mtime is
+    # bumped on each hit and the least recently used entries are evicted.
+    suffix = '.json'
+
+    def __init__(self, directory, max_entries=256):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        path = self.path(key)
+
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (IOError, OSError):
+            return None
+        except ValueError:
+            logger.warning('removing corrupt cache entry: %s', path)
+            _ignore_missing(os.remove, path)
+            return None
+
+        expires = entry.get('expires')
+        if expires is not None and expires <= time.time():
+            logger.info('removing expired cache entry: %s', path)
+            _ignore_missing(os.remove, path)
+            return None
+
+        _ignore_missing(os.utime, path, None)
+
+        return entry['value']
+
+    def put(self, key, value, lifetime=None):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        entry = {'value': value, 'expires': None}
+        if lifetime is not None:
+            entry['expires'] = time.time() + lifetime
+
+        descriptor, temporary_path = tempfile.mkstemp(
+            dir=self.directory,
+            prefix='.',
+            suffix='.tmp',
+        )
+        try:
+            with os.fdopen(descriptor, 'w') as f:
+                json.dump(entry, f)
+
+            os.replace(temporary_path, self.path(key))
+        except Exception:
+            _ignore_missing(os.remove, temporary_path)
+            raise
+
+        self.evict()
+
+    def remove(self, key):
+        _ignore_missing(os.remove, self.path(key))
+
+    def keys(self):
+        if not os.path.isdir(self.directory):
+            return []
+
+        return [
+            name[:-len(self.suffix)]
+            for name in os.listdir(self.directory)
+            if name.endswith(self.suffix) and not name.startswith('.')
+        ]
+
+    def evict(self):
+        if self.max_entries is None:
+            return
+
+        ages = []
+        for key in self.keys():
+            try:
+                ages.append((os.path.getmtime(self.path(key)), key))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        ages.sort()
+
+        for _, key in ages[:max(0, len(ages) - self.max_entries)]:
+            logger.info('evicting cache entry: %s', key)
+            self.remove(key)
+
+
+class Leases:
+    # The builds a client is waiting on.  A lease is taken under a client
+    # side key before the build is requested, so a client killed mid request
+    # still leaves a trace, and the build is attached once it is known.  The
+    # client renews its leases while it runs and releases them once the build
+    # is done or cancelled so a lease left unrenewed past its duration marks
+    # a build orphaned by a client that crashed or was killed.
+    def __init__(self, directory, duration=300):
+        self.entries = Cache(directory=directory, max_entries=None)
+        self.duration = duration
+
+    def acquire(self, request_url):
+        key = uuid.uuid4().hex
+        now = time.time()
+
+        self.entries.put(key, {
+            'key': key,
+            'request_url': request_url,
+            'requested': now,
+            'id': None,
+            'url': None,
+            'human_url': None,
+            'renewed': now,
+        })
+
+        return key
+
+    def _update(self, key, **values):
+        lease = self.entries.get(key)
+        if lease is None:
+            # released meanwhile
+            return
+
+        lease.update(values)
+        self.entries.put(key, lease)
+
+    def attach(self, key, build):
+        self._update(
+            key,
+            id=build.id,
+            url=build.url,
+            human_url=build.human_url,
+        )
+
+    def renew(self, key):
+        self._update(key, renewed=time.time())
+
+    def release(self, key):
+        self.entries.remove(key)
+
+    def orphaned(self):
+        leases = []
+        now = time.time()
+
+        for key in self.entries.keys():
+            lease = self.entries.get(key)
+            if lease is not None and lease['renewed'] + self.duration < now:
+                leases.append(lease)
+
+        return leases
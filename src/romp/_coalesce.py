@@ -0,0 +1,603 @@
+# This is used for the CI side without any installation
+# standard lib only, zstd output needs zstandard or Python 3.14
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import os.path
+import posixpath
+import queue
+import sys
+import tarfile
+import tempfile
+import threading
+
+try:
+    from compression import zstd as compression_zstd
+except ImportError:
+    compression_zstd = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+extensions = collections.OrderedDict((
+    ('none', '.tar'),
+    ('gzip', '.tar.gz'),
+    ('zstd', '.tar.zst'),
+))
+compressions = tuple(extensions)
+
+manifest_name = 'romp-manifest.json'
+
+chunk_size = 1024 * 1024
+# chunks per source so the readers running ahead of the writer stay bounded
+queue_size = 16
+
+
+def archive_environment(file_name):
+    # the jobs name their archives artifacts.<environment>.<uuid>.tar.gz,
+    # those of older builds are missing the environment
+    middle = file_name[len('artifacts.'):-len('.tar.gz')]
+    environment, _, _ = middle.rpartition('.')
+
+    return environment or None
+
+
+def _archive_namespace(path):
+    # older archives fall back to their uuid to stay apart
+    file_name = os.path.basename(path)
+    environment = archive_environment(file_name)
+    if environment is None:
+        environment = file_name[len('artifacts.'):-len('.tar.gz')]
+
+    return environment
+
+
+class _Abandoned(Exception):
+    pass
+
+
+def _put(items, item, abandoned):
+    while True:
+        try:
+            items.put(item, timeout=0.1)
+        except queue.Full:
+            if abandoned.is_set():
+                raise _Abandoned()
+        else:
+            return
+
+
+def _read_source(path, items, abandoned):
+    # decompresses one archive on a worker thread into its queue
+    try:
+        try:
+            with tarfile.open(name=path, mode='r|gz') as source:
+                for info in source:
+                    _put(items, ('member', info), abandoned)
+                    if not info.isreg():
+                        continue
+
+                    data = source.extractfile(info)
+                    while True:
+                        chunk = data.read(chunk_size)
+                        if len(chunk) == 0:
+                            break
+
+                        _put(items, ('chunk', chunk), abandoned)
+        except _Abandoned:
+            raise
+        except Exception as e:
+            _put(items, ('error', e), abandoned)
+            return
+
+        _put(items, ('end', None), abandoned)
+    except _Abandoned:
+        pass
+
+
+class _QueuedFile:
+    # the content of the current member as its chunks arrive from the reader
+    def __init__(self, items):
+        self.items = items
+        self.view = memoryview(b'')
+        self.offset = 0
+
+    def read(self, size):
+        pieces = []
+
+        while size > 0:
+            if self.offset == len(self.view):
+                kind, value = self.items.get()
+                if kind == 'error':
+                    raise value
+                if kind != 'chunk':
+                    raise Exception('member content ended early')
+
+                self.view = memoryview(value)
+                self.offset = 0
+
+            piece = self.view[self.offset:self.offset + size]
+            self.offset += len(piece)
+            size -= len(piece)
+            pieces.append(piece)
+
+        return b''.join(pieces)
+
+
+def _write_source(target, items):
+    content = _QueuedFile(items=items)
+
+    while True:
+        kind, value = items.get()
+
+        if kind == 'end':
+            return
+
+        if kind == 'error':
+            raise value
+
+        if value.isreg():
+            target.addfile(value, content)
+        else:
+            target.addfile(value)
+
+
+def _link_repeats(planned):
+    # Repeated content becomes a hard link to the first copy.  Extracting
+    # over an existing path writes through to the file already there so a
+    # name written again later would change every file linked with it.
+    # Only the last member to be written with a name is linked, or linked
+    # to.
+    last = {}
+    for index, item in enumerate(planned):
+        last[item.info.name] = index
+
+    names = {}
+    for index, item in enumerate(planned):
+        if (
+                item.digest is None
+                or item.size == 0
+                or last[item.info.name] != index
+        ):
+            continue
+
+        name = names.setdefault(item.digest, item.info.name)
+        if name != item.info.name:
+            item.info.type = tarfile.LNKTYPE
+            item.info.linkname = name
+            item.info.size = 0
+
+
+def _padded(size):
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def _header_size(target, info):
+    return len(info.tobuf(target.format, target.encoding, target.errors))
+
+
+class _Planned:
+    # a member held back until all of them are known, the content of a
+    # regular file is at offset in the store
+    def __init__(self, info, environment, path):
+        self.info = info
+        self.environment = environment
+        self.path = path
+        self.size = info.size
+        self.offset = None
+        self.digest = None
+
+
+def _gather_source(store, items, namespace, planned):
+    # appends the content of one source's members to the store, their
+    # names are put below the namespace if there is one
+    content = _QueuedFile(items=items)
+
+    while True:
+        kind, value = items.get()
+
+        if kind == 'end':
+            return
+
+        if kind == 'error':
+            raise value
+
+        info = value
+        item = _Planned(info=info, environment=namespace, path=info.name)
+        if namespace is not None:
+            info.name = posixpath.join(namespace, info.name)
+            if info.islnk():
+                info.linkname = posixpath.join(namespace, info.linkname)
+
+        planned.append(item)
+
+        if not info.isreg():
+            continue
+
+        item.offset = store.tell()
+        digest = hashlib.sha256()
+        remaining = info.size
+        while remaining > 0:
+            chunk = content.read(min(remaining, chunk_size))
+            digest.update(chunk)
+            store.write(chunk)
+            remaining -= len(chunk)
+
+        item.digest = digest.hexdigest()
+
+
+def _write_gathered(target, paths, queues, deduplicate, namespace):
+    # Linking repeated content needs to know every name that will be
+    # written.  Namespacing puts every member below its environment so
+    # nothing shadows anything else and the manifest leading the archive
+    # gives the offset of each file's content in the uncompressed tar so it
+    # can be found without reading the rest.  That needs all of the members,
+    # and the exact size of their headers, before anything is written.
+    # Either way the content waits in one temporary file.
+    planned = []
+
+    with tempfile.TemporaryFile() as store:
+        for path, items in zip(paths, queues):
+            _gather_source(
+                store=store,
+                items=items,
+                namespace=_archive_namespace(path) if namespace else None,
+                planned=planned,
+            )
+
+        if deduplicate:
+            _link_repeats(planned=planned)
+
+        if namespace:
+            _write_manifest(target=target, planned=planned)
+
+        for item in planned:
+            if item.info.isreg():
+                store.seek(item.offset)
+                target.addfile(item.info, store)
+            else:
+                target.addfile(item.info)
+
+
+def _write_manifest(target, planned):
+    manifest_info = tarfile.TarInfo(manifest_name)
+    manifest_info.mtime = max(
+        [item.info.mtime for item in planned] + [0],
+    )
+
+    # the offsets depend on the size of the manifest holding them
+    manifest = b''
+    while True:
+        manifest_info.size = len(manifest)
+        offset = (
+            _header_size(target=target, info=manifest_info)
+            + _padded(len(manifest))
+        )
+        content_offsets = {}
+        files = []
+
+        for item in planned:
+            offset += _header_size(target=target, info=item.info)
+
+            if item.info.isreg():
+                content_offsets[item.info.name] = offset
+
+            if item.digest is not None:
+                files.append(collections.OrderedDict((
+                    ('environment', item.environment),
+                    ('path', item.path),
+                    ('size', item.size),
+                    ('digest', item.digest),
+                    ('offset', content_offsets[
+                        item.info.linkname
+                        if item.info.islnk()
+                        else item.info.name
+                    ]),
+                )))
+
+            offset += _padded(item.info.size)
+
+        encoded = json.dumps(
+            {'version': 1, 'files': files},
+            indent=1,
+        ).encode('utf-8')
+
+        if len(encoded) == len(manifest):
+            break
+
+        manifest = encoded
+
+    target.addfile(manifest_info, io.BytesIO(encoded))
+
+
+@contextlib.contextmanager
+def _open_target(target_file, compression, compression_level, workers):
+    if compression == 'none':
+        with tarfile.open(fileobj=target_file, mode='w|') as target:
+            yield target
+    elif compression == 'gzip':
+        if compression_level is None:
+            compression_level = 9
+
+        target = tarfile.open(
+            fileobj=target_file,
+            mode='w:gz',
+            compresslevel=compression_level,
+        )
+        with target:
+            yield target
+    elif compression == 'zstd':
+        if compression_level is None:
+            compression_level = 3
+
+        if zstandard is not None:
+            compressor = zstandard.ZstdCompressor(
+                level=compression_level,
+                threads=workers,
+            )
+            writer = compressor.stream_writer(target_file, closefd=False)
+        elif compression_zstd is not None:
+            writer = compression_zstd.ZstdFile(
+                target_file,
+                mode='w',
+                level=compression_level,
+            )
+        else:
+            raise Exception('zstd output needs zstandard installed')
+
+        with writer:
+            with tarfile.open(fileobj=writer, mode='w|') as target:
+                yield target
+    else:
+        raise Exception('unknown compression: {}'.format(compression))
+
+
+def coalesce(
+        source_paths,
+        target_file,
+        compression='gzip',
+        compression_level=None,
+        workers=None,
+        deduplicate=False,
+        namespace=False,
+):
+    # Combines the per environment artifact tarballs into one.  They are
+    # taken in name order so the coalesce job and the client downloading
+    # each job's artifact build the same tarball.  The sources are
+    # decompressed on a pool of threads, zlib releases the GIL while
+    # inflating, and the one writer takes their members strictly in order.
+    # Deduplicating stores each distinct content once with the repeats
+    # written as hard links to it, extraction gives them the same content
+    # but they share the one file unless the extractor copies them.
+    # Namespacing puts each environment's members below its own directory
+    # with a manifest of them all first.
+    ordered = sorted(source_paths, key=os.path.basename)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    abandoned = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in ordered]
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    try:
+        # the pool starts them in order so the source being written always
+        # has a worker
+        for path, items in zip(ordered, queues):
+            pool.submit(_read_source, path, items, abandoned)
+
+        with _open_target(
+                target_file=target_file,
+                compression=compression,
+                compression_level=compression_level,
+                workers=workers,
+        ) as target:
+            if deduplicate or namespace:
+                _write_gathered(
+                    target=target,
+                    paths=ordered,
+                    queues=queues,
+                    deduplicate=deduplicate,
+                    namespace=namespace,
+                )
+                return
+
+            for items in queues:
+                _write_source(target=target, items=items)
+    finally:
+        abandoned.set()
+        pool.shutdown(wait=True)
+
+
+def open_decompressed(fileobj, compression):
+    # the uncompressed tar stream, seeking forward reads through the rest
+    if compression == 'none':
+        return fileobj
+
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+    if compression == 'zstd':
+        if zstandard is not None:
+            return zstandard.ZstdDecompressor().stream_reader(
+                fileobj,
+                closefd=False,
+            )
+
+        if compression_zstd is not None:
+            return compression_zstd.ZstdFile(fileobj, mode='r')
+
+        raise Exception('zstd input needs zstandard installed')
+
+    raise Exception('unknown compression: {}'.format(compression))
+
+
+class Manifest:
+    # The index written at the front of a namespaced archive.  Only the
+    # first member is read to load it and a file is then read by skipping
+    # straight to its offset.
+    def __init__(self, files):
+        self.files = files
+        self.by_key = collections.OrderedDict(
+            ((entry['environment'], entry['path']), entry)
+            for entry in files
+        )
+
+    @classmethod
+    def read(cls, fileobj, compression='none'):
+        # from the start of the archive
+        stream = open_decompressed(fileobj=fileobj, compression=compression)
+
+        with tarfile.open(fileobj=stream, mode='r|') as archive:
+            info = archive.next()
+            if info is None or info.name != manifest_name:
+                raise Exception('archive has no manifest')
+
+            content = archive.extractfile(info).read()
+
+        manifest = json.loads(content.decode('utf-8'))
+        if manifest['version'] != 1:
+            raise Exception('unsupported manifest version: {}'.format(
+                manifest['version'],
+            ))
+
+        return cls(files=manifest['files'])
+
+    def environments(self):
+        return sorted({entry['environment'] for entry in self.files})
+
+    def paths(self, environment):
+        return [
+            entry['path']
+            for entry in self.files
+            if entry['environment'] == environment
+        ]
+
+    def entry(self, environment, path):
+        entry = self.by_key.get((environment, path))
+        if entry is None:
+            raise Exception('not in the manifest: {} {}'.format(
+                environment,
+                path,
+            ))
+
+        return entry
+
+    def read_file(self, fileobj, environment, path, compression='none'):
+        # from the start of the archive, only an uncompressed archive in a
+        # seekable file avoids reading through everything before the file
+        entry = self.entry(environment=environment, path=path)
+        stream = open_decompressed(fileobj=fileobj, compression=compression)
+
+        start = fileobj.tell() if compression == 'none' else 0
+        stream.seek(start + entry['offset'])
+
+        content = io.BytesIO()
+        remaining = entry['size']
+        while remaining > 0:
+            chunk = stream.read(min(remaining, chunk_size))
+            if len(chunk) == 0:
+                raise Exception('archive ended early: {}'.format(path))
+
+            content.write(chunk)
+            remaining -= len(chunk)
+
+        content = content.getvalue()
+        if hashlib.sha256(content).hexdigest() != entry['digest']:
+            raise Exception('digest mismatch: {} {}'.format(
+                environment,
+                path,
+            ))
+
+        return content
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.set_defaults(func=parser.print_help)
+
+    parser.add_argument(
+        '--source-directory',
+    )
+
+    targets = parser.add_mutually_exclusive_group(required=True)
+
+    targets.add_argument(
+        '--target'
+    )
+
+    targets.add_argument(
+        '--target-stem',
+        help='The target path without the extension of the compression',
+    )
+
+    parser.add_argument(
+        '--compression',
+        choices=compressions,
+        default='gzip',
+    )
+
+    parser.add_argument(
+        '--compression-level',
+        type=int,
+        help='The codec default if unset',
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Threads decompressing sources, the CPU count if unset',
+    )
+
+    parser.add_argument(
+        '--deduplicate',
+        action='store_true',
+        help='Store repeated content once with hard links to the first copy',
+    )
+
+    parser.add_argument(
+        '--namespace',
+        action='store_true',
+        help=(
+            'Put each environment\'s members below a directory named for it'
+            ' with a manifest of them all at the front'
+        ),
+    )
+
+    args = parser.parse_args()
+
+    target = args.target
+    if target is None:
+        target = args.target_stem + extensions[args.compression]
+
+    artifact_archives = glob.glob(
+        os.path.join(args.source_directory, 'artifacts.*.tar.gz'),
+    )
+
+    with open(target, 'wb') as target_file:
+        coalesce(
+            source_paths=artifact_archives,
+            target_file=target_file,
+            compression=args.compression,
+            compression_level=args.compression_level,
+            workers=args.workers,
+            deduplicate=args.deduplicate,
+            namespace=args.namespace,
+        )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
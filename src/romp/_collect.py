@@ -0,0 +1,319 @@
+import fnmatch
+import logging
+import os
+import os.path
+import re
+
+
+logger = logging.getLogger(__name__)
+
+
+ignore_file_names = ('.gitignore', '.rompignore')
+
+default_ignore_patterns = (
+    '.git/',
+    '.hg/',
+    '.svn/',
+    '.tox/',
+    '.nox/',
+    '__pycache__/',
+    '*.py[co]',
+)
+
+
+def _translate(pattern):
+    result = []
+    index = 0
+    length = len(pattern)
+
+    while index < length:
+        if pattern.startswith('**/', index):
+            result.append('(?:.*/)?')
+            index += 3
+        elif pattern.startswith('**', index):
+            result.append('.*')
+            index += 2
+        elif pattern[index] == '*':
+            result.append('[^/]*')
+            index += 1
+        elif pattern[index] == '?':
+            result.append('[^/]')
+            index += 1
+        elif pattern[index] == '[':
+            end = pattern.find(']', index + 2)
+            if end == -1:
+                result.append(re.escape('['))
+                index += 1
+                continue
+
+            content = pattern[index + 1:end]
+            if content.startswith('!'):
+                content = '^' + content[1:]
+            result.append('[' + content.replace('\\', '\\\\') + ']')
+            index = end + 1
+        elif pattern[index] == '\\' and index + 1 < length:
+            result.append(re.escape(pattern[index + 1]))
+            index += 2
+        else:
+            result.append(re.escape(pattern[index]))
+            index += 1
+
+    return re.compile(''.join(result) + r'\Z')
+
+
+class IgnoreRule:
+    def __init__(self, pattern, base):
+        self.source = pattern
+        self.base = base
+        self.prefix = os.path.join(base, '')
+
+        self.negate = pattern.startswith('!')
+        if self.negate:
+            pattern = pattern[1:]
+
+        self.directory_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+
+        # a slash anywhere but the end anchors to the base directory
+        self.anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+
+        self.regex = _translate(pattern)
+
+    def matches(self, path, is_directory):
+        if self.directory_only and not is_directory:
+            return False
+
+        if not path.startswith(self.prefix):
+            return False
+
+        relative = path[len(self.prefix):].replace(os.sep, '/')
+        if not self.anchored:
+            relative = relative.rsplit('/', 1)[-1]
+
+        return self.regex.match(relative) is not None
+
+
+def parse_ignore_lines(lines, base):
+    rules = []
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.endswith('\\ '):
+            line = line.rstrip()
+
+        if len(line) == 0 or line.startswith('#'):
+            continue
+
+        rules.append(IgnoreRule(pattern=line, base=base))
+
+    return rules
+
+
+class Collector:
+    # Expands the archive paths like git would see them.  Ignore files apply
+    # to their own directory and below with later and deeper rules taking
+    # precedence and ignored directories are not descended into.
+    def __init__(
+            self,
+            root,
+            patterns=default_ignore_patterns,
+            use_ignore_files=True,
+    ):
+        self.root = os.path.abspath(root)
+        self.use_ignore_files = use_ignore_files
+        # not tied to a directory so they apply everywhere
+        self.base_rules = tuple(
+            IgnoreRule(pattern=pattern, base='')
+            for pattern in patterns
+        )
+        self._rules = {}
+
+    def _read_rules(self, directory):
+        rules = []
+
+        if not self.use_ignore_files:
+            return rules
+
+        for name in ignore_file_names:
+            path = os.path.join(directory, name)
+            try:
+                with open(path) as f:
+                    lines = f.readlines()
+            except (IOError, OSError):
+                continue
+
+            logger.debug('loading ignore rules: %s', path)
+            rules.extend(parse_ignore_lines(lines=lines, base=directory))
+
+        return rules
+
+    def rules(self, directory):
+        # the rules applying to the entries of the directory
+        directory = os.path.abspath(directory)
+
+        rules = self._rules.get(directory)
+        if rules is not None:
+            return rules
+
+        parent = os.path.dirname(directory)
+        inside = os.path.commonprefix(
+            (os.path.join(directory, ''), os.path.join(self.root, '')),
+        ) == os.path.join(self.root, '')
+
+        if directory == self.root or not inside or parent == directory:
+            inherited = self.base_rules
+        else:
+            inherited = self.rules(parent)
+
+        rules = inherited + tuple(self._read_rules(directory))
+        self._rules[directory] = rules
+
+        return rules
+
+    def ignored(self, path, is_directory, rules=None):
+        if rules is None:
+            rules = self.rules(os.path.dirname(os.path.abspath(path)))
+
+        absolute = os.path.abspath(path)
+        result = False
+        for rule in rules:
+            if rule.matches(path=absolute, is_directory=is_directory):
+                result = not rule.negate
+
+        return result
+
+    def walk(self, path):
+        # yields (path, is_directory) for the path and what is below it, the
+        # path itself was asked for explicitly so it is never ignored
+        is_directory = os.path.isdir(path) and not os.path.islink(path)
+
+        yield path, is_directory
+
+        if is_directory:
+            for item in self._walk_directory(path):
+                yield item
+
+    def _walk_directory(self, directory):
+        rules = self.rules(directory)
+
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        for entry in entries:
+            is_directory = entry.is_dir(follow_symlinks=False)
+            path = os.path.join(directory, entry.name)
+
+            if self.ignored(path=path, is_directory=is_directory, rules=rules):
+                continue
+
+            yield path, is_directory
+
+            if is_directory:
+                for item in self._walk_directory(path):
+                    yield item
+
+    def glob(self, pattern):
+        # like glob.glob(recursive=True) but pruning ignored paths
+        parts = pattern.replace(os.sep, '/').split('/')
+
+        if len(parts) > 1 and parts[0] == '':
+            parts[0] = os.sep
+
+        for index, part in enumerate(parts):
+            if _has_magic(part):
+                break
+        else:
+            if os.path.lexists(pattern):
+                return [pattern]
+
+            return []
+
+        base = os.path.join(*parts[:index]) if index > 0 else ''
+
+        results = []
+        seen = set()
+        for path in self._glob(base, parts[index:]):
+            if path not in seen:
+                seen.add(path)
+                results.append(path)
+
+        return results
+
+    def _glob(self, directory, parts):
+        if len(parts) == 0:
+            yield directory
+            return
+
+        part = parts[0]
+        rest = parts[1:]
+
+        if not _has_magic(part):
+            path = os.path.join(directory, part)
+            if len(rest) == 0:
+                if os.path.lexists(path):
+                    yield path
+            elif os.path.isdir(path):
+                for match in self._glob(path, rest):
+                    yield match
+
+            return
+
+        rules = self.rules(directory or os.curdir)
+
+        try:
+            entries = sorted(
+                os.scandir(directory or os.curdir),
+                key=lambda entry: entry.name,
+            )
+        except OSError:
+            return
+
+        if part == '**':
+            if len(rest) > 0:
+                for match in self._glob(directory, rest):
+                    yield match
+
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+
+                is_directory = entry.is_dir(follow_symlinks=False)
+                path = os.path.join(directory, entry.name)
+
+                if self.ignored(
+                        path=path,
+                        is_directory=is_directory,
+                        rules=rules,
+                ):
+                    continue
+
+                if len(rest) == 0:
+                    yield path
+
+                if is_directory:
+                    for match in self._glob(path, parts):
+                        yield match
+
+            return
+
+        for entry in entries:
+            if entry.name.startswith('.') and not part.startswith('.'):
+                continue
+
+            if not fnmatch.fnmatchcase(entry.name, part):
+                continue
+
+            is_directory = entry.is_dir()
+            path = os.path.join(directory, entry.name)
+
+            if self.ignored(path=path, is_directory=is_directory, rules=rules):
+                continue
+
+            if len(rest) == 0:
+                yield path
+            elif is_directory:
+                for match in self._glob(path, rest):
+                    yield match
+
+
+def _has_magic(part):
+    return any(character in part for character in '*?[')
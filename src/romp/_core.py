@@ -1,65 +1,944 @@
-import glob
+import bz2
+import calendar
+import collections
+import fnmatch
+import functools
+import hashlib
 import io
 import json
 import logging
+import multiprocessing.pool
 import os
 import os.path
 import posixpath
+import queue
+import random
+import re
+import shutil
+import struct
+import subprocess
 import tarfile
+import tempfile
+import threading
 import time
+import uuid
 import zipfile
+import zlib
+from urllib.parse import urlparse
+from urllib.request import pathname2url
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    from compression import zstd as compression_zstd
+except ImportError:
+    compression_zstd = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 import requests
+import requests.adapters
 import requests.auth
 
+import romp._coalesce
+import romp._collect
+
 
 logger = logging.getLogger(__name__)
 
 
-def write_tarball_bytes(file, paths, paths_root):
-    with tarfile.TarFile(fileobj=file, mode='w') as archive:
-        for path in paths:
-            archive.add(name=path, arcname=os.path.relpath(path, paths_root))
+default_chunk_size = 64 * 1024
+default_upload_chunk_size = 8 * 1024 * 1024
+# downloads larger than this go to disk rather than staying in memory
+default_spool_size = 1024 * 1024
+# enough for the end of central directory record with the longest comment
+# and usually for the whole central directory too
+zip_tail_size = 64 * 1024 + 22
+
+
+class _NullCompressor:
+    def compress(self, data):
+        return bytes(data)
+
+    def flush(self):
+        return b''
+
+
+def _create_null_compressor(level):
+    return _NullCompressor()
+
+
+class _GzipCompressor:
+    # The header is written here rather than by zlib so that it does not
+    # depend on the platform zlib was built for.  The mtime is always zero
+    # and the OS is always 'unknown'.
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(
+            level,
+            zlib.DEFLATED,
+            -zlib.MAX_WBITS,
+        )
+        self.crc = 0
+        self.size = 0
+        self.header = struct.pack(
+            '<BBBBIBB',
+            0x1f,
+            0x8b,
+            zlib.DEFLATED,
+            0,
+            0,
+            {1: 4, 9: 2}.get(level, 0),
+            255,
+        )
+
+    def compress(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+        compressed = self.header + self.compressor.compress(data)
+        self.header = b''
+
+        return compressed
+
+    def flush(self):
+        return b''.join((
+            self.header,
+            self.compressor.flush(),
+            struct.pack(
+                '<II',
+                self.crc & 0xffffffff,
+                self.size & 0xffffffff,
+            ),
+        ))
+
+
+def _create_gzip_compressor(level):
+    return _GzipCompressor(level=level)
+
+
+def _create_bz2_compressor(level):
+    return bz2.BZ2Compressor(level)
+
+
+def _create_xz_compressor(level):
+    return lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=level)
+
+
+def _create_zstd_compressor(level):
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+
+    return compression_zstd.ZstdCompressor(level=level)
+
+
+class Codec:
+    def __init__(
+            self,
+            name,
+            extension,
+            create_compressor,
+            default_level,
+            auto_levels,
+            available=True,
+    ):
+        self.name = name
+        self.extension = extension
+        self._create_compressor = create_compressor
+        self.default_level = default_level
+        self.auto_levels = auto_levels
+        self.available = available
+
+    def create_compressor(self, level=None):
+        if level is None:
+            level = self.default_level
+
+        return self._create_compressor(level)
+
+
+all_codecs = collections.OrderedDict(
+    (codec.name, codec)
+    for codec in (
+        Codec(
+            name='none',
+            extension='.tar',
+            create_compressor=_create_null_compressor,
+            default_level=None,
+            auto_levels=(None,),
+        ),
+        Codec(
+            name='gzip',
+            extension='.tar.gz',
+            create_compressor=_create_gzip_compressor,
+            default_level=6,
+            auto_levels=(1, 6, 9),
+        ),
+        Codec(
+            name='bz2',
+            extension='.tar.bz2',
+            create_compressor=_create_bz2_compressor,
+            default_level=9,
+            auto_levels=(9,),
+        ),
+        # Python 2.7's tarfile can not read xz and zstd needs a module or
+        # command the build agent may not have so auto never picks them
+        Codec(
+            name='xz',
+            extension='.tar.xz',
+            create_compressor=_create_xz_compressor,
+            default_level=6,
+            auto_levels=(),
+            available=lzma is not None,
+        ),
+        Codec(
+            name='zstd',
+            extension='.tar.zst',
+            create_compressor=_create_zstd_compressor,
+            default_level=3,
+            auto_levels=(),
+            available=(
+                zstandard is not None
+                or compression_zstd is not None
+            ),
+        ),
+    )
+)
+
+
+codecs = collections.OrderedDict(
+    (name, codec)
+    for name, codec in all_codecs.items()
+    if codec.available
+)
+
+
+class _CompressingWriter:
+    def __init__(self, file, compressor):
+        self.file = file
+        self.compressor = compressor
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        if len(compressed) > 0:
+            self.file.write(compressed)
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        self.file.write(self.compressor.flush())
+
+
+def reproducible_mtime():
+    return int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+
+
+def normalize_tarinfo(info, mtime):
+    info.uid = 0
+    info.gid = 0
+    info.uname = ''
+    info.gname = ''
+    info.mtime = mtime
+
+    if info.isdir() or info.mode & 0o100:
+        info.mode = 0o755
+    else:
+        info.mode = 0o644
+
+    return info
+
+
+def iter_archive_members(paths, paths_root, collector=None):
+    if collector is None:
+        collector = romp._collect.Collector(
+            root=paths_root or os.curdir,
+            patterns=(),
+            use_ignore_files=False,
+        )
+
+    for path in paths:
+        for member_path, _ in collector.walk(path):
+            yield member_path, os.path.relpath(member_path, paths_root)
+
+
+def collect_archive_members(
+        paths,
+        paths_root,
+        reproducible=False,
+        collector=None,
+):
+    # a ** pattern matches directories along with the files below them so
+    # the same path can be walked more than once, each is archived once
+    by_arcname = collections.OrderedDict()
+    for path, arcname in iter_archive_members(
+            paths=paths,
+            paths_root=paths_root,
+            collector=collector,
+    ):
+        by_arcname.setdefault(arcname.replace(os.sep, '/'), (path, arcname))
+
+    if reproducible:
+        return [by_arcname[arcname] for arcname in sorted(by_arcname)]
+
+    return list(by_arcname.values())
+
+
+class PrefetchedMember:
+    def __init__(self, path, info, stat, data, digest):
+        self.path = path
+        self.info = info
+        self.stat = stat
+        self.data = data
+        self.digest = digest
+
+
+_scratch = threading.local()
+
+
+def _gettarinfo(path, arcname):
+    # TarFile.gettarinfo() tracks inodes to detect hard links which would
+    # depend on the order the worker threads happen to run in.  Each thread
+    # uses its own scratch archive and hard links are resolved by the writer.
+    scratch = getattr(_scratch, 'archive', None)
+    if scratch is None:
+        scratch = tarfile.TarFile(fileobj=io.BytesIO(), mode='w')
+        _scratch.archive = scratch
+
+    scratch.inodes.clear()
+
+    return scratch.gettarinfo(name=path, arcname=arcname)
+
+
+def prefetch_member(path, arcname, read_limit, hash_files):
+    stat = os.lstat(path)
+    info = _gettarinfo(path=path, arcname=arcname)
+    data = None
+    digest = None
+
+    if info.isreg():
+        if info.size <= read_limit:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            if hash_files:
+                digest = digest_chunks([data])
+        elif hash_files:
+            with open(path, 'rb') as f:
+                digest = digest_chunks(iter_file_chunks(file=f))
+
+    return PrefetchedMember(
+        path=path,
+        info=info,
+        stat=stat,
+        data=data,
+        digest=digest,
+    )
+
+
+def iter_prefetched_members(
+        members,
+        workers=8,
+        read_limit=64 * 2**10,
+        hash_files=False,
+):
+    # files up to the read limit are read by the workers while larger ones
+    # are left to be streamed by the writer so memory use stays bounded
+    arguments = [
+        (path, arcname, read_limit, hash_files)
+        for path, arcname in members
+    ]
+
+    if workers <= 1:
+        for argument in arguments:
+            yield prefetch_member(*argument)
+
+        return
+
+    pool = multiprocessing.pool.ThreadPool(processes=workers)
+    pending = collections.deque()
+    depth = 8 * workers
+
+    try:
+        for argument in arguments:
+            pending.append(pool.apply_async(prefetch_member, argument))
+
+            if len(pending) >= depth:
+                yield pending.popleft().get()
+
+        while len(pending) > 0:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def write_tarball_bytes(
+        file,
+        paths,
+        paths_root,
+        compression='none',
+        compression_level=None,
+        reproducible=False,
+        read_workers=8,
+        collector=None,
+        collapse_duplicates=False,
+):
+    writer = _CompressingWriter(
+        file=file,
+        compressor=codecs[compression].create_compressor(
+            level=compression_level,
+        ),
+    )
+
+    members = collect_archive_members(
+        paths=paths,
+        paths_root=paths_root,
+        reproducible=reproducible,
+        collector=collector,
+    )
+
+    if reproducible:
+        tar_format = tarfile.PAX_FORMAT
+        mtime = reproducible_mtime()
+    else:
+        tar_format = tarfile.DEFAULT_FORMAT
+
+    linked_inodes = {}
+    duplicates = {}
+
+    with tarfile.open(fileobj=writer, mode='w|', format=tar_format) as archive:
+        prefetched_members = iter_prefetched_members(
+            members=members,
+            workers=read_workers,
+            hash_files=collapse_duplicates,
+        )
+        for member in prefetched_members:
+            info = member.info
+
+            if reproducible:
+                normalize_tarinfo(info=info, mtime=mtime)
+
+            if not info.isreg():
+                archive.addfile(info)
+                continue
+
+            if member.stat.st_nlink > 1:
+                inode = (member.stat.st_dev, member.stat.st_ino)
+                if inode in linked_inodes:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = linked_inodes[inode]
+                    info.size = 0
+                    archive.addfile(info)
+                    continue
+
+                linked_inodes[inode] = info.name
+
+            if collapse_duplicates and info.size > 0:
+                if member.digest in duplicates:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = duplicates[member.digest]
+                    info.size = 0
+                    archive.addfile(info)
+                    continue
+
+                duplicates[member.digest] = info.name
+
+            if member.data is not None:
+                archive.addfile(info, io.BytesIO(member.data))
+            else:
+                with open(member.path, 'rb') as f:
+                    archive.addfile(info, f)
+
+    writer.finish()
+
+
+def sample_paths(
+        paths,
+        sample_size=2**20,
+        block_size=64 * 2**10,
+        collector=None,
+):
+    sample = bytearray()
+    total_size = 0
+
+    members = iter_archive_members(
+        paths=paths,
+        paths_root=None,
+        collector=collector,
+    )
+    for path, _ in members:
+        if not os.path.isfile(path) or os.path.islink(path):
+            continue
+
+        total_size += os.path.getsize(path)
+
+        if len(sample) < sample_size:
+            with open(path, 'rb') as f:
+                remaining = sample_size - len(sample)
+                sample.extend(f.read(min(block_size, remaining)))
+
+    return bytes(sample), total_size
+
+
+def choose_compression(paths, link_speed, collector=None):
+    sample, total_size = sample_paths(paths=paths, collector=collector)
+
+    if len(sample) == 0:
+        return 'none', None
+
+    best = None
+
+    for codec in codecs.values():
+        for level in codec.auto_levels:
+            compressor = codec.create_compressor(level=level)
+
+            start = time.perf_counter()
+            compressed_size = len(compressor.compress(sample))
+            compressed_size += len(compressor.flush())
+            elapsed = time.perf_counter() - start
+
+            compress_time = total_size * elapsed / len(sample)
+            upload_time = (
+                total_size * compressed_size / len(sample) / link_speed
+            )
+            # compression and upload are streamed concurrently so the slower
+            # of the two dominates the total
+            estimate = max(compress_time, upload_time)
+
+            logger.info(
+                'compression %s level %s: ratio %.3f, estimated %.2f seconds',
+                codec.name,
+                level,
+                compressed_size / float(len(sample)),
+                estimate,
+            )
+
+            if best is None or estimate < best[0]:
+                best = (estimate, codec.name, level)
+
+    _, name, level = best
+
+    return name, level
+
+
+class _Abandoned(Exception):
+    pass
+
+
+class _QueueWriter:
+    def __init__(self, chunks, chunk_size, abandoned):
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        self.abandoned = abandoned
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer.extend(data)
+
+        while len(self.buffer) >= self.chunk_size:
+            self.put(('chunk', bytes(self.buffer[:self.chunk_size])))
+            del self.buffer[:self.chunk_size]
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        if len(self.buffer) > 0:
+            self.put(('chunk', bytes(self.buffer)))
+            self.buffer = bytearray()
+
+    def put(self, item):
+        # the consumer may stop iterating early so don't block forever
+        while not self.abandoned.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+
+            return
+
+        raise _Abandoned()
+
+
+def iter_written_chunks(write, chunk_size=default_chunk_size, depth=4):
+    chunks = queue.Queue(maxsize=depth)
+    abandoned = threading.Event()
+    writer = _QueueWriter(
+        chunks=chunks,
+        chunk_size=chunk_size,
+        abandoned=abandoned,
+    )
+
+    def target():
+        try:
+            try:
+                write(writer)
+                writer.finish()
+            except _Abandoned:
+                raise
+            except Exception as e:
+                writer.put(('error', e))
+            else:
+                writer.put(('done', None))
+        except _Abandoned:
+            pass
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            kind, value = chunks.get()
+
+            if kind == 'done':
+                break
+            elif kind == 'error':
+                raise value
+
+            yield value
+    finally:
+        abandoned.set()
+        thread.join()
+
+
+def iter_tarball_chunks(
+        paths,
+        paths_root,
+        compression='none',
+        compression_level=None,
+        reproducible=False,
+        read_workers=8,
+        collector=None,
+        collapse_duplicates=False,
+        chunk_size=default_chunk_size,
+):
+    return iter_written_chunks(
+        write=functools.partial(
+            write_tarball_bytes,
+            paths=paths,
+            paths_root=paths_root,
+            compression=compression,
+            compression_level=compression_level,
+            reproducible=reproducible,
+            read_workers=read_workers,
+            collector=collector,
+            collapse_duplicates=collapse_duplicates,
+        ),
+        chunk_size=chunk_size,
+    )
+
+
+def _git(directory, *args):
+    output = subprocess.check_output(('git',) + args, cwd=directory)
+
+    return output.decode('utf-8').strip()
+
+
+def git_tree_hash(ref, directory='.'):
+    # git archive run in a subdirectory only includes that subdirectory so
+    # the identity is the tree of the same
+    return _git(directory, 'rev-parse', '--verify', '{}:./'.format(ref))
+
+
+def write_git_tarball_bytes(
+        file,
+        ref,
+        directory='.',
+        compression='none',
+        compression_level=None,
+):
+    writer = _CompressingWriter(
+        file=file,
+        compressor=codecs[compression].create_compressor(
+            level=compression_level,
+        ),
+    )
+
+    # tracked files straight from the object database, the working tree is
+    # not looked at
+    process = subprocess.Popen(
+        ['git', 'archive', '--format=tar', ref],
+        cwd=directory,
+        stdout=subprocess.PIPE,
+    )
+
+    try:
+        for chunk in iter_file_chunks(file=process.stdout):
+            writer.write(chunk)
+    except BaseException:
+        # given up on part way so git may still be writing, at the end of
+        # the output it may not have exited yet and is just waited for
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        process.wait()
+
+    if process.returncode != 0:
+        raise Exception(
+            'git archive of {} failed with {}'.format(ref, process.returncode),
+        )
+
+    writer.finish()
+
+
+def iter_git_tarball_chunks(
+        ref,
+        directory='.',
+        compression='none',
+        compression_level=None,
+        chunk_size=default_chunk_size,
+):
+    return iter_written_chunks(
+        write=functools.partial(
+            write_git_tarball_bytes,
+            ref=ref,
+            directory=directory,
+            compression=compression,
+            compression_level=compression_level,
+        ),
+        chunk_size=chunk_size,
+    )
+
+
+def iter_file_chunks(file, chunk_size=default_chunk_size):
+    return iter(functools.partial(file.read, chunk_size), b'')
+
+
+def iter_multipart_chunks(
+        chunks,
+        boundary,
+        field_name,
+        file_name,
+        content_type='application/octet-stream',
+):
+    header = (
+        '--{boundary}\r\n'
+        'Content-Disposition: form-data; name="{field_name}";'
+        ' filename="{file_name}"\r\n'
+        'Content-Type: {content_type}\r\n'
+        '\r\n'
+    ).format(
+        boundary=boundary,
+        field_name=field_name,
+        file_name=file_name,
+        content_type=content_type,
+    )
+    yield header.encode('utf-8')
+
+    for chunk in chunks:
+        yield chunk
+
+    yield '\r\n--{boundary}--\r\n'.format(boundary=boundary).encode('utf-8')
+
+
+class PollSchedule:
+    # Without a known duration the build is polled at the fixed
+    # unknown_maximum period.  If it is known how long the build usually
+    # runs, polls are quick while it is queued, back off in proportion to
+    # how long it has been running and then, within spread of the expected
+    # duration either side, are never slower than the unknown period and
+    # speed up as the expected finish approaches.  The finish is noticed no
+    # later than without knowing the duration so long as it falls in that
+    # window.
+    def __init__(
+            self,
+            minimum=2,
+            maximum=60,
+            unknown_maximum=15,
+            expected_duration=None,
+            backoff=0.25,
+            spread=0.2,
+            jitter=0.1,
+            random=random.random,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.unknown_maximum = unknown_maximum
+        self.expected_duration = expected_duration
+        self.backoff = backoff
+        self.spread = spread
+        self.jitter = jitter
+        self.random = random
+
+    def delay(self, status, running):
+        # running is the seconds since the build was first seen in progress
+        if self.expected_duration is None:
+            # polling any faster would only cost requests, nothing is known
+            # to say when it might pay off
+            return max(self.minimum, min(self.maximum, self.unknown_maximum))
+
+        remaining = self.expected_duration - running
+        window = self.expected_duration * self.spread
+
+        if status != 'inProgress':
+            delay = self.minimum
+        elif remaining > window:
+            # back off but not so far past the start of the window that the
+            # polls there are late
+            delay = min(
+                running * self.backoff,
+                max(self.unknown_maximum, remaining - window),
+            )
+        else:
+            delay = min(self.unknown_maximum, abs(remaining) / 2.0)
+
+        delay = max(self.minimum, min(self.maximum, delay))
+
+        # spread out the polls of builds started together, only ever sooner
+        # so the periods above are never exceeded
+        return delay * (1 - self.jitter * self.random())
 
 
 class Build:
-    def __init__(self, id, url, human_url):
+    def __init__(self, id, url, human_url, session=requests):
         self.id = id
         self.url = url
         self.human_url = human_url
+        self.session = session
+        self.etag = None
+        self.response_json = None
+        self.started = None
+        self.duration = None
+        self.failed_job = None
+        self.cancelled = False
 
     @classmethod
-    def from_response_json(cls, response_json):
+    def from_response_json(cls, response_json, session=requests):
         id = response_json['id']
         url = response_json['url']
         human_url = response_json['_links']['web']['href']
 
-        return cls(id=id, url=url, human_url=human_url)
+        return cls(id=id, url=url, human_url=human_url, session=session)
 
-    def wait_for_lock_build(self, check_period=15):
-        while True:
-            logger.info("build url: %s", self.url)
-            response = requests.get(self.url)
+    def poll(self):
+        # a single check of the build, an unchanged build is answered with
+        # a bodyless 304 and the previous response is reused
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
 
-            response.raise_for_status()
-            logger.info(response.content)
-            response_json = response.json()
+        response = self.session.get(self.url, headers=headers)
 
-            status = response_json['status']
+        if response.status_code == 304 and self.response_json is not None:
+            logger.debug('build unchanged: %s', self.url)
+            return self.response_json
 
-            if status == 'completed':
-                return response_json
+        response.raise_for_status()
+        logger.debug(response.content)
 
-            logger.info('')
-            logger.info('Url: %s', self.human_url)
-            logger.info('Build Status: %s', status)
-            logger.info(
-                '    waiting %s seconds to check again for completion',
-                check_period,
+        self.etag = response.headers.get('ETag')
+        self.response_json = response.json()
+
+        return self.response_json
+
+    def check(self, schedule, clock=time.perf_counter):
+        # polls once and returns the response and how long to wait before
+        # the next check, None once completed, so both the blocking and the
+        # asyncio waits share it
+        response_json = self.poll()
+
+        return response_json, self.observe(
+            response_json=response_json,
+            schedule=schedule,
+            clock=clock,
+        )
+
+    def observe(self, response_json, schedule, clock=time.perf_counter):
+        # the delay until the next check, None once completed
+        self.response_json = response_json
+        status = response_json['status']
+        now = clock()
+
+        if status != 'notStarted' and self.started is None:
+            self.started = now
+
+        if status == 'completed':
+            self.duration = now - self.started
+            return None
+
+        delay = schedule.delay(
+            status=status,
+            running=0 if self.started is None else now - self.started,
+        )
+
+        logger.info('')
+        logger.info('Url: %s', self.human_url)
+        logger.info('Build Status: %s', status)
+        logger.info(
+            '    waiting %.1f seconds to check again for completion',
+            delay,
+        )
+
+        return delay
+
+    def wait_for_lock_build(
+            self,
+            check_period=15,
+            schedule=None,
+            clock=time.perf_counter,
+            sleep=time.sleep,
+            on_job_event=None,
+    ):
+        if schedule is None:
+            schedule = PollSchedule(unknown_maximum=check_period)
+
+        logger.info("build url: %s", self.url)
+
+        if on_job_event is not None:
+            job_events = self.iter_job_events(
+                schedule=schedule,
+                clock=clock,
+                sleep=sleep,
             )
-            time.sleep(check_period)
+            for event in job_events:
+                on_job_event(event)
+
+            return self.response_json
+
+        while True:
+            response_json, delay = self.check(schedule=schedule, clock=clock)
 
-    def get_lock_build_artifact(self, artifact_file):
+            if delay is None:
+                return response_json
+
+            sleep(delay)
+
+    def iter_job_events(
+            self,
+            schedule=None,
+            clock=time.perf_counter,
+            sleep=time.sleep,
+    ):
+        # waits for the build like wait_for_lock_build while yielding the
+        # romp on jobs starting and finishing as they happen
+        if schedule is None:
+            schedule = PollSchedule()
+
+        timeline = Timeline(build=self)
+
+        while True:
+            _, delay = self.check(schedule=schedule, clock=clock)
+
+            for event in timeline.poll():
+                yield event
+
+            if delay is None:
+                return
+
+            sleep(delay)
+
+    def artifact_download_url(self, artifact_name):
         # 'https://dev.azure.com/altendky/a27e6706-93a8-46b1-8098-e5134713123d/_apis/build/builds/222/artifacts?artifactName=all&fileId=615BBA316A140A61F371BA354124349281B001BE9689366DA9660AC506A1ECCE01&fileName=lock.tar.gz&api-version=5.0-preview.3'
         # url = (
         #     'https://dev.azure.com'
@@ -69,7 +948,7 @@ class Build:
 
         logger.info('artifact url: %s', url)
 
-        response = requests.get(
+        response = self.session.get(
             url=url,
             params={
                 'api-version': '5.0',
@@ -77,28 +956,443 @@ class Build:
         )
         response.raise_for_status()
 
-        artifact_name = 'artifacts'
-
         response_json = response.json()
         for artifact in response_json['value']:
             if artifact['name'] != artifact_name:
                 continue
 
-            artifact_download_url = artifact['resource']['downloadUrl']
+            return artifact['resource']['downloadUrl']
+
+        return None
+
+    def get_artifact_zip(self, artifact_name, required=True):
+        url = self.artifact_download_url(artifact_name)
+        if url is None:
+            if not required:
+                return None
 
-            break
-        else:
             raise Exception('artifact not found: ' + artifact_name)
 
-        response = requests.get(artifact_download_url)
-        i = io.BytesIO(response.content)
+        # ask for the tail holding the central directory first so the
+        # members can then be fetched on their own, servers that ignore the
+        # range send the whole zip instead
+        response = self.session.get(
+            url,
+            headers={'Range': 'bytes=-{}'.format(zip_tail_size)},
+            stream=True,
+        )
+        with response:
+            response.raise_for_status()
+
+            if response.status_code == 206:
+                logger.info('reading artifact with ranges: %s', url)
+                content_range = response.headers['Content-Range']
+                file = _HttpRangeFile(
+                    session=self.session,
+                    url=response.url,
+                    size=int(content_range.rsplit('/', 1)[1]),
+                    tail=response.content,
+                )
+            else:
+                logger.info('ranges not supported, downloading: %s', url)
+                file = tempfile.SpooledTemporaryFile(
+                    max_size=default_spool_size,
+                )
+                try:
+                    for chunk in response.iter_content(
+                            chunk_size=default_chunk_size,
+                    ):
+                        file.write(chunk)
+                    file.seek(0)
+                except BaseException:
+                    file.close()
+                    raise
 
-        with zipfile.ZipFile(file=i) as artifacts:
-            opened = artifacts.open(
-                posixpath.join(artifact_name, 'artifacts.tar.gz'),
+        try:
+            artifacts = _ClosingZipFile(file=file)
+        except BaseException:
+            file.close()
+            raise
+
+        if isinstance(file, _HttpRangeFile):
+            # no range needs to run past the start of the next member
+            file.boundaries = sorted(
+                info.header_offset
+                for info in artifacts.infolist()
             )
+
+        return artifacts
+
+    def get_lock_build_artifact(self, artifact_file, compression='gzip'):
+        artifact_name = 'artifacts'
+        file_name = 'artifacts' + romp._coalesce.extensions[compression]
+
+        with self.get_artifact_zip(artifact_name) as artifacts:
+            opened = artifacts.open(posixpath.join(artifact_name, file_name))
             with opened as f:
-                artifact_file.write(f.read())
+                shutil.copyfileobj(f, artifact_file, default_chunk_size)
+
+    def read_lock_build_artifact_file(
+            self,
+            environment,
+            path,
+            compression='gzip',
+    ):
+        # one file out of a namespaced artifact, found through its manifest
+        artifact_name = 'artifacts'
+        file_name = 'artifacts' + romp._coalesce.extensions[compression]
+        member = posixpath.join(artifact_name, file_name)
+
+        with self.get_artifact_zip(artifact_name) as artifacts:
+            with artifacts.open(member) as f:
+                manifest = romp._coalesce.Manifest.read(
+                    fileobj=f,
+                    compression=compression,
+                )
+
+            with artifacts.open(member) as f:
+                return manifest.read_file(
+                    fileobj=f,
+                    environment=environment,
+                    path=path,
+                    compression=compression,
+                )
+
+    def save_artifact_tarballs(self, artifact_name, directory, required=True):
+        # saves the artifacts.<uuid>.tar.gz published by the jobs and returns
+        # their paths
+        paths = []
+
+        artifacts = self.get_artifact_zip(
+            artifact_name=artifact_name,
+            required=required,
+        )
+        if artifacts is None:
+            return paths
+
+        with artifacts:
+            for info in artifacts.infolist():
+                name = posixpath.basename(info.filename)
+                if not fnmatch.fnmatchcase(name, 'artifacts.*.tar.gz'):
+                    continue
+
+                path = os.path.join(directory, name)
+                with artifacts.open(info) as source, open(path, 'wb') as f:
+                    shutil.copyfileobj(source, f, default_chunk_size)
+                paths.append(path)
+
+        return paths
+
+    def extract_artifacts(
+            self,
+            artifact_name,
+            extractor,
+            environment=None,
+            required=True,
+    ):
+        # streams the artifacts.*.tar.gz published by the jobs into the
+        # extractor straight from the download and returns the paths written
+        paths = []
+
+        artifacts = self.get_artifact_zip(
+            artifact_name=artifact_name,
+            required=required,
+        )
+        if artifacts is None:
+            return paths
+
+        with artifacts:
+            infos = strip_zip_info_prefixes(
+                prefix=artifact_name,
+                zip_infos=artifacts.infolist(),
+            )
+            for info in sorted(infos, key=lambda info: info.filename):
+                name = info.filename
+                if not fnmatch.fnmatchcase(name, 'artifacts.*.tar.gz'):
+                    continue
+
+                if environment is None:
+                    archive_environment = romp._coalesce.archive_environment(
+                        name,
+                    )
+                else:
+                    archive_environment = environment
+
+                with artifacts.open(info) as f:
+                    paths.extend(extractor.extract_tarball(
+                        fileobj=f,
+                        environment=archive_environment,
+                    ))
+
+        return paths
+
+    def cancel(self):
+        logger.info('cancelling build: %s', self.url)
+
+        response = self.session.patch(
+            self.url,
+            params={'api-version': '5.0'},
+            json={'status': 'cancelling'},
+        )
+        response.raise_for_status()
+        self.cancelled = True
+
+
+class _ClosingZipFile(zipfile.ZipFile):
+    # owns the downloaded file and closes it along with the zip
+    def __init__(self, file):
+        zipfile.ZipFile.__init__(self, file=file)
+        self.owned_file = file
+
+    def close(self):
+        try:
+            zipfile.ZipFile.close(self)
+        finally:
+            self.owned_file.close()
+
+
+class _HttpRangeFile(io.RawIOBase):
+    # A read only seekable file fetching its content with range requests.
+    # The already downloaded tail is served from memory and the rest is
+    # streamed from one open response for as long as the reads stay
+    # sequential.  Ranges end at the next boundary so reading one zip member
+    # does not transfer the following ones.
+    def __init__(self, session, url, size, tail):
+        io.RawIOBase.__init__(self)
+        self.session = session
+        self.url = url
+        self.size = size
+        self.tail = tail
+        self.tail_start = size - len(tail)
+        self.boundaries = []
+        self.position = 0
+        self.response = None
+        self.response_position = None
+        self.response_end = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('unsupported whence: {!r}'.format(whence))
+
+        if position < 0:
+            raise ValueError('negative seek position: {}'.format(position))
+
+        self.position = position
+
+        return self.position
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        filled = 0
+
+        while filled < len(view) and self.position < self.size:
+            wanted = len(view) - filled
+
+            if self.position >= self.tail_start:
+                start = self.position - self.tail_start
+                data = self.tail[start:start + wanted]
+            else:
+                data = self._read_range(wanted)
+
+            view[filled:filled + len(data)] = data
+            filled += len(data)
+            self.position += len(data)
+
+        return filled
+
+    def _read_range(self, size):
+        if self.response_position != self.position:
+            self._open_range()
+
+        size = min(size, self.response_end - self.position)
+        data = self.response.raw.read(size)
+        if len(data) == 0:
+            raise Exception('range ended early: {}'.format(self.url))
+
+        self.response_position += len(data)
+
+        return data
+
+    def _open_range(self):
+        self._close_response()
+
+        end = min(
+            [
+                boundary
+                for boundary in self.boundaries
+                if boundary > self.position
+            ] + [self.tail_start],
+        )
+
+        response = self.session.get(
+            self.url,
+            headers={
+                'Range': 'bytes={}-{}'.format(self.position, end - 1),
+            },
+            stream=True,
+        )
+        try:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise Exception('range not honored: {}'.format(self.url))
+        except BaseException:
+            response.close()
+            raise
+
+        self.response = response
+        self.response_position = self.position
+        self.response_end = end
+
+    def _close_response(self):
+        if self.response is not None:
+            self.response.close()
+
+        self.response = None
+        self.response_position = None
+        self.response_end = None
+
+    def close(self):
+        self._close_response()
+        io.RawIOBase.close(self)
+
+
+def job_artifact_name(environment):
+    return 'artifacts-' + environment
+
+
+artifact_modes = ('coalesced', 'per-job')
+
+
+job_name_prefix = 'romp on '
+
+
+def parse_time(text):
+    # seconds since the epoch from the UTC times in the API which can have
+    # more fractional digits than strptime accepts
+    match = re.match(
+        r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?Z?$',
+        text,
+    )
+    if match is None:
+        raise Exception('unable to parse time: {!r}'.format(text))
+
+    whole, fraction = match.groups()
+    seconds = calendar.timegm(time.strptime(whole, '%Y-%m-%dT%H:%M:%S'))
+    if fraction is not None:
+        seconds += float('0.' + fraction)
+
+    return seconds
+
+
+class JobEvent:
+    # a romp on job, one per environment, starting or finishing
+    def __init__(self, kind, name, environment, result, duration, record):
+        self.kind = kind
+        self.name = name
+        self.environment = environment
+        self.result = result
+        self.duration = duration
+        self.record = record
+
+    @classmethod
+    def from_record(cls, kind, record):
+        name = record['name']
+        # the matrix entry names are the space separated environment fields
+        environment = '-'.join(name[len(job_name_prefix):].split())
+
+        duration = None
+        if record.get('startTime') and record.get('finishTime'):
+            duration = (
+                parse_time(record['finishTime'])
+                - parse_time(record['startTime'])
+            )
+
+        return cls(
+            kind=kind,
+            name=name,
+            environment=environment,
+            result=record.get('result') if kind == 'finished' else None,
+            duration=duration if kind == 'finished' else None,
+            record=record,
+        )
+
+    def __repr__(self):
+        return '<JobEvent {} {} {}>'.format(
+            self.kind,
+            self.environment,
+            self.result,
+        )
+
+
+class Timeline:
+    # Follows the records of a build's timeline fetching only those changed
+    # since the previous poll and reports the romp on jobs as they start and
+    # finish.
+    def __init__(self, build):
+        self.build = build
+        self.url = build.url + '/timeline'
+        self.change_id = None
+        self.states = {}
+
+    def poll(self):
+        params = {'api-version': '5.0'}
+        if self.change_id is not None:
+            params['changeId'] = self.change_id
+
+        response = self.build.session.get(self.url, params=params)
+        response.raise_for_status()
+
+        # nothing at all is returned before the timeline exists
+        if response.status_code == 204 or len(response.content) == 0:
+            return []
+
+        response_json = response.json()
+        self.change_id = response_json.get('changeId', self.change_id)
+
+        events = []
+        for record in response_json.get('records', []):
+            if record.get('type') != 'Job':
+                continue
+
+            if not record.get('name', '').startswith(job_name_prefix):
+                continue
+
+            previous = self.states.get(record['id'])
+            state = record.get('state')
+            self.states[record['id']] = state
+
+            if state == previous:
+                continue
+
+            if state in ('inProgress', 'completed') and previous in (
+                    None,
+                    'pending',
+            ):
+                events.append(
+                    JobEvent.from_record(kind='started', record=record),
+                )
+
+            if state == 'completed':
+                events.append(
+                    JobEvent.from_record(kind='finished', record=record),
+                )
+
+        return events
 
 
 def strip_zip_info_prefixes(prefix, zip_infos):
@@ -124,50 +1418,721 @@ def strip_zip_info_prefixes(prefix, zip_infos):
     return result
 
 
-def post_file(data):
-    response = requests.post(
-        url='https://file.io/',
-        params={'expires': '1w'},
-        files={'file': ('archive.tar.gz', data)},
+class DeadlineExceeded(Exception):
+    pass
+
+
+def check_deadline(deadline):
+    # deadline is a time.time() or None for none
+    if deadline is not None and time.time() >= deadline:
+        raise DeadlineExceeded('upload did not finish before the deadline')
+
+
+def _iter_counted(chunks, counter, deadline=None):
+    for chunk in chunks:
+        check_deadline(deadline)
+        counter[0] += len(chunk)
+        yield chunk
+
+
+default_upload_url = 'https://file.io/'
+upload_expires = '1w'
+upload_lifetime = 7 * 24 * 60 * 60
+# leave the build time to be queued and fetch a reused archive
+upload_cache_margin = 24 * 60 * 60
+# bytes per second assumed until an upload has been measured
+default_link_speed = 1000000
+# smaller uploads are mostly request overhead rather than link speed
+link_speed_sample_size = 1024 * 1024
+
+
+def digest_chunks(chunks):
+    digest = hashlib.sha256()
+
+    for chunk in chunks:
+        digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def archive_key(
+        paths,
+        paths_root,
+        reproducible=False,
+        read_workers=8,
+        collector=None,
+        collapse_duplicates=False,
+):
+    # the uncompressed stream so the key does not depend on the codec
+    return digest_chunks(iter_tarball_chunks(
+        paths=paths,
+        paths_root=paths_root,
+        reproducible=reproducible,
+        read_workers=read_workers,
+        collector=collector,
+        collapse_duplicates=collapse_duplicates,
+    ))
+
+
+def url_available(url, session=requests):
+    try:
+        response = session.head(url, allow_redirects=True)
+    except requests.RequestException:
+        return False
+
+    return response.ok
+
+
+# seconds to connect and to wait between bytes of the response
+default_timeout = (10, 60)
+
+
+class _TimeoutAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        requests.adapters.HTTPAdapter.__init__(self, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        return requests.adapters.HTTPAdapter.send(self, request, **kwargs)
+
+
+class _HostAuth(requests.auth.AuthBase):
+    # the credentials are only for the build service and must not be sent
+    # along to the upload hosts sharing the session
+    def __init__(self, auth, url):
+        self.auth = auth
+        self.netloc = urlparse(url).netloc
+
+    def __call__(self, request):
+        if urlparse(request.url).netloc != self.netloc:
+            return request
+
+        return self.auth(request)
+
+
+def create_session(
+        username=None,
+        personal_access_token=None,
+        auth_url=None,
+        pool_size=10,
+        timeout=default_timeout,
+):
+    # one session for all requests so connections are kept alive and reused
+    # across polls, artifact downloads and uploads
+    session = requests.Session()
+    adapter = _TimeoutAdapter(
+        timeout=timeout,
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
     )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if personal_access_token is not None:
+        session.auth = _HostAuth(
+            auth=requests.auth.HTTPBasicAuth(username, personal_access_token),
+            url=auth_url,
+        )
+
+    return session
+
 
-    response.raise_for_status()
-    response_json = response.json()
+class UploadBackend:
+    name = None
+    # remembers the measured upload speed when set to a romp._cache.Cache
+    speeds = None
 
-    if not response_json['success']:
-        raise Exception('failed to upload archive')
+    def identity(self):
+        raise NotImplementedError()
 
-    logger.info('response_json: %s', json.dumps(response_json, indent=4))
+    def speed_key(self):
+        return digest_chunks([json.dumps(self.identity()).encode('utf-8')])
 
-    return response_json['link']
+    def link_speed(self):
+        # as measured by the last sizeable upload through this backend
+        if self.speeds is not None:
+            speed = self.speeds.get(self.speed_key())
+            if speed is not None:
+                return speed
+
+        return default_link_speed
+
+    def _upload(self, chunks, file_name, reusable, deadline):
+        raise NotImplementedError()
+
+    def available(self, url):
+        return url_available(url=url, session=self.session)
+
+    def upload(self, chunks, file_name, reusable=False, deadline=None):
+        # Giving up at the deadline is checked between chunks so a transfer
+        # that stalls can run past it by up to the HTTP read timeout.
+        if isinstance(chunks, bytes):
+            chunks = [chunks]
+
+        counter = [0]
+        start = time.perf_counter()
+
+        url = self._upload(
+            chunks=_iter_counted(
+                chunks=chunks,
+                counter=counter,
+                deadline=deadline,
+            ),
+            file_name=file_name,
+            reusable=reusable,
+            deadline=deadline,
+        )
+
+        elapsed = time.perf_counter() - start
+        speed = counter[0] / max(elapsed, 1e-6)
+        logger.info(
+            'uploaded %d bytes to %s in %.1f seconds (%.0f bytes/second)',
+            counter[0],
+            self.name,
+            elapsed,
+            speed,
+        )
+
+        if self.speeds is not None and counter[0] >= link_speed_sample_size:
+            self.speeds.put(key=self.speed_key(), value=speed)
+
+        return url
+
+
+class FileIoBackend(UploadBackend):
+    name = 'file.io'
+
+    def __init__(
+            self,
+            session,
+            url=default_upload_url,
+            expires=upload_expires,
+    ):
+        self.session = session
+        self.url = url
+        self.expires = expires
+
+    def identity(self):
+        return [self.name, self.url]
+
+    def _upload(self, chunks, file_name, reusable, deadline):
+        params = {'expires': self.expires}
+        if reusable:
+            params['autoDelete'] = 'false'
+
+        boundary = uuid.uuid4().hex
+
+        # streamed as a chunked request body so the archive is never held
+        # completely in memory
+        response = self.session.post(
+            url=self.url,
+            params=params,
+            headers={
+                'Content-Type': 'multipart/form-data; boundary=' + boundary,
+            },
+            data=iter_multipart_chunks(
+                chunks=chunks,
+                boundary=boundary,
+                field_name='file',
+                file_name=file_name,
+            ),
+        )
+
+        response.raise_for_status()
+        response_json = response.json()
+
+        if not response_json['success']:
+            raise Exception('failed to upload archive')
+
+        logger.info('response_json: %s', json.dumps(response_json, indent=4))
+
+        return response_json['link']
+
+
+def _retryable(exception):
+    if isinstance(exception, requests.HTTPError):
+        status = exception.response.status_code
+        return status >= 500 or status in {408, 429}
+
+    return isinstance(exception, requests.RequestException)
+
+
+def retry(function, retries, backoff):
+    for attempt in range(retries + 1):
+        try:
+            return function()
+        except Exception as e:
+            if attempt >= retries or not _retryable(e):
+                raise
+
+            delay = backoff * 2**attempt
+            logger.info('retrying in %.1f seconds after: %s', delay, e)
+            time.sleep(delay)
+
+
+class HttpPutBackend(UploadBackend):
+    # Any server accepting a PUT of a new path below the URL and serving it
+    # back by GET such as a bucket or WebDAV share close to the agents.  The
+    # archive is spooled to a temporary file first so it is put with a
+    # Content-Length rather than a chunked transfer encoding.
+    name = 'http-put'
+
+    def __init__(self, session, url):
+        self.session = session
+        self.url = url.rstrip('/')
+
+    def identity(self):
+        return [self.name, self.url]
+
+    def _upload(self, chunks, file_name, reusable, deadline):
+        url = '{}/{}/{}'.format(self.url, uuid.uuid4().hex, file_name)
+
+        with tempfile.TemporaryFile() as spooled:
+            for chunk in chunks:
+                spooled.write(chunk)
+
+            check_deadline(deadline)
+            spooled.seek(0)
+            response = self.session.put(url=url, data=spooled)
+            response.raise_for_status()
+
+        return url
+
+
+class RangedPutBackend(HttpPutBackend):
+    # Puts the archive in retried and resumable pieces.  This is a romp
+    # specific contract, not a standard protocol, and needs a server written
+    # or configured for it:
+    #
+    #   - every piece is a PUT to the same <url>/<sha256>/<file name> with a
+    #     Content-Range: bytes <first>-<last>/<size> header, or bytes */0
+    #     for an empty archive
+    #   - the server writes the body at that offset, pieces arrive in any
+    #     order, several at once and possibly more than once
+    #   - once every byte has been put the file is served back by GET
+    #
+    # Plain HTTP servers must reject a PUT with a Content-Range (RFC 7231
+    # section 4.3.4) so one that does not follow this fails the upload
+    # rather than storing a piece as the whole archive.  Completed pieces
+    # are recorded in the checkpoints so an interrupted upload of the same
+    # archive resumes where it stopped.
+    name = 'ranged-put'
+
+    def __init__(
+            self,
+            session,
+            url,
+            chunk_size=default_upload_chunk_size,
+            concurrency=4,
+            retries=3,
+            backoff=1,
+            checkpoints=None,
+    ):
+        HttpPutBackend.__init__(self, session=session, url=url)
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.checkpoints = checkpoints
+
+    def _upload(self, chunks, file_name, reusable, deadline):
+        with tempfile.TemporaryFile() as spooled:
+            digest = hashlib.sha256()
+            for chunk in chunks:
+                digest.update(chunk)
+                spooled.write(chunk)
+
+            return self._upload_chunked(
+                file=spooled,
+                size=spooled.tell(),
+                digest=digest.hexdigest(),
+                file_name=file_name,
+                deadline=deadline,
+            )
+
+    def _upload_chunked(self, file, size, digest, file_name, deadline=None):
+        # content addressed so a resumed upload targets the same URL
+        url = '{}/{}/{}'.format(self.url, digest, file_name)
+        checkpoint_key = digest_chunks([
+            json.dumps([url, size, self.chunk_size]).encode('utf-8'),
+        ])
+
+        completed = set()
+        if self.checkpoints is not None:
+            completed.update(self.checkpoints.get(checkpoint_key) or ())
+
+        count = max(1, -(-size // self.chunk_size))
+        remaining = [index for index in range(count) if index not in completed]
+        logger.info(
+            'uploading %d of %d chunks to %s',
+            len(remaining),
+            count,
+            url,
+        )
+
+        lock = threading.Lock()
+
+        def put(index):
+            start = index * self.chunk_size
+            with lock:
+                file.seek(start)
+                data = file.read(self.chunk_size)
+
+            if size == 0:
+                content_range = 'bytes */0'
+            else:
+                content_range = 'bytes {}-{}/{}'.format(
+                    start,
+                    start + len(data) - 1,
+                    size,
+                )
+
+            def attempt():
+                check_deadline(deadline)
+                response = self.session.put(
+                    url=url,
+                    data=data,
+                    headers={'Content-Range': content_range},
+                )
+                response.raise_for_status()
+
+            retry(function=attempt, retries=self.retries, backoff=self.backoff)
+
+            with lock:
+                completed.add(index)
+                if self.checkpoints is not None:
+                    self.checkpoints.put(
+                        key=checkpoint_key,
+                        value=sorted(completed),
+                        lifetime=upload_lifetime,
+                    )
+
+        pool = multiprocessing.pool.ThreadPool(processes=self.concurrency)
+        try:
+            for _ in pool.imap_unordered(put, remaining):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
+
+        if self.checkpoints is not None:
+            self.checkpoints.remove(checkpoint_key)
+
+        return url
+
+
+class LocalDirectoryBackend(UploadBackend):
+    # Stores uploads in a directory.  Give the URL it is served at, or
+    # accept the default file: URL for benchmarking and testing offline.
+    name = 'directory'
+
+    def __init__(self, directory, url=None):
+        self.directory = os.path.abspath(directory)
+
+        if url is None:
+            url = 'file:' + pathname2url(self.directory)
+
+        self.url = url.rstrip('/')
+
+    def identity(self):
+        return [self.name, self.directory, self.url]
+
+    def path_from_url(self, url):
+        prefix = self.url + '/'
+        if not url.startswith(prefix):
+            return None
+
+        return os.path.join(self.directory, url[len(prefix):])
+
+    def available(self, url):
+        path = self.path_from_url(url=url)
+
+        return path is not None and os.path.isfile(path)
+
+    def _upload(self, chunks, file_name, reusable, deadline):
+        name = '{}-{}'.format(uuid.uuid4().hex, file_name)
+        path = os.path.join(self.directory, name)
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+        os.rename(temporary_path, path)
+
+        return '{}/{}'.format(self.url, name)
+
+
+upload_backends = collections.OrderedDict(
+    (backend.name, backend)
+    for backend in (
+        FileIoBackend,
+        HttpPutBackend,
+        RangedPutBackend,
+        LocalDirectoryBackend,
+    )
+)
+
+
+def create_upload_backend(
+        name,
+        session,
+        url=None,
+        directory=None,
+        chunk_size=default_upload_chunk_size,
+        concurrency=4,
+        checkpoints=None,
+        speeds=None,
+):
+    if name == FileIoBackend.name:
+        if url is None:
+            url = default_upload_url
+
+        backend = FileIoBackend(session=session, url=url)
+    elif name == HttpPutBackend.name:
+        if url is None:
+            raise Exception('an upload URL is required for ' + name)
+
+        backend = HttpPutBackend(session=session, url=url)
+    elif name == RangedPutBackend.name:
+        if url is None:
+            raise Exception('an upload URL is required for ' + name)
+
+        backend = RangedPutBackend(
+            session=session,
+            url=url,
+            chunk_size=chunk_size,
+            concurrency=concurrency,
+            checkpoints=checkpoints,
+        )
+    elif name == LocalDirectoryBackend.name:
+        if directory is None:
+            raise Exception('an upload directory is required for ' + name)
+
+        backend = LocalDirectoryBackend(directory=directory, url=url)
+    else:
+        raise Exception('unknown upload backend: ' + name)
+
+    backend.speeds = speeds
+
+    return backend
+
+
+def upload_archive(create_upload, key, cache, backend, deadline=None):
+    if cache is not None:
+        # the same archive uploaded elsewhere is a different entry
+        key = digest_chunks([
+            json.dumps([backend.identity(), key]).encode('utf-8'),
+        ])
+        archive_url = cache.get(key)
+
+        if archive_url is not None:
+            if backend.available(archive_url):
+                logger.info('reusing upload for %s: %s', key, archive_url)
+                return archive_url, True
+
+            logger.info('cached upload no longer available: %s', archive_url)
+            cache.remove(key)
+
+    file_name, chunks = create_upload()
+    archive_url = backend.upload(
+        chunks=chunks,
+        file_name=file_name,
+        reusable=cache is not None,
+        deadline=deadline,
+    )
+
+    if cache is not None:
+        cache.put(
+            key=key,
+            value=archive_url,
+            lifetime=upload_lifetime - upload_cache_margin,
+        )
+
+    return archive_url, False
+
+
+def select_compression(
+        compression,
+        compression_level,
+        paths,
+        link_speed,
+        collector=None,
+        backend=None,
+):
+    if compression != 'auto':
+        return compression, compression_level
+
+    if link_speed is None:
+        if backend is None:
+            link_speed = default_link_speed
+        else:
+            link_speed = backend.link_speed()
+        logger.info('upload speed: %.0f bytes/second', link_speed)
+
+    compression, compression_level = choose_compression(
+        paths=paths,
+        link_speed=link_speed,
+        collector=collector,
+    )
+    logger.info(
+        'selected archive compression: %s %s',
+        compression,
+        compression_level,
+    )
+
+    return compression, compression_level
+
+
+def upload_paths(
+        paths,
+        paths_root,
+        cache,
+        compression='gzip',
+        compression_level=None,
+        link_speed=None,
+        reproducible=False,
+        read_workers=8,
+        collector=None,
+        collapse_duplicates=False,
+        backend=None,
+        deadline=None,
+):
+    key = None
+    if cache is not None:
+        # the compression is not part of the key since the remote side
+        # detects it while extracting
+        key = archive_key(
+            paths=paths,
+            paths_root=paths_root,
+            reproducible=reproducible,
+            read_workers=read_workers,
+            collector=collector,
+            collapse_duplicates=collapse_duplicates,
+        )
+        logger.info('archive key: %s', key)
+
+    def create_upload():
+        selected_compression, selected_level = select_compression(
+            compression=compression,
+            compression_level=compression_level,
+            paths=paths,
+            link_speed=link_speed,
+            collector=collector,
+            backend=backend,
+        )
+
+        chunks = iter_tarball_chunks(
+            paths=paths,
+            paths_root=paths_root,
+            compression=selected_compression,
+            compression_level=selected_level,
+            reproducible=reproducible,
+            read_workers=read_workers,
+            collector=collector,
+            collapse_duplicates=collapse_duplicates,
+        )
+        file_name = 'archive' + codecs[selected_compression].extension
+
+        return file_name, chunks
+
+    return upload_archive(
+        create_upload=create_upload,
+        key=key,
+        cache=cache,
+        backend=backend,
+        deadline=deadline,
+    )
+
+
+def upload_git_tree(
+        ref,
+        directory,
+        cache,
+        compression='gzip',
+        compression_level=None,
+        link_speed=None,
+        backend=None,
+        deadline=None,
+):
+    # the tree hash identifies the content so a repeat run on the same tree
+    # neither builds nor uploads the archive
+    tree = git_tree_hash(ref=ref, directory=directory)
+    logger.info('git tree for %s: %s', ref, tree)
+    key = 'git-tree:' + tree
+
+    def create_upload():
+        # the working tree approximates the tracked files for sampling
+        selected_compression, selected_level = select_compression(
+            compression=compression,
+            compression_level=compression_level,
+            paths=[directory],
+            link_speed=link_speed,
+            collector=romp._collect.Collector(root=directory),
+            backend=backend,
+        )
+
+        chunks = iter_git_tarball_chunks(
+            ref=ref,
+            directory=directory,
+            compression=selected_compression,
+            compression_level=selected_level,
+        )
+        file_name = 'archive' + codecs[selected_compression].extension
+
+        return file_name, chunks
+
+    return upload_archive(
+        create_upload=create_upload,
+        key=key,
+        cache=cache,
+        backend=backend,
+        deadline=deadline,
+    )
 
 
 def request_remote_lock_build(
-        archive_url,
-        username,
-        personal_access_token,
+        archive_urls,
+        session,
         build_request_url,
         command,
         environments,
         source_branch,
         definition_id,
         artifact_paths,
+        artifact_mode='coalesced',
+        artifact_compression='gzip',
+        artifact_compression_level=None,
+        artifact_deduplicate=False,
+        artifact_namespace=False,
 ):
     parameters = {
         'ROMP_COMMAND': command,
         'ROMP_ENVIRONMENTS': environments,
         'ROMP_ARTIFACT_PATHS': ' '.join(path for path in artifact_paths),
+        'ROMP_ARTIFACT_MODE': artifact_mode,
+        'ROMP_ARTIFACT_COMPRESSION': artifact_compression,
+        'ROMP_ARTIFACT_DEDUPLICATE': 'true' if artifact_deduplicate else '',
+        'ROMP_ARTIFACT_NAMESPACE': 'true' if artifact_namespace else '',
     }
 
-    if archive_url is not None:
-        parameters['ROMP_ARCHIVE_URL'] = archive_url
+    if artifact_compression_level is not None:
+        parameters['ROMP_ARTIFACT_COMPRESSION_LEVEL'] = str(
+            artifact_compression_level,
+        )
 
-    response = requests.post(
+    # layers are extracted in order so later ones take precedence
+    if len(archive_urls) > 0:
+        parameters['ROMP_ARCHIVE_URL'] = ' '.join(archive_urls)
+
+    response = session.post(
         url=build_request_url,
-        auth=requests.auth.HTTPBasicAuth(
-            username,
-            personal_access_token,
-        ),
         json={
             "definition": {"id": definition_id},
             "sourceBranch": source_branch,
@@ -202,4 +2167,7 @@ def request_remote_lock_build(
     for parameters in to_be_logged:
         logger.info(*parameters)
 
-    return Build.from_response_json(response_json=response_json)
+    return Build.from_response_json(
+        response_json=response_json,
+        session=session,
+    )
@@ -0,0 +1,254 @@
+import logging
+import os
+import os.path
+import shutil
+import tarfile
+import threading
+
+import romp._core
+
+
+logger = logging.getLogger(__name__)
+
+
+layouts = ('flat', 'environment')
+
+
+class Extractor:
+    # Writes the members of artifact tarballs below the directory as they are
+    # read from the stream.  Members that would land outside of their root
+    # through absolute paths, .. or links are refused.  The environment
+    # layout gives each environment its own
+    # <platform>-<interpreter>-<version>-<arch> directory.  When skipping
+    # unchanged files those with the same size and content are left alone,
+    # mtime included, and only the changed ones are written and reported.
+    def __init__(self, directory, layout='flat', skip_unchanged=False):
+        if layout not in layouts:
+            raise Exception('unknown artifact layout: {}'.format(layout))
+
+        self.directory = os.path.abspath(directory)
+        self.layout = layout
+        self.skip_unchanged = skip_unchanged
+        self.written = {}
+        self.changed = []
+        self.unchanged = []
+        # environments sharing the flat layout are not allowed to interleave
+        # their writes to the same files
+        self.lock = threading.Lock()
+
+    def root(self, environment):
+        if self.layout == 'flat':
+            return self.directory
+
+        if environment is None:
+            raise Exception(
+                'the environment layout needs to know the environment of'
+                ' each artifact archive',
+            )
+
+        return self.target(root=self.directory, name=environment)
+
+    def target(self, root, name):
+        # the path within root for an archive member name
+        parts = [
+            part
+            for part in name.replace('\\', '/').split('/')
+            if part not in ('', '.')
+        ]
+
+        if (
+                name.startswith(('/', '\\'))
+                or len(parts) == 0
+                or any(part == '..' for part in parts)
+                or any(os.path.splitdrive(part)[0] != '' for part in parts)
+        ):
+            raise Exception('unsafe artifact path: {!r}'.format(name))
+
+        path = os.path.join(root, *parts)
+
+        # an existing link in the tree must not lead the write elsewhere
+        parent = os.path.realpath(os.path.dirname(path))
+        if not _within(path=parent, directory=os.path.realpath(root)):
+            raise Exception('unsafe artifact path: {!r}'.format(name))
+
+        return path
+
+    def extract_tarball(self, fileobj, environment=None):
+        # returns the paths written
+        root = self.root(environment=environment)
+        _makedirs(root)
+
+        if self.layout == 'flat':
+            with self.lock:
+                return self._extract_tarball(
+                    fileobj=fileobj,
+                    root=root,
+                    environment=environment,
+                )
+
+        return self._extract_tarball(
+            fileobj=fileobj,
+            root=root,
+            environment=environment,
+        )
+
+    def extract_path(self, path, environment=None):
+        with open(path, 'rb') as f:
+            return self.extract_tarball(fileobj=f, environment=environment)
+
+    def _extract_tarball(self, fileobj, root, environment):
+        # returns the paths written, unchanged files are not included
+        paths = []
+
+        # streaming mode so the members are written as the gzip is decoded
+        with tarfile.open(fileobj=fileobj, mode='r|gz') as archive:
+            for member in archive:
+                extracted = self._extract_member(
+                    archive=archive,
+                    member=member,
+                    root=root,
+                )
+                if extracted is None:
+                    continue
+
+                path, changed = extracted
+
+                previous = self.written.get(path, environment)
+                if previous != environment:
+                    logger.warning(
+                        '%s from %s replaced the one from %s',
+                        path,
+                        environment,
+                        previous,
+                    )
+                self.written[path] = environment
+
+                if changed:
+                    self.changed.append(path)
+                    paths.append(path)
+                else:
+                    self.unchanged.append(path)
+
+        return paths
+
+    def _extract_member(self, archive, member, root):
+        # returns the path and whether it changed or None when skipped
+        path = self.target(root=root, name=member.name)
+
+        if member.isdir():
+            _makedirs(path)
+            return None
+
+        _makedirs(os.path.dirname(path))
+
+        if member.issym():
+            linked = os.path.join(os.path.dirname(path), member.linkname)
+            if (
+                    os.path.isabs(member.linkname)
+                    or not _within(path=linked, directory=root)
+            ):
+                raise Exception('unsafe artifact link: {!r} -> {!r}'.format(
+                    member.name,
+                    member.linkname,
+                ))
+
+            if (
+                    self.skip_unchanged
+                    and os.path.islink(path)
+                    and os.readlink(path) == member.linkname
+            ):
+                return path, False
+
+            _remove(path)
+            os.symlink(member.linkname, path)
+            return path, True
+
+        if member.islnk():
+            # copied rather than linked so the files stay independent
+            source_path = self.target(root=root, name=member.linkname)
+            with open(source_path, 'rb') as source:
+                changed = self._write(
+                    path=path,
+                    source=source,
+                    size=os.path.getsize(source_path),
+                )
+        elif member.isreg():
+            changed = self._write(
+                path=path,
+                source=archive.extractfile(member),
+                size=member.size,
+            )
+        else:
+            logger.warning('skipping special artifact member: %s', member.name)
+            return None
+
+        mode = member.mode & 0o755
+        if not changed:
+            # a mode change alone leaves the mtime be
+            if os.stat(path).st_mode & 0o7777 != mode:
+                os.chmod(path, mode)
+            return path, False
+
+        os.chmod(path, mode)
+        os.utime(path, (member.mtime, member.mtime))
+
+        return path, True
+
+    def _write(self, path, source, size):
+        # returns whether the file had to be written
+        chunk_size = romp._core.default_chunk_size
+
+        if (
+                self.skip_unchanged
+                and not os.path.islink(path)
+                and os.path.isfile(path)
+                and os.path.getsize(path) == size
+                # writing in place would change the other links as well
+                and os.stat(path).st_nlink == 1
+        ):
+            # compared chunk by chunk as the member streams in so nothing is
+            # buffered and an identical file is never opened for writing
+            with open(path, 'rb') as existing:
+                matched = 0
+                while True:
+                    chunk = source.read(chunk_size)
+                    if len(chunk) == 0:
+                        return False
+
+                    if existing.read(len(chunk)) != chunk:
+                        break
+
+                    matched += len(chunk)
+
+            # the sizes match so the rest overwrites the differing tail
+            with open(path, 'r+b') as f:
+                f.seek(matched)
+                f.write(chunk)
+                shutil.copyfileobj(source, f, chunk_size)
+                f.truncate()
+
+            return True
+
+        _remove(path)
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(source, f, chunk_size)
+
+        return True
+
+
+def _within(path, directory):
+    path = os.path.normpath(path)
+    directory = os.path.normpath(directory)
+
+    return path == directory or path.startswith(os.path.join(directory, ''))
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def _remove(path):
+    # a link left in place would have the write follow it
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
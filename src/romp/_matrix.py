@@ -107,6 +107,12 @@ class Environment:
 
     def to_matrix_entry(self):
         entry_uuid = str(uuid.uuid4())
+        environment = '-'.join((
+            self.platform,
+            self.interpreter,
+            self.version,
+            self.architecture,
+        ))
 
         return (
             '{platform} {interpreter} {version} {architecture}'.format(
@@ -129,7 +135,14 @@ class Environment:
                 'extracter': extracters[self.platform],
                 'TOXENV': self.tox_env(),
                 'uuid': entry_uuid,
-                'artifacts_archive': 'artifacts.{}.tar.gz'.format(entry_uuid),
+                # the client lays out extracted artifacts by environment
+                'artifacts_archive': 'artifacts.{}.{}.tar.gz'.format(
+                    environment,
+                    entry_uuid,
+                ),
+                # names the per job artifact, the client matches it to the
+                # job through the timeline
+                'environment': environment,
             },
         )
 
@@ -233,14 +246,18 @@ def main():
     )
     parser.set_defaults(func=parser.print_help)
 
+    # romp itself needs Python 3 though it still runs builds on 2.7
     test_environments = [
         environment
         for environment in build_all_environments()
         if not (
-            environment.platform == 'Windows'
-            and environment.interpreter == 'CPython'
-            and environment.version != '3.7'
-            and environment.architecture == 'x86'
+            (
+                environment.platform == 'Windows'
+                and environment.interpreter == 'CPython'
+                and environment.version != '3.7'
+                and environment.architecture == 'x86'
+            )
+            or environment.version == '2.7'
         )
     ]
 
@@ -1,17 +1,22 @@
-import collections
+import asyncio
 import functools
 import getpass
-import glob
-import io
 import itertools
 import json
 import logging
+import os.path
 import sys
+import time
 
 import click
 import click.types
 
+import romp._async
+import romp._cache
+import romp._coalesce
+import romp._collect
 import romp._core
+import romp._extract
 import romp._matrix
 import romp._version
 
@@ -175,7 +180,24 @@ def create_check_period_option(
         '--check-period',
         default=15,
         envvar=envvar,
-        help='The period used to poll the build for completion',
+        help=(
+            'The period used to poll the build for completion when the'
+            ' duration of the previous matching build is not known.  With a'
+            ' known duration polls are more frequent while the build is'
+            ' queued, back off further mid build and are at least this'
+            ' frequent, and then faster, near the expected finish.'
+        ),
+    )
+
+
+def create_minimum_check_period_option(
+        envvar='ROMP_MINIMUM_CHECK_PERIOD',
+):
+    return create_option(
+        '--minimum-check-period',
+        default=2,
+        envvar=envvar,
+        help='The shortest period used to poll the build for completion',
     )
 
 
@@ -244,6 +266,140 @@ def create_artifact_paths_option(
     )
 
 
+artifact_mode_choice = Choice(
+    choices=romp._core.artifact_modes,
+    case_sensitive=False,
+)
+
+
+def create_artifact_mode_option(
+        envvar='ROMP_ARTIFACT_MODE',
+):
+    return create_option(
+        '--artifact-mode',
+        default='coalesced',
+        envvar=envvar,
+        help=(
+            'coalesced waits for a final job to combine the artifacts of all'
+            ' environments.  per-job downloads each environment\'s artifact as'
+            ' soon as its job finishes and combines them locally.'
+        ),
+        type=artifact_mode_choice,
+    )
+
+
+artifact_compression_choice = Choice(
+    choices=romp._coalesce.compressions,
+    case_sensitive=False,
+)
+
+
+def create_artifact_compression_option(
+        envvar='ROMP_ARTIFACT_COMPRESSION',
+):
+    return create_option(
+        '--artifact-compression',
+        default='gzip',
+        envvar=envvar,
+        help=(
+            'Compression for the coalesced artifact.  zstd compresses on'
+            ' multiple threads.'
+        ),
+        type=artifact_compression_choice,
+    )
+
+
+def create_artifact_compression_level_option(
+        envvar='ROMP_ARTIFACT_COMPRESSION_LEVEL',
+):
+    return create_option(
+        '--artifact-compression-level',
+        envvar=envvar,
+        help='Level for the artifact compression, the codec default if unset',
+        type=int,
+    )
+
+
+def create_artifact_deduplicate_option(
+        envvar='ROMP_ARTIFACT_DEDUPLICATE',
+):
+    return create_option(
+        '--artifact-deduplicate/--no-artifact-deduplicate',
+        default=False,
+        envvar=envvar,
+        help=(
+            'Store content repeated across the coalesced artifact once with'
+            ' the other copies as hard links to it'
+        ),
+    )
+
+
+def create_artifact_namespace_option(
+        envvar='ROMP_ARTIFACT_NAMESPACE',
+):
+    return create_option(
+        '--artifact-namespace/--no-artifact-namespace',
+        default=False,
+        envvar=envvar,
+        help=(
+            'Put each environment\'s files below its own directory in the'
+            ' coalesced artifact with a manifest of them all at the front'
+        ),
+    )
+
+
+def create_artifact_directory_option(
+        envvar='ROMP_ARTIFACT_DIRECTORY',
+):
+    return create_option(
+        '--artifact-dir',
+        'artifact_directory',
+        envvar=envvar,
+        help=(
+            'The directory to extract the resulting artifacts into as they'
+            ' are downloaded'
+        ),
+        type=click.Path(file_okay=False),
+    )
+
+
+artifact_layout_choice = Choice(
+    choices=romp._extract.layouts,
+    case_sensitive=False,
+)
+
+
+def create_artifact_layout_option(
+        envvar='ROMP_ARTIFACT_LAYOUT',
+):
+    return create_option(
+        '--artifact-layout',
+        default='flat',
+        envvar=envvar,
+        help=(
+            'flat extracts the artifacts of all environments into the'
+            ' artifact directory.  environment extracts each into its own'
+            ' <platform>-<interpreter>-<version>-<arch> subdirectory.'
+        ),
+        type=artifact_layout_choice,
+    )
+
+
+def create_artifact_skip_unchanged_option(
+        envvar='ROMP_ARTIFACT_SKIP_UNCHANGED',
+):
+    return create_option(
+        '--artifact-skip-unchanged/--no-artifact-skip-unchanged',
+        default=False,
+        envvar=envvar,
+        help=(
+            'Leave files in the artifact directory alone, mtime included,'
+            ' when their size and content are unchanged and report the files'
+            ' that did change'
+        ),
+    )
+
+
 platforms_choice = Choice(
     choices=romp._matrix.all_platforms,
     case_sensitive=False,
@@ -408,6 +564,317 @@ def create_archive_paths_option(
     )
 
 
+compression_choice = Choice(
+    choices=tuple(romp._core.codecs.keys()) + ('auto',),
+    case_sensitive=False,
+)
+
+
+def create_archive_base_paths_option(
+        envvar='ROMP_ARCHIVE_BASE_PATHS',
+):
+    return create_option(
+        '--archive-base-path',
+        'archive_base_paths',
+        envvar=envvar,
+        help=(
+            'Rarely changing files such as dependencies to upload as a'
+            ' separate base layer.  It is extracted before the archive paths'
+            ' and only uploaded again when its content changes.'
+        ),
+        multiple=True,
+    )
+
+
+def create_archive_git_ref_option(
+        envvar='ROMP_ARCHIVE_GIT_REF',
+):
+    return create_option(
+        '--archive-git-ref',
+        envvar=envvar,
+        help=(
+            'Archive the files tracked by git at this ref, such as HEAD, from'
+            ' the archive paths root.  It is extracted after the base layer'
+            ' and before the archive paths and only uploaded again when the'
+            ' tree changes.'
+        ),
+    )
+
+
+def create_upload_backend_option(
+        envvar='ROMP_UPLOAD_BACKEND',
+):
+    return create_option(
+        '--upload-backend',
+        default=romp._core.FileIoBackend.name,
+        envvar=envvar,
+        help=(
+            'Where to upload archives.  file.io posts to a file.io'
+            ' compatible service, http-put puts below the upload URL,'
+            ' ranged-put puts there in pieces to a server implementing'
+            ' romp\'s Content-Range contract and directory stores in the'
+            ' upload directory.'
+        ),
+        type=Choice(choices=tuple(romp._core.upload_backends.keys())),
+    )
+
+
+def create_upload_url_option(
+        envvar='ROMP_UPLOAD_URL',
+):
+    return create_option(
+        '--upload-url',
+        envvar=envvar,
+        help=(
+            'The URL of the upload service, {} for file.io.  For the'
+            ' directory backend the URL it is served at.'.format(
+                romp._core.default_upload_url,
+            )
+        ),
+    )
+
+
+def create_upload_directory_option(
+        envvar='ROMP_UPLOAD_DIRECTORY',
+):
+    return create_option(
+        '--upload-directory',
+        envvar=envvar,
+        help='The directory used by the directory upload backend',
+        type=click.Path(file_okay=False),
+    )
+
+
+def create_upload_chunk_size_option(
+        envvar='ROMP_UPLOAD_CHUNK_SIZE',
+):
+    return create_option(
+        '--upload-chunk-size',
+        default=romp._core.default_upload_chunk_size,
+        envvar=envvar,
+        help=(
+            'The size in bytes of the retried and resumable pieces put by'
+            ' the ranged-put backend'
+        ),
+        type=click.IntRange(min=1),
+    )
+
+
+def create_upload_concurrency_option(
+        envvar='ROMP_UPLOAD_CONCURRENCY',
+):
+    return create_option(
+        '--upload-concurrency',
+        default=4,
+        envvar=envvar,
+        help='Pieces uploaded at once by the ranged-put backend',
+        type=click.IntRange(min=1),
+    )
+
+
+def create_http_pool_size_option(
+        envvar='ROMP_HTTP_POOL_SIZE',
+):
+    return create_option(
+        '--http-pool-size',
+        default=10,
+        envvar=envvar,
+        help=(
+            'Connections kept alive per host for reuse by the build requests,'
+            ' polls, downloads and uploads.  At least the upload concurrency'
+            ' is used.'
+        ),
+        type=click.IntRange(min=1),
+    )
+
+
+def create_http_timeout_option(
+        envvar='ROMP_HTTP_TIMEOUT',
+):
+    return create_option(
+        '--http-timeout',
+        default=60,
+        envvar=envvar,
+        help=(
+            'Seconds to wait for a connection or between bytes of a response'
+            ' before failing a request'
+        ),
+        type=click.IntRange(min=1),
+    )
+
+
+def create_archive_compression_option(
+        envvar='ROMP_ARCHIVE_COMPRESSION',
+):
+    return create_option(
+        '--archive-compression',
+        default='gzip',
+        envvar=envvar,
+        help=(
+            'Compression for the archive built from the archive paths.'
+            '  auto picks the codec with the lowest estimated compression'
+            ' and upload time for the upload speed from those every build'
+            ' agent can extract, none, gzip and bz2.'
+        ),
+        type=compression_choice,
+    )
+
+
+def create_archive_compression_level_option(
+        envvar='ROMP_ARCHIVE_COMPRESSION_LEVEL',
+):
+    return create_option(
+        '--archive-compression-level',
+        envvar=envvar,
+        help='Level for the archive compression, the codec default if unset',
+        type=int,
+    )
+
+
+def create_upload_speed_option(
+        envvar='ROMP_UPLOAD_SPEED',
+):
+    return create_option(
+        '--upload-speed',
+        envvar=envvar,
+        help=(
+            'Upload speed in bytes per second used to select the auto'
+            ' archive compression.  Defaults to the speed measured by the'
+            ' last upload through the same backend, {} before there is'
+            ' one.'.format(romp._core.default_link_speed)
+        ),
+        type=float,
+    )
+
+
+def create_reproducible_archive_option(
+        envvar='ROMP_REPRODUCIBLE_ARCHIVE',
+):
+    return create_option(
+        '--reproducible-archive/--no-reproducible-archive',
+        default=False,
+        envvar=envvar,
+        help=(
+            'Build the archive with sorted members and normalized metadata'
+            ' so identical files give an identical archive.  File times are'
+            ' set to $SOURCE_DATE_EPOCH, or zero if unset.'
+        ),
+    )
+
+
+def create_archive_read_workers_option(
+        envvar='ROMP_ARCHIVE_READ_WORKERS',
+):
+    return create_option(
+        '--archive-read-workers',
+        default=8,
+        envvar=envvar,
+        help=(
+            'Threads reading small files ahead of the archive writer.'
+            '  1 reads serially.'
+        ),
+        type=click.IntRange(min=1),
+    )
+
+
+def create_archive_ignore_option(
+        envvar='ROMP_ARCHIVE_IGNORE',
+):
+    return create_option(
+        '--archive-ignore/--no-archive-ignore',
+        default=True,
+        envvar=envvar,
+        help=(
+            'Leave out paths matched by .gitignore and .rompignore files'
+            ' and VCS, tox and Python cache directories.  Archive paths'
+            ' may use ** to match any number of directories.'
+        ),
+    )
+
+
+def create_archive_collapse_duplicates_option(
+        envvar='ROMP_ARCHIVE_COLLAPSE_DUPLICATES',
+):
+    return create_option(
+        '--archive-collapse-duplicates/--no-archive-collapse-duplicates',
+        default=False,
+        envvar=envvar,
+        help=(
+            'Store files with identical content once and the rest as hard'
+            ' links to it'
+        ),
+    )
+
+
+def create_progress_option(
+        envvar='ROMP_PROGRESS',
+):
+    return create_option(
+        '--progress/--no-progress',
+        default=False,
+        envvar=envvar,
+        help=(
+            'Report each environment as its job starts and finishes rather'
+            ' than only the build as a whole'
+        ),
+    )
+
+
+def create_fail_fast_option(
+        envvar='ROMP_FAIL_FAST',
+):
+    return create_option(
+        '--fail-fast/--no-fail-fast',
+        default=False,
+        envvar=envvar,
+        help=(
+            'Cancel the build as soon as any environment fails and collect'
+            ' the artifacts of the environments that already finished'
+        ),
+    )
+
+
+def create_timeout_option(
+        envvar='ROMP_TIMEOUT',
+):
+    return create_option(
+        '--timeout',
+        envvar=envvar,
+        help=(
+            'Seconds after which to give up, including the upload, and'
+            ' cancel the build.  An upload that has stalled is given up on'
+            ' within the HTTP timeout.'
+        ),
+        type=click.IntRange(min=1),
+    )
+
+
+def create_upload_cache_option(
+        envvar='ROMP_UPLOAD_CACHE',
+):
+    return create_option(
+        '--upload-cache/--no-upload-cache',
+        default=True,
+        envvar=envvar,
+        help=(
+            'Reuse the previous upload of an identical archive while it'
+            ' is still available'
+        ),
+    )
+
+
+def create_cache_directory_option(
+        envvar='ROMP_CACHE_DIRECTORY',
+):
+    return create_option(
+        '--cache-directory',
+        default=romp._cache.default_directory(),
+        envvar=envvar,
+        help='Directory for local state such as the upload cache',
+        type=click.Path(file_okay=False),
+    )
+
+
 def create_verbose_option(
         envvar='ROMP_VERBOSITY',
 ):
@@ -423,6 +890,26 @@ def create_verbose_option(
     )
 
 
+def create_job_progress_reporter(total):
+    finished = []
+
+    def report(event):
+        if event.kind == 'started':
+            click.echo('Started {}'.format(event.environment))
+            return
+
+        finished.append(event)
+        click.echo('Finished {} {} in {:.0f} seconds ({}/{})'.format(
+            event.environment,
+            event.result,
+            event.duration or 0,
+            len(finished),
+            total,
+        ))
+
+    return report
+
+
 verbosity_levels = [
     (2, logging.DEBUG),
     (1, logging.INFO),
@@ -436,18 +923,27 @@ def logging_level_from_verbosity(verbosity):
             return logging_level
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @create_personal_access_token_option()
 @create_build_request_url_option()
 @create_command_option()
 @create_username_option()
 @create_environments_option()
 @create_check_period_option()
+@create_minimum_check_period_option()
 @create_source_branch_option()
 @create_definition_id_option()
 @create_archive_option()
 @create_artifact_option()
 @create_artifact_paths_option()
+@create_artifact_mode_option()
+@create_artifact_compression_option()
+@create_artifact_compression_level_option()
+@create_artifact_deduplicate_option()
+@create_artifact_namespace_option()
+@create_artifact_directory_option()
+@create_artifact_layout_option()
+@create_artifact_skip_unchanged_option()
 @create_matrix_platforms_option()
 @create_matrix_interpreters_option()
 @create_matrix_versions_option()
@@ -456,19 +952,51 @@ def logging_level_from_verbosity(verbosity):
 @create_matrix_exclude_option()
 @create_archive_paths_root_option()
 @create_archive_paths_option()
+@create_archive_base_paths_option()
+@create_archive_git_ref_option()
+@create_upload_backend_option()
+@create_upload_url_option()
+@create_upload_directory_option()
+@create_upload_chunk_size_option()
+@create_upload_concurrency_option()
+@create_http_pool_size_option()
+@create_http_timeout_option()
+@create_archive_compression_option()
+@create_archive_compression_level_option()
+@create_upload_speed_option()
+@create_reproducible_archive_option()
+@create_archive_read_workers_option()
+@create_archive_ignore_option()
+@create_archive_collapse_duplicates_option()
+@create_progress_option()
+@create_fail_fast_option()
+@create_timeout_option()
+@create_upload_cache_option()
+@create_cache_directory_option()
 @create_verbose_option()
+@click.pass_context
 def main(
+        context,
         personal_access_token,
         build_request_url,
         command,
         username,
         environments,
         check_period,
+        minimum_check_period,
         source_branch,
         definition_id,
         archive_file,
         artifact,
         artifact_paths,
+        artifact_mode,
+        artifact_compression,
+        artifact_compression_level,
+        artifact_deduplicate,
+        artifact_namespace,
+        artifact_directory,
+        artifact_layout,
+        artifact_skip_unchanged,
         matrix_platforms,
         matrix_interpreters,
         matrix_versions,
@@ -477,16 +1005,58 @@ def main(
         matrix_excludes,
         archive_paths_root,
         archive_paths,
+        archive_base_paths,
+        archive_git_ref,
+        upload_backend,
+        upload_url,
+        upload_directory,
+        upload_chunk_size,
+        upload_concurrency,
+        http_pool_size,
+        http_timeout,
+        archive_compression,
+        archive_compression_level,
+        upload_speed,
+        reproducible_archive,
+        archive_read_workers,
+        archive_ignore,
+        archive_collapse_duplicates,
+        progress,
+        fail_fast,
+        timeout,
+        upload_cache,
+        cache_directory,
         verbosity,
 ):
     root_logger = logging.getLogger()
     root_logger.setLevel(logging_level_from_verbosity(verbosity))
     root_logger.addHandler(logging.StreamHandler())
 
+    if context.invoked_subcommand is not None:
+        # subcommands use the options given here
+        return
+
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    if archive_ignore:
+        collector = romp._collect.Collector(root=archive_paths_root or '.')
+    else:
+        collector = romp._collect.Collector(
+            root=archive_paths_root or '.',
+            patterns=(),
+            use_ignore_files=False,
+        )
+
     archive_paths = list(itertools.chain.from_iterable(
-        glob.glob(path)
+        collector.glob(path)
         for path in archive_paths
     ))
+    archive_base_paths = list(itertools.chain.from_iterable(
+        collector.glob(path)
+        for path in archive_base_paths
+    ))
 
     matrix_specified = any(
         len(dimension) > 0
@@ -543,47 +1113,285 @@ def main(
 
     environments_string = romp._matrix.string_from_environments(environments)
 
-    archive_url = None
-    archive_bytes = None
-    if archive_file is not None:
-        archive_bytes = archive_file.read()
-    elif len(archive_paths) > 0:
-        click.echo('Archiving paths for upload')
-        archive_bytesio = io.BytesIO()
-        romp._core.write_tarball_bytes(
-            file=archive_bytesio,
-            paths=archive_paths,
-            paths_root=archive_paths_root,
+    if upload_cache:
+        upload_cache = romp._cache.Cache(
+            directory=os.path.join(cache_directory, 'uploads'),
         )
-        archive_bytes = archive_bytesio.getvalue()
-
-    if archive_bytes is not None:
-        click.echo('Uploading archive')
-        archive_url = romp._core.post_file(data=archive_bytes)
-        click.echo('Archive URL: {}'.format(archive_url))
+    else:
+        upload_cache = None
 
-    click.echo('Requesting build')
-    build = romp._core.request_remote_lock_build(
-        archive_url=archive_url,
+    session = romp._core.create_session(
         username=username,
         personal_access_token=personal_access_token,
-        build_request_url=build_request_url,
-        command=command,
-        environments=environments_string,
-        source_branch=source_branch,
-        definition_id=definition_id,
-        artifact_paths=artifact_paths,
+        auth_url=build_request_url,
+        pool_size=max(http_pool_size, upload_concurrency),
+        timeout=http_timeout,
+    )
+
+    upload_backend = romp._core.create_upload_backend(
+        name=upload_backend,
+        session=session,
+        url=upload_url,
+        directory=upload_directory,
+        chunk_size=upload_chunk_size,
+        concurrency=upload_concurrency,
+        checkpoints=romp._cache.Cache(
+            directory=os.path.join(cache_directory, 'upload-checkpoints'),
+        ),
+        speeds=romp._cache.Cache(
+            directory=os.path.join(cache_directory, 'upload-speeds'),
+        ),
+    )
+
+    archive_urls = []
+
+    try:
+        if len(archive_base_paths) > 0:
+            click.echo('Uploading archive base layer')
+            # always reproducible so unchanged files give an unchanged key
+            archive_url, reused = romp._core.upload_paths(
+                paths=archive_base_paths,
+                paths_root=archive_paths_root,
+                cache=upload_cache,
+                compression=archive_compression,
+                compression_level=archive_compression_level,
+                link_speed=upload_speed,
+                reproducible=True,
+                read_workers=archive_read_workers,
+                collector=collector,
+                collapse_duplicates=archive_collapse_duplicates,
+                backend=upload_backend,
+                deadline=deadline,
+            )
+            if reused:
+                click.echo('Reused previously uploaded archive base layer')
+            click.echo('Archive base layer URL: {}'.format(archive_url))
+            archive_urls.append(archive_url)
+
+        if archive_git_ref is not None:
+            click.echo('Uploading archive of git ref {}'.format(
+                archive_git_ref,
+            ))
+            archive_url, reused = romp._core.upload_git_tree(
+                ref=archive_git_ref,
+                directory=archive_paths_root or '.',
+                cache=upload_cache,
+                compression=archive_compression,
+                compression_level=archive_compression_level,
+                link_speed=upload_speed,
+                backend=upload_backend,
+                deadline=deadline,
+            )
+            if reused:
+                click.echo('Reused previously uploaded git archive')
+            click.echo('Git archive URL: {}'.format(archive_url))
+            archive_urls.append(archive_url)
+
+        archive_url = None
+        reused = False
+        if archive_file is not None:
+            def create_archive_upload():
+                return (
+                    os.path.basename(archive_file.name),
+                    romp._core.iter_file_chunks(file=archive_file),
+                )
+
+            archive_key = None
+            seekable = getattr(archive_file, 'seekable', lambda: False)
+            if upload_cache is not None and seekable():
+                archive_key = romp._core.digest_chunks(
+                    romp._core.iter_file_chunks(file=archive_file),
+                )
+                archive_file.seek(0)
+            else:
+                upload_cache = None
+
+            click.echo('Uploading archive')
+            archive_url, reused = romp._core.upload_archive(
+                create_upload=create_archive_upload,
+                key=archive_key,
+                cache=upload_cache,
+                backend=upload_backend,
+                deadline=deadline,
+            )
+        elif len(archive_paths) > 0:
+            click.echo('Archiving paths for upload')
+            archive_url, reused = romp._core.upload_paths(
+                paths=archive_paths,
+                paths_root=archive_paths_root,
+                cache=upload_cache,
+                compression=archive_compression,
+                compression_level=archive_compression_level,
+                link_speed=upload_speed,
+                reproducible=reproducible_archive,
+                read_workers=archive_read_workers,
+                collector=collector,
+                collapse_duplicates=archive_collapse_duplicates,
+                backend=upload_backend,
+                deadline=deadline,
+            )
+
+        if archive_url is not None:
+            if reused:
+                click.echo('Reused previously uploaded archive')
+            click.echo('Archive URL: {}'.format(archive_url))
+            archive_urls.append(archive_url)
+    except romp._core.DeadlineExceeded:
+        click.echo('Timed out after {} seconds'.format(timeout))
+        sys.exit(1)
+
+    durations = romp._cache.Cache(
+        directory=os.path.join(cache_directory, 'durations'),
+    )
+    duration_key = romp._core.digest_chunks([json.dumps([
+        build_request_url,
+        definition_id,
+        environments_string,
+    ]).encode('utf-8')])
+
+    def requested(build):
+        click.echo('Waiting for build: {}'.format(build.human_url))
+
+    on_job_event = None
+    if progress:
+        on_job_event = create_job_progress_reporter(total=len(environments))
+
+    remaining = None
+    if timeout is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            click.echo('Timed out after {} seconds'.format(timeout))
+            sys.exit(1)
+
+    leases = romp._cache.Leases(
+        directory=os.path.join(cache_directory, 'leases'),
     )
 
-    click.echo('Waiting for build: {}'.format(build.human_url))
+    artifact_extractor = None
+    if artifact_directory is not None:
+        artifact_extractor = romp._extract.Extractor(
+            directory=artifact_directory,
+            layout=artifact_layout,
+            skip_unchanged=artifact_skip_unchanged,
+        )
 
-    response_json = build.wait_for_lock_build(check_period=check_period)
+    click.echo('Requesting build')
+    engine = romp._async.Engine(session=session, leases=leases)
+    try:
+        with engine:
+            build, response_json = romp._async.run(
+                engine.run_build(
+                    schedule=romp._core.PollSchedule(
+                        minimum=minimum_check_period,
+                        unknown_maximum=check_period,
+                        expected_duration=durations.get(duration_key),
+                    ),
+                    artifact_file=artifact,
+                    requested=requested,
+                    on_job_event=on_job_event,
+                    archive_urls=archive_urls,
+                    build_request_url=build_request_url,
+                    command=command,
+                    environments=environments_string,
+                    source_branch=source_branch,
+                    definition_id=definition_id,
+                    artifact_paths=artifact_paths,
+                    artifact_mode=artifact_mode,
+                    fail_fast=fail_fast,
+                    artifact_extractor=artifact_extractor,
+                    artifact_compression=artifact_compression,
+                    artifact_compression_level=artifact_compression_level,
+                    artifact_deduplicate=artifact_deduplicate,
+                    artifact_namespace=artifact_namespace,
+                ),
+                signals=romp._async.interrupt_signals,
+                timeout=remaining,
+            )
+    except asyncio.TimeoutError:
+        click.echo('Timed out after {} seconds, build cancelled'.format(
+            timeout,
+        ))
+        sys.exit(1)
+    except romp._async.Interrupted as e:
+        click.echo('Interrupted, build cancelled')
+        sys.exit(128 + e.signal_number)
+
+    if artifact_skip_unchanged and artifact_extractor is not None:
+        changed = artifact_extractor.changed
+        for path in changed:
+            click.echo('Changed artifact: {}'.format(
+                os.path.relpath(path, artifact_extractor.directory),
+            ))
+
+        click.echo('{} of {} artifact files changed'.format(
+            len(changed),
+            len(changed) + len(artifact_extractor.unchanged),
+        ))
+
+    if build.cancelled:
+        click.echo('Cancelled build after {} failed'.format(
+            build.failed_job.environment,
+        ))
+        sys.exit(1)
 
-    if artifact is not None:
-        click.echo('Handling artifact')
-        build.get_lock_build_artifact(artifact_file=artifact)
+    durations.put(duration_key, build.duration)
 
     if response_json['result'] != 'succeeded':
         sys.exit(1)
 
     sys.exit(0)
+
+
+@main.command(
+    help='Cancel builds left running by romp processes that did not finish',
+)
+@click.pass_context
+def cleanup(context):
+    parameters = context.parent.params
+
+    leases = romp._cache.Leases(
+        directory=os.path.join(parameters['cache_directory'], 'leases'),
+    )
+
+    failed = False
+
+    for lease in leases.orphaned():
+        if lease['id'] is None:
+            # the client stopped before the build request returned
+            click.echo(
+                'Orphaned build request of unknown outcome: {}'.format(
+                    lease['request_url'],
+                ),
+            )
+            leases.release(lease['key'])
+            continue
+
+        build = romp._core.Build(
+            id=lease['id'],
+            url=lease['url'],
+            human_url=lease['human_url'],
+            session=romp._core.create_session(
+                username=parameters['username'],
+                personal_access_token=parameters['personal_access_token'],
+                auth_url=lease['url'],
+                timeout=parameters['http_timeout'],
+            ),
+        )
+
+        try:
+            response_json = build.poll()
+            if response_json['status'] != 'completed':
+                click.echo('Cancelling orphaned build: {}'.format(
+                    build.human_url,
+                ))
+                build.cancel()
+        except Exception:
+            # left for the next cleanup
+            logger.exception('failed to clean up build: %s', build.human_url)
+            failed = True
+            continue
+
+        leases.release(lease['key'])
+
+    if failed:
+        sys.exit(1)
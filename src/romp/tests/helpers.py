@@ -0,0 +1,92 @@
+import io
+import os
+import subprocess
+import tarfile
+
+import romp._core
+
+
+linux = 'Linux-CPython-3.7-x86_64'
+mac = 'macOS-CPython-3.7-x86_64'
+
+
+def write_files(root, files):
+    paths = []
+
+    for name, content in sorted(files.items()):
+        path = os.path.join(str(root), name)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(path, 'wb') as f:
+            f.write(content)
+
+        paths.append(path)
+
+    return paths
+
+
+def git(root, *args):
+    subprocess.check_call(
+        [
+            'git',
+            '-c', 'user.name=romp',
+            '-c', 'user.email=romp@example.invalid',
+        ] + list(args),
+        cwd=str(root),
+    )
+
+
+class FakeBackend(romp._core.UploadBackend):
+    name = 'fake'
+
+    def __init__(self, available=True):
+        self.uploads = []
+        self.is_available = available
+
+    def identity(self):
+        return [self.name]
+
+    def available(self, url):
+        return self.is_available
+
+    def _upload(self, chunks, file_name, reusable, deadline):
+        self.uploads.append(b''.join(chunks))
+        return 'https://example.invalid/{}'.format(len(self.uploads))
+
+
+def write_archive(path, files):
+    with tarfile.open(str(path), mode='w:gz') as archive:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+    return str(path)
+
+
+def read_tree(root):
+    result = {}
+
+    for directory, _, files in os.walk(str(root)):
+        for name in files:
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, str(root)).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                result[relative] = f.read()
+
+    return result
+
+
+def build_request(server):
+    return {
+        'schedule': romp._core.PollSchedule(minimum=0.05, maximum=0.05),
+        'archive_urls': [],
+        'build_request_url': server.request_url,
+        'command': '',
+        'environments': '',
+        'source_branch': 'develop',
+        'definition_id': 1,
+        'artifact_paths': [],
+    }
@@ -0,0 +1,539 @@
+import hashlib
+import http.server as http_server
+import io
+import json
+import socketserver
+import threading
+import time
+import urllib.parse as urlparse
+import uuid
+import zipfile
+
+
+class ThreadingHTTPServer(
+        socketserver.ThreadingMixIn,
+        http_server.HTTPServer,
+):
+    daemon_threads = True
+
+
+class Handler(http_server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def stand_in(self):
+        return self.server.stand_in
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        body = bytearray()
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            body.extend(self.rfile.read(size))
+            self.rfile.readline()
+
+            if size == 0:
+                return bytes(body)
+
+    def send_body(self, body, status=200, content_type=None, headers=()):
+        self.send_response(status)
+        if content_type is not None:
+            self.send_header('Content-Type', content_type)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_ranged_body(self, body, content_type=None):
+        # honors a single bytes=first-last, bytes=first- or bytes=-suffix
+        requested = self.headers.get('Range')
+        if requested is None or not self.stand_in.ranges:
+            self.send_body(body=body, content_type=content_type)
+            return len(body)
+
+        first, last = requested.split('=', 1)[1].split('-')
+        if first == '':
+            first = max(len(body) - int(last), 0)
+            last = len(body) - 1
+        else:
+            first = int(first)
+            last = len(body) - 1 if last == '' else int(last)
+        last = min(last, len(body) - 1)
+
+        self.send_body(
+            body=memoryview(body)[first:last + 1],
+            status=206,
+            content_type=content_type,
+            headers=[(
+                'Content-Range',
+                'bytes {}-{}/{}'.format(first, last, len(body)),
+            )],
+        )
+
+        return last + 1 - first
+
+    def send_json(self, value, status=200, headers=()):
+        self.send_body(
+            body=json.dumps(value).encode('utf-8'),
+            status=status,
+            content_type='application/json',
+            headers=headers,
+        )
+
+
+class StandIn:
+    handler_class = Handler
+
+    def __init__(self):
+        self.requests = []
+        self.headers = []
+        self.authorizations = []
+        self.client_ports = set()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', 0),
+            self.handler_class,
+        )
+        self.server.stand_in = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def record(self, handler):
+        with self.lock:
+            self.requests.append((handler.command, handler.path))
+            self.headers.append(handler.headers)
+            self.authorizations.append(handler.headers.get('Authorization'))
+            self.client_ports.add(handler.client_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+def parse_multipart_file(content_type, body):
+    boundary = content_type.split('boundary=', 1)[1].encode('ascii')
+    part = body.split(b'--' + boundary)[1]
+    _, content = part.split(b'\r\n\r\n', 1)
+
+    return content[:-len(b'\r\n')]
+
+
+class FileHandler(Handler):
+    # file.io style multipart POST plus plain and Content-Range PUT and GET
+
+    def store(self, name, content):
+        with self.stand_in.lock:
+            self.stand_in.files[name] = content
+            self.stand_in.uploads.append(content)
+
+    def faulted(self):
+        fault = self.stand_in.fault
+        if fault is None or not fault(self):
+            return False
+
+        self.send_body(body=b'', status=500)
+        return True
+
+    def do_PUT(self):
+        self.stand_in.record(self)
+        name = self.path.lstrip('/')
+        body = self.read_body()
+
+        if self.faulted():
+            return
+
+        content_range = self.headers.get('Content-Range')
+        if content_range is None:
+            self.store(name=name, content=body)
+            self.send_body(body=b'', status=201)
+            return
+
+        span, total = content_range.split(' ', 1)[1].split('/')
+        total = int(total)
+
+        with self.stand_in.lock:
+            partial = self.stand_in.partials.setdefault(name, bytearray(total))
+            if span != '*':
+                first, last = (int(value) for value in span.split('-'))
+                partial[first:last + 1] = body
+
+            self.stand_in.files[name] = bytes(partial)
+            self.stand_in.uploads.append(body)
+
+        self.send_body(body=b'', status=201)
+
+    def do_POST(self):
+        self.stand_in.record(self)
+        content = parse_multipart_file(
+            content_type=self.headers['Content-Type'],
+            body=self.read_body(),
+        )
+        name = uuid.uuid4().hex
+        self.store(name=name, content=content)
+
+        self.send_json({
+            'success': True,
+            'link': '{}/{}'.format(self.stand_in.url, name),
+        })
+
+    def do_GET(self):
+        self.stand_in.record(self)
+        content = self.stand_in.files.get(self.path.lstrip('/'))
+
+        if content is None:
+            self.send_body(body=b'', status=404)
+            return
+
+        self.send_body(body=content)
+
+    do_HEAD = do_GET
+
+
+class FileStandIn(StandIn):
+    handler_class = FileHandler
+
+    def __init__(self):
+        StandIn.__init__(self)
+        self.files = {}
+        self.partials = {}
+        self.uploads = []
+        self.fault = None
+
+
+class FakeClock:
+    # shared by the client and the server so polling runs in simulated time
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class BuildHandler(Handler):
+    # the Azure DevOps build endpoints with the build progress driven by the
+    # stand in clock
+
+    def send_conditional_json(self, value):
+        etag = '"{}"'.format(
+            hashlib.sha256(json.dumps(value, sort_keys=True).encode('utf-8'))
+            .hexdigest(),
+        )
+        if self.headers.get('If-None-Match') == etag:
+            with self.stand_in.lock:
+                self.stand_in.not_modified += 1
+            self.send_body(body=b'', status=304, headers=[('ETag', etag)])
+            return
+
+        self.send_json(value, headers=[('ETag', etag)])
+
+    def do_GET(self):
+        self.stand_in.record(self)
+        time.sleep(self.stand_in.delay)
+        path, _, query = self.path.partition('?')
+        query = urlparse.parse_qs(query)
+
+        if 'buildIds' in query:
+            build_ids = [
+                int(build_id)
+                for build_id in query['buildIds'][0].split(',')
+            ]
+            builds = [
+                self.stand_in.build_json(build_id)
+                for build_id in build_ids
+                if build_id in self.stand_in.builds
+            ]
+            self.send_conditional_json({'count': len(builds), 'value': builds})
+            return
+
+        if path.startswith('/_download/'):
+            _, _, build_id, name = path.split('/')
+            content = self.stand_in.artifact_zip(
+                build_id=int(build_id),
+                name=name,
+            )
+            if content is None:
+                self.send_body(body=b'', status=404)
+                return
+
+            with self.stand_in.lock:
+                self.stand_in.downloads.append((self.stand_in.clock(), name))
+            sent = self.send_ranged_body(
+                body=content,
+                content_type='application/zip',
+            )
+            with self.stand_in.lock:
+                self.stand_in.downloaded += sent
+            return
+
+        if path.endswith('/artifacts'):
+            build_id = int(path.rsplit('/', 2)[-2])
+            names = self.stand_in.artifact_names(build_id=build_id)
+            self.send_json({
+                'count': len(names),
+                'value': [
+                    {
+                        'name': name,
+                        'resource': {
+                            'downloadUrl': '{}/_download/{}/{}'.format(
+                                self.stand_in.url,
+                                build_id,
+                                name,
+                            ),
+                        },
+                    }
+                    for name in names
+                ],
+            })
+            return
+
+        if path.endswith('/timeline'):
+            build_id = int(path.rsplit('/', 2)[-2])
+            change_id = int(query.get('changeId', ['-1'])[0])
+            self.send_json(self.stand_in.timeline_json(
+                build_id=build_id,
+                change_id=change_id,
+            ))
+            return
+
+        build_id = int(path.rstrip('/').rsplit('/', 1)[-1])
+        self.send_conditional_json(self.stand_in.build_json(build_id))
+
+    def do_PATCH(self):
+        self.stand_in.record(self)
+        build_id = int(self.path.partition('?')[0].rsplit('/', 1)[-1])
+        request = json.loads(self.read_body().decode('utf-8'))
+
+        if request.get('status') == 'cancelling':
+            self.stand_in.cancel(build_id)
+
+        self.send_json(self.stand_in.build_json(build_id))
+
+    def do_POST(self):
+        self.stand_in.record(self)
+        request = json.loads(self.read_body().decode('utf-8'))
+
+        with self.stand_in.lock:
+            self.stand_in.requested.append(request)
+
+        self.send_json(self.stand_in.add_build(
+            queued=self.stand_in.queued,
+            running=self.stand_in.running,
+            jobs=self.stand_in.jobs,
+            artifacts=self.stand_in.artifacts,
+        ))
+
+
+class BuildStandIn(StandIn):
+    handler_class = BuildHandler
+
+    def __init__(self, clock):
+        StandIn.__init__(self)
+        self.clock = clock
+        self.builds = {}
+        self.not_modified = 0
+        self.delay = 0
+        self.requested = []
+        # for the builds requested through the API
+        self.queued = 0
+        self.running = 0
+        self.jobs = ()
+        self.artifacts = ()
+        self.downloads = []
+        self.downloaded = 0
+        self.ranges = True
+        self.cancelled = []
+
+    @property
+    def request_url(self):
+        return '{}/_apis/build/builds?api-version=5.0'.format(self.url)
+
+    def build_url(self, build_id):
+        return '{}/_apis/build/Builds/{}'.format(self.url, build_id)
+
+    def add_build(
+            self,
+            queued,
+            running,
+            result='succeeded',
+            jobs=(),
+            artifacts=(),
+    ):
+        # jobs are (name, start, duration, result) and artifacts are
+        # (name, published, files) with the times relative to the build
+        # starting to run
+        with self.lock:
+            build_id = len(self.builds) + 1
+            created = self.clock()
+            self.builds[build_id] = {
+                'queued_until': created + queued,
+                'completed_at': created + queued + running,
+                'result': result,
+                'jobs': [
+                    {
+                        'name': name,
+                        'started': created + queued + start,
+                        'finished': created + queued + start + duration,
+                        'result': job_result,
+                    }
+                    for name, start, duration, job_result in jobs
+                ],
+                'artifacts': [
+                    (name, created + queued + published, files)
+                    for name, published, files in artifacts
+                ],
+            }
+
+        return self.build_json(build_id)
+
+    def cancel(self, build_id):
+        # the build and its unfinished jobs stop right away
+        with self.lock:
+            build = self.builds[build_id]
+            now = self.clock()
+
+            if now >= build['completed_at']:
+                return
+
+            self.cancelled.append(build_id)
+            build['completed_at'] = now
+            build['result'] = 'canceled'
+            for job in build['jobs']:
+                if job['finished'] > now:
+                    job['finished'] = max(now, job['started'])
+                    job['result'] = 'canceled'
+
+    def build_json(self, build_id):
+        build = self.builds[build_id]
+        now = self.clock()
+
+        if now < build['queued_until']:
+            status = 'notStarted'
+        elif now < build['completed_at']:
+            status = 'inProgress'
+        else:
+            status = 'completed'
+
+        response_json = {
+            'id': build_id,
+            'url': self.build_url(build_id),
+            'status': status,
+            '_links': {'web': {'href': self.build_url(build_id) + '/web'}},
+        }
+        if status == 'completed':
+            response_json['result'] = build['result']
+
+        return response_json
+
+    def published_artifacts(self, build_id):
+        now = self.clock()
+
+        return [
+            (name, files)
+            for name, published, files in self.builds[build_id]['artifacts']
+            if published <= now
+        ]
+
+    def artifact_names(self, build_id):
+        return [name for name, _ in self.published_artifacts(build_id)]
+
+    def artifact_zip(self, build_id, name):
+        for artifact_name, files in self.published_artifacts(build_id):
+            if artifact_name != name:
+                continue
+
+            if isinstance(files, bytes):
+                # an already zipped artifact
+                return files
+
+            content = io.BytesIO()
+            with zipfile.ZipFile(content, 'w') as artifact:
+                for file_name, file_content in sorted(files.items()):
+                    artifact.writestr(name + '/' + file_name, file_content)
+
+            return content.getvalue()
+
+        return None
+
+    def timeline_json(self, build_id, change_id):
+        # each job starting or finishing is a change, the records changed
+        # after the requested change id are returned
+        jobs = self.builds[build_id]['jobs']
+        now = self.clock()
+
+        changes = sorted(
+            (moment, index)
+            for index, job in enumerate(jobs)
+            for moment in (job['started'], job['finished'])
+            if moment <= now
+        )
+        last_changes = {}
+        for number, (_, index) in enumerate(changes, 1):
+            last_changes[index] = number
+
+        records = [{
+            'id': 'task',
+            'type': 'Task',
+            'name': 'Run Command',
+            'state': 'pending',
+            'changeId': 0,
+        }]
+        for index, job in enumerate(jobs):
+            record = {
+                'id': 'job-{}'.format(index),
+                'type': 'Job',
+                'name': job['name'],
+                'state': 'pending',
+                'changeId': last_changes.get(index, 0),
+            }
+            if now >= job['started']:
+                record['state'] = 'inProgress'
+                record['startTime'] = format_time(job['started'])
+            if now >= job['finished']:
+                record['state'] = 'completed'
+                record['finishTime'] = format_time(job['finished'])
+                record['result'] = job['result']
+
+            records.append(record)
+
+        return {
+            'id': 'timeline',
+            'changeId': len(changes),
+            'records': [
+                record
+                for record in records
+                if record['changeId'] > change_id
+            ],
+        }
+
+
+def format_time(seconds):
+    # the seven fractional digits the API uses
+    whole = int(seconds)
+
+    return '{}.{:07d}Z'.format(
+        time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(whole)),
+        int(round((seconds - whole) * 10**7)),
+    )
@@ -0,0 +1,463 @@
+import asyncio
+import io
+import os
+import signal
+import tarfile
+import threading
+import time
+
+import click.testing
+import pytest
+
+import romp._async
+import romp._cache
+import romp._coalesce
+import romp._core
+import romp.cli
+import romp.tests.helpers
+import romp.tests.servers
+
+
+def test_many_builds_one_loop():
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        server.queued = 0.1
+        server.running = 0.5
+
+        engine = romp._async.Engine(
+            session=romp._core.create_session(pool_size=8),
+            concurrency=100,
+            http_workers=8,
+        )
+        requests = [
+            {
+                'schedule': romp._core.PollSchedule(
+                    minimum=0.05,
+                    maximum=0.1,
+                ),
+                'archive_urls': [],
+                'build_request_url': server.request_url,
+                'command': 'echo {}'.format(index),
+                'environments': '',
+                'source_branch': 'develop',
+                'definition_id': 1,
+                'artifact_paths': [],
+            }
+            for index in range(300)
+        ]
+
+        start = time.time()
+        with engine:
+            results = romp._async.run(engine.run_builds(requests))
+        elapsed = time.time() - start
+
+    assert [response_json['status'] for _, response_json in results] == (
+        ['completed'] * 300
+    )
+    assert sorted(build.id for build, _ in results) == list(range(1, 301))
+    assert engine.most_in_flight == 100
+    # three waves of 100 overlapping builds rather than 300 in sequence
+    assert elapsed < 300 * 0.6 / 10
+    assert len(server.client_ports) <= 8
+
+
+def test_tracker_batches_polls():
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        builds_json = [
+            server.add_build(queued=0.1, running=0.1 + index / 200.0)
+            for index in range(200)
+        ]
+        # one build the server does not know of
+        builds_json.append(
+            dict(builds_json[0], id=1000, url=server.build_url(1000)),
+        )
+
+        engine = romp._async.Engine(session=romp._core.create_session())
+        with engine:
+            async def wait_all():
+                return await asyncio.gather(
+                    *(
+                        engine.tracker.wait(
+                            build=romp._core.Build.from_response_json(
+                                response_json=build_json,
+                                session=engine.session,
+                            ),
+                            schedule=romp._core.PollSchedule(
+                                minimum=0.05,
+                                maximum=0.05,
+                                jitter=0,
+                            ),
+                        )
+                        for build_json in builds_json
+                    ),
+                    return_exceptions=True,
+                )
+
+            results = romp._async.run(wait_all())
+
+    assert [result['status'] for result in results[:-1]] == (
+        ['completed'] * 200
+    )
+    assert 'not found' in str(results[-1])
+    # roughly one request per period over the 1.2 seconds for all the
+    # builds rather than one per build
+    assert len(server.requests) < 40
+
+
+def test_run_build_job_events():
+    events = []
+
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        server.running = 1
+        server.jobs = [
+            ('romp on Linux CPython 3.7 x86_64', 0.1, 0.4, 'succeeded'),
+            ('romp on macOS CPython 3.7 x86_64', 0.1, 0.8, 'succeeded'),
+        ]
+
+        with romp._async.Engine(session=romp._core.create_session()) as engine:
+            romp._async.run(engine.run_build(
+                schedule=romp._core.PollSchedule(minimum=0.05, maximum=0.05),
+                on_job_event=lambda event: events.append(
+                    (event.kind, event.environment),
+                ),
+                archive_urls=[],
+                build_request_url=server.request_url,
+                command='',
+                environments='',
+                source_branch='develop',
+                definition_id=1,
+                artifact_paths=[],
+            ))
+
+    assert events == [
+        ('started', 'Linux-CPython-3.7-x86_64'),
+        ('started', 'macOS-CPython-3.7-x86_64'),
+        ('finished', 'Linux-CPython-3.7-x86_64'),
+        ('finished', 'macOS-CPython-3.7-x86_64'),
+    ]
+
+
+def tarball(files):
+    content = io.BytesIO()
+    with tarfile.open(fileobj=content, mode='w:gz') as archive:
+        for name, data in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+    return content.getvalue()
+
+
+def test_per_job_artifacts(tmp_path):
+    job_tarballs = {
+        'artifacts.b.tar.gz': tarball({'linux.txt': b'penguin'}),
+        'artifacts.a.tar.gz': tarball({'mac.txt': b'apple'}),
+    }
+    for name, content in job_tarballs.items():
+        with open(str(tmp_path / name), 'wb') as f:
+            f.write(content)
+
+    coalesced = io.BytesIO()
+    romp._coalesce.coalesce(
+        source_paths=[str(tmp_path / name) for name in job_tarballs],
+        target_file=coalesced,
+    )
+
+    results = {}
+    for mode in romp._core.artifact_modes:
+        with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+            server.running = 1
+            server.jobs = [
+                ('romp on Linux CPython 3.7 x86_64', 0, 0.1, 'succeeded'),
+                ('romp on macOS CPython 3.7 x86_64', 0, 0.4, 'succeeded'),
+            ]
+            server.artifacts = [
+                (
+                    'artifacts-Linux-CPython-3.7-x86_64',
+                    0.1,
+                    {'artifacts.b.tar.gz': job_tarballs['artifacts.b.tar.gz']},
+                ),
+                (
+                    'artifacts-macOS-CPython-3.7-x86_64',
+                    0.4,
+                    {'artifacts.a.tar.gz': job_tarballs['artifacts.a.tar.gz']},
+                ),
+                ('artifacts', 0.9, {'artifacts.tar.gz': coalesced.getvalue()}),
+            ]
+
+            artifact_file = io.BytesIO()
+            engine = romp._async.Engine(session=romp._core.create_session())
+            with engine:
+                build, _ = romp._async.run(engine.run_build(
+                    schedule=romp._core.PollSchedule(
+                        minimum=0.05,
+                        maximum=0.05,
+                    ),
+                    artifact_file=artifact_file,
+                    artifact_mode=mode,
+                    archive_urls=[],
+                    build_request_url=server.request_url,
+                    command='',
+                    environments='',
+                    source_branch='develop',
+                    definition_id=1,
+                    artifact_paths=['*.txt'],
+                ))
+
+        results[mode] = artifact_file.getvalue()
+        completed_at = server.builds[build.id]['completed_at']
+        downloads = [name for _, name in server.downloads]
+
+        if mode == 'per-job':
+            assert sorted(downloads) == [
+                'artifacts-Linux-CPython-3.7-x86_64',
+                'artifacts-macOS-CPython-3.7-x86_64',
+            ]
+            assert all(at < completed_at for at, _ in server.downloads)
+        else:
+            assert downloads == ['artifacts']
+
+    assert [
+        [(info.name, archive.extractfile(info).read()) for info in archive]
+        for archive in (
+            tarfile.open(fileobj=io.BytesIO(results[mode]))
+            for mode in romp._core.artifact_modes
+        )
+    ] == [[('mac.txt', b'apple'), ('linux.txt', b'penguin')]] * 2
+
+
+def test_fail_fast():
+    linux_tarball = tarball({'linux.txt': b'penguin'})
+
+    for mode in romp._core.artifact_modes:
+        with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+            server.running = 5
+            server.jobs = [
+                ('romp on Linux CPython 3.7 x86_64', 0, 0.1, 'succeeded'),
+                ('romp on Windows CPython 3.7 x86', 0, 0.3, 'failed'),
+                ('romp on macOS CPython 3.7 x86_64', 0, 4.5, 'succeeded'),
+            ]
+            server.artifacts = [
+                (
+                    'artifacts-Linux-CPython-3.7-x86_64',
+                    0.1,
+                    {'artifacts.b.tar.gz': linux_tarball},
+                ),
+                (
+                    'coalesce',
+                    0.1,
+                    {'artifacts.b.tar.gz': linux_tarball, '__filler__': b''},
+                ),
+            ]
+
+            artifact_file = io.BytesIO()
+            start = time.time()
+            engine = romp._async.Engine(session=romp._core.create_session())
+            with engine:
+                build, response_json = romp._async.run(engine.run_build(
+                    schedule=romp._core.PollSchedule(
+                        minimum=0.05,
+                        maximum=0.05,
+                    ),
+                    artifact_file=artifact_file,
+                    artifact_mode=mode,
+                    fail_fast=True,
+                    archive_urls=[],
+                    build_request_url=server.request_url,
+                    command='',
+                    environments='',
+                    source_branch='develop',
+                    definition_id=1,
+                    artifact_paths=['*.txt'],
+                ))
+            elapsed = time.time() - start
+
+        assert elapsed < 2
+        assert server.cancelled == [build.id]
+        assert build.cancelled
+        assert build.failed_job.environment == 'Windows-CPython-3.7-x86'
+
+        with tarfile.open(fileobj=io.BytesIO(artifact_file.getvalue())) as f:
+            assert f.getnames() == ['linux.txt']
+
+
+def test_timeout_cancels(tmp_path):
+    leases = romp._cache.Leases(directory=str(tmp_path), duration=0)
+
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        server.running = 5
+
+        engine = romp._async.Engine(
+            session=romp._core.create_session(),
+            leases=leases,
+        )
+        with engine, pytest.raises(asyncio.TimeoutError):
+            romp._async.run(
+                engine.run_build(**romp.tests.helpers.build_request(server)),
+                timeout=0.3,
+            )
+
+    assert server.cancelled == [1]
+    assert leases.orphaned() == []
+
+
+@pytest.mark.parametrize(
+    'timeout, signalled, expected',
+    [
+        (0.3, None, asyncio.TimeoutError),
+        (30, 0.3, romp._async.Interrupted),
+    ],
+)
+def test_timeout_with_signals(tmp_path, timeout, signalled, expected):
+    # as the CLI runs a build, with both a timeout and the interrupt signals
+    leases = romp._cache.Leases(directory=str(tmp_path), duration=0)
+
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        server.running = 5
+
+        engine = romp._async.Engine(
+            session=romp._core.create_session(),
+            leases=leases,
+        )
+        timer = None
+        if signalled is not None:
+            timer = threading.Timer(
+                signalled,
+                os.kill,
+                args=(os.getpid(), signal.SIGINT),
+            )
+            timer.start()
+        with engine, pytest.raises(expected):
+            romp._async.run(
+                engine.run_build(**romp.tests.helpers.build_request(server)),
+                signals=romp._async.interrupt_signals,
+                timeout=timeout,
+            )
+        if timer is not None:
+            timer.join()
+
+        # cancelled before run returned rather than left to the loop that
+        # is already closed
+        assert server.cancelled == [1]
+
+    assert leases.orphaned() == []
+
+
+def test_signal_cancels(tmp_path):
+    leases = romp._cache.Leases(directory=str(tmp_path), duration=0)
+
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        server.running = 5
+
+        engine = romp._async.Engine(
+            session=romp._core.create_session(),
+            leases=leases,
+        )
+        timer = threading.Timer(
+            0.3,
+            os.kill,
+            args=(os.getpid(), signal.SIGINT),
+        )
+        timer.start()
+        with engine, pytest.raises(romp._async.Interrupted):
+            romp._async.run(
+                engine.run_build(**romp.tests.helpers.build_request(server)),
+                signals=[signal.SIGINT],
+            )
+        timer.join()
+
+    assert server.cancelled == [1]
+    assert leases.orphaned() == []
+
+
+def test_lease_taken_before_request(tmp_path, monkeypatch):
+    leases = romp._cache.Leases(directory=str(tmp_path))
+    seen = []
+
+    request_remote_lock_build = romp._core.request_remote_lock_build
+
+    def recording_request(**kwargs):
+        seen.append([
+            leases.entries.get(key)['id']
+            for key in leases.entries.keys()
+        ])
+        return request_remote_lock_build(**kwargs)
+
+    monkeypatch.setattr(
+        romp._core,
+        'request_remote_lock_build',
+        recording_request,
+    )
+
+    def requested(build):
+        seen.append([
+            leases.entries.get(key)['id']
+            for key in leases.entries.keys()
+        ])
+
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        engine = romp._async.Engine(
+            session=romp._core.create_session(),
+            leases=leases,
+        )
+        with engine:
+            romp._async.run(engine.run_build(
+                requested=requested,
+                **romp.tests.helpers.build_request(server)
+            ))
+
+    assert seen == [[None], [1]]
+    assert leases.entries.keys() == []
+
+
+def test_cleanup_orphaned(tmp_path, monkeypatch):
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        leases = romp._cache.Leases(directory=str(tmp_path / 'leases'))
+
+        with monkeypatch.context() as context:
+            # last renewed long ago
+            context.setattr(romp._cache.time, 'time', lambda: 0)
+            for running in (5, 0):
+                lease = leases.acquire(request_url=server.request_url)
+                leases.attach(lease, romp._core.Build.from_response_json(
+                    server.add_build(queued=0, running=running),
+                ))
+            # killed before the build was requested
+            leases.acquire(request_url=server.request_url)
+
+        result = click.testing.CliRunner().invoke(
+            romp.cli.main,
+            ['--pat', 'x', '--cache-directory', str(tmp_path), 'cleanup'],
+        )
+
+    assert result.exit_code == 0, result.output
+    assert server.cancelled == [1]
+    assert 'Orphaned build request of unknown outcome' in result.output
+    assert leases.entries.keys() == []
+
+
+def test_cleanup_continues_after_errors(tmp_path, monkeypatch):
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        leases = romp._cache.Leases(directory=str(tmp_path / 'leases'))
+
+        with monkeypatch.context() as context:
+            context.setattr(romp._cache.time, 'time', lambda: 0)
+            running = leases.acquire(request_url=server.request_url)
+            leases.attach(running, romp._core.Build.from_response_json(
+                server.add_build(queued=0, running=5),
+            ))
+            # the server no longer knows this build
+            missing = leases.acquire(request_url=server.request_url)
+            leases.attach(missing, romp._core.Build(
+                id=99,
+                url=server.url + '/missing',
+                human_url=server.url + '/missing/web',
+            ))
+
+        result = click.testing.CliRunner().invoke(
+            romp.cli.main,
+            ['--pat', 'x', '--cache-directory', str(tmp_path), 'cleanup'],
+        )
+
+    assert result.exit_code == 1, result.output
+    assert server.cancelled == [1]
+    assert leases.entries.keys() == [missing]
@@ -0,0 +1,358 @@
+import io
+import os
+import random
+import time
+import tracemalloc
+import zipfile
+
+import pytest
+import requests
+
+import romp._coalesce
+import romp._core
+import romp.tests.helpers
+import romp.tests.servers
+
+
+def test_schedule_delays():
+    schedule = romp._core.PollSchedule(
+        minimum=2,
+        maximum=60,
+        expected_duration=600,
+        jitter=0,
+    )
+
+    assert schedule.delay(status='notStarted', running=0) == 2
+    assert schedule.delay(status='inProgress', running=1) == 2
+    assert schedule.delay(status='inProgress', running=300) == 60
+    assert schedule.delay(status='inProgress', running=420) == 60
+    assert schedule.delay(status='inProgress', running=480) == 15
+    assert schedule.delay(status='inProgress', running=597) == 2
+    assert schedule.delay(status='inProgress', running=620) == 10
+    assert schedule.delay(status='inProgress', running=900) == 15
+
+
+def test_schedule_unknown_duration():
+    schedule = romp._core.PollSchedule(unknown_maximum=15)
+
+    assert schedule.delay(status='notStarted', running=0) == 15
+    assert schedule.delay(status='inProgress', running=1) == 15
+    assert schedule.delay(status='inProgress', running=3000) == 15
+
+
+def test_schedule_jitter():
+    schedule = romp._core.PollSchedule(
+        minimum=10,
+        maximum=10,
+        expected_duration=600,
+        jitter=0.1,
+        random=lambda: 1,
+    )
+
+    assert schedule.delay(status='inProgress', running=0) == 9
+
+
+def test_poll_not_modified():
+    clock = romp.tests.servers.FakeClock()
+
+    with romp.tests.servers.BuildStandIn(clock=clock) as server:
+        build = romp._core.Build.from_response_json(
+            server.add_build(queued=10, running=10),
+        )
+
+        first = build.poll()
+        second = build.poll()
+        clock.sleep(10)
+        third = build.poll()
+
+    assert first == second
+    assert first['status'] == 'notStarted'
+    assert third['status'] == 'inProgress'
+    assert server.not_modified == 1
+
+
+def wait(server, clock, queued, running, schedule):
+    clock.now = 0
+    build = romp._core.Build.from_response_json(
+        server.add_build(queued=queued, running=running),
+    )
+
+    response_json = build.wait_for_lock_build(
+        schedule=schedule,
+        clock=clock,
+        sleep=clock.sleep,
+    )
+
+    assert response_json['status'] == 'completed'
+
+    return clock() - (queued + running), build.duration
+
+
+def benchmark(create_schedule):
+    clock = romp.tests.servers.FakeClock()
+    latencies = []
+
+    with romp.tests.servers.BuildStandIn(clock=clock) as server:
+        for running in range(20, 1800, 131):
+            latency, duration = wait(
+                server=server,
+                clock=clock,
+                queued=10,
+                running=running,
+                schedule=create_schedule(running),
+            )
+            latencies.append(latency)
+            assert duration <= running + latency
+
+    return (
+        sum(latencies) / len(latencies),
+        len(server.requests) / float(len(latencies)),
+    )
+
+
+def test_adaptive_polling_benchmark():
+    # simulated time over a range of build durations so the comparison is
+    # exact rather than timing dependent
+    results = {
+        'fixed': benchmark(
+            lambda running: romp._core.PollSchedule(
+                minimum=15,
+                maximum=15,
+                unknown_maximum=15,
+                jitter=0,
+            ),
+        ),
+        'adaptive': benchmark(
+            lambda running: romp._core.PollSchedule(
+                random=random.Random(running).random,
+            ),
+        ),
+        'early': benchmark(
+            lambda running: romp._core.PollSchedule(
+                expected_duration=running * 0.95,
+                random=random.Random(running).random,
+            ),
+        ),
+        'late': benchmark(
+            lambda running: romp._core.PollSchedule(
+                expected_duration=running * 1.05,
+                random=random.Random(running).random,
+            ),
+        ),
+    }
+
+    fixed_latency, fixed_requests = results['fixed']
+
+    # the completion is never noticed later than by the fixed period, not
+    # knowing the duration costs no extra requests and knowing it saves some
+    for latency, requests in results.values():
+        assert latency <= fixed_latency
+    assert results['adaptive'][1] <= fixed_requests
+    for name in ('early', 'late'):
+        assert results[name][1] < fixed_requests
+
+
+def test_session_shared():
+    clock = romp.tests.servers.FakeClock()
+
+    with romp.tests.servers.BuildStandIn(clock=clock) as server:
+        with romp.tests.servers.FileStandIn() as upload_server:
+            session = romp._core.create_session(
+                username='user',
+                personal_access_token='token',
+                auth_url=server.url,
+            )
+            build = romp._core.Build.from_response_json(
+                response_json=server.add_build(queued=10, running=10),
+                session=session,
+            )
+
+            for _ in range(5):
+                build.poll()
+
+            backend = romp._core.HttpPutBackend(
+                session=session,
+                url=upload_server.url,
+            )
+            backend.upload(chunks=[b'red'], file_name='a')
+
+    assert len(server.client_ports) == 1
+    assert server.authorizations == ['Basic dXNlcjp0b2tlbg=='] * 5
+    assert upload_server.authorizations == [None]
+
+
+def test_session_timeout():
+    clock = romp.tests.servers.FakeClock()
+
+    with romp.tests.servers.BuildStandIn(clock=clock) as server:
+        server.delay = 1
+        build = romp._core.Build.from_response_json(
+            response_json=server.add_build(queued=10, running=10),
+            session=romp._core.create_session(timeout=0.1),
+        )
+
+        with pytest.raises(requests.exceptions.Timeout):
+            build.poll()
+
+
+jobs = [
+    ('romp on Linux CPython 3.7 x86_64', 10, 20, 'succeeded'),
+    ('romp on Windows CPython 3.7 x86', 10, 60.5, 'failed'),
+    ('Coalesce artifacts', 75, 20, 'succeeded'),
+]
+
+
+def test_job_events():
+    clock = romp.tests.servers.FakeClock()
+
+    with romp.tests.servers.BuildStandIn(clock=clock) as server:
+        build = romp._core.Build.from_response_json(
+            server.add_build(queued=5, running=100, jobs=jobs),
+        )
+
+        events = list(build.iter_job_events(
+            schedule=romp._core.PollSchedule(
+                minimum=2,
+                maximum=2,
+                jitter=0,
+            ),
+            clock=clock,
+            sleep=clock.sleep,
+        ))
+
+    assert [
+        (event.kind, event.environment, event.result, event.duration)
+        for event in events
+    ] == [
+        ('started', 'Linux-CPython-3.7-x86_64', None, None),
+        ('started', 'Windows-CPython-3.7-x86', None, None),
+        ('finished', 'Linux-CPython-3.7-x86_64', 'succeeded', 20),
+        ('finished', 'Windows-CPython-3.7-x86', 'failed', 60.5),
+    ]
+    timeline_paths = [
+        path
+        for _, path in server.requests
+        if '/timeline' in path
+    ]
+    assert 'changeId' not in timeline_paths[0]
+    assert all('changeId=' in path for path in timeline_paths[1:])
+
+
+def test_parse_time():
+    assert romp._core.parse_time('1970-01-02T00:00:01.2500000Z') == 86401.25
+    assert romp._core.parse_time('1970-01-01T00:00:03Z') == 3
+
+
+def artifact_peak_memory(tmp_path, size, ranges):
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w') as artifact:
+        artifact.writestr('artifacts/artifacts.tar.gz', os.urandom(size))
+
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        server.ranges = ranges
+        build = romp._core.Build.from_response_json(
+            server.add_build(
+                queued=0,
+                running=0,
+                artifacts=[('artifacts', 0, content.getvalue())],
+            ),
+        )
+        del content
+
+        path = tmp_path / 'artifacts.{}.tar.gz'.format(size)
+        with open(str(path), 'wb') as f:
+            tracemalloc.start()
+            try:
+                build.get_lock_build_artifact(artifact_file=f)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+    assert path.stat().st_size == size
+
+    return peak
+
+
+@pytest.mark.parametrize('ranges', [False, True])
+def test_artifact_download_memory(tmp_path, ranges):
+    small = artifact_peak_memory(
+        tmp_path=tmp_path,
+        size=4 * 1024 * 1024,
+        ranges=ranges,
+    )
+    large = artifact_peak_memory(
+        tmp_path=tmp_path,
+        size=64 * 1024 * 1024,
+        ranges=ranges,
+    )
+
+    # the download is spooled to disk and copied out in chunks
+    assert large < 4 * romp._core.default_spool_size
+    assert large < 2 * small
+
+
+@pytest.mark.parametrize('ranges', [False, True])
+def test_artifact_ranges(ranges):
+    tarball = os.urandom(256 * 1024)
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w') as artifact:
+        artifact.writestr('artifacts/__filler__.a', os.urandom(1024 * 1024))
+        artifact.writestr('artifacts/artifacts.tar.gz', tarball)
+        artifact.writestr('artifacts/__filler__.b', os.urandom(1024 * 1024))
+    content = content.getvalue()
+
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        server.ranges = ranges
+        build = romp._core.Build.from_response_json(
+            server.add_build(
+                queued=0,
+                running=0,
+                artifacts=[('artifacts', 0, content)],
+            ),
+        )
+
+        artifact_file = io.BytesIO()
+        build.get_lock_build_artifact(artifact_file=artifact_file)
+
+    assert artifact_file.getvalue() == tarball
+    if ranges:
+        # the central directory and the one member, none of the filler
+        assert server.downloaded < len(tarball) + 2 * 64 * 1024
+    else:
+        assert server.downloaded == len(content)
+
+
+def test_read_lock_build_artifact_file(tmp_path):
+    paths = [
+        romp.tests.helpers.write_archive(
+            path=tmp_path / 'artifacts.{}.0.tar.gz'.format(environment),
+            files=[('requirements.txt', environment.encode('ascii'))],
+        )
+        for environment in ('a', 'b')
+    ]
+
+    tarball = io.BytesIO()
+    romp._coalesce.coalesce(
+        source_paths=paths,
+        target_file=tarball,
+        compression='none',
+        namespace=True,
+    )
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w') as artifact:
+        artifact.writestr('artifacts/artifacts.tar', tarball.getvalue())
+
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        build = romp._core.Build.from_response_json(
+            server.add_build(
+                queued=0,
+                running=0,
+                artifacts=[('artifacts', 0, content.getvalue())],
+            ),
+        )
+
+        assert build.read_lock_build_artifact_file(
+            environment='b',
+            path='requirements.txt',
+            compression='none',
+        ) == b'b'
@@ -0,0 +1,122 @@
+import os
+import time
+
+import romp._cache
+import romp._core
+import romp.tests.helpers
+
+
+def test_put_get(tmp_path):
+    cache = romp._cache.Cache(directory=str(tmp_path / 'cache'))
+
+    assert cache.get('a') is None
+    cache.put('a', {'b': 1})
+    assert cache.get('a') == {'b': 1}
+
+
+def test_expired(tmp_path):
+    cache = romp._cache.Cache(directory=str(tmp_path))
+
+    cache.put('a', 1, lifetime=-1)
+
+    assert cache.get('a') is None
+    assert cache.keys() == []
+
+
+def test_corrupt(tmp_path):
+    cache = romp._cache.Cache(directory=str(tmp_path))
+    with open(cache.path('a'), 'w') as f:
+        f.write('{')
+
+    assert cache.get('a') is None
+    assert cache.keys() == []
+
+
+def test_least_recently_used_evicted(tmp_path):
+    cache = romp._cache.Cache(directory=str(tmp_path), max_entries=2)
+
+    cache.put('a', 1)
+    cache.put('b', 2)
+    os.utime(cache.path('a'), (1, 1))
+    os.utime(cache.path('b'), (2, 2))
+
+    cache.get('a')
+    cache.put('c', 3)
+
+    assert sorted(cache.keys()) == ['a', 'c']
+
+
+def test_upload_reused(tmp_path):
+    backend = romp.tests.helpers.FakeBackend()
+    cache = romp._cache.Cache(directory=str(tmp_path))
+
+    def create_upload():
+        return 'archive.tar', [b'abc']
+
+    results = [
+        romp._core.upload_archive(
+            create_upload=create_upload,
+            key='key',
+            cache=cache,
+            backend=backend,
+        )
+        for _ in range(2)
+    ]
+
+    assert results == [
+        ('https://example.invalid/1', False),
+        ('https://example.invalid/1', True),
+    ]
+    assert backend.uploads == [b'abc']
+
+
+def test_upload_unavailable_replaced(tmp_path):
+    backend = romp.tests.helpers.FakeBackend(available=False)
+    cache = romp._cache.Cache(directory=str(tmp_path))
+
+    results = [
+        romp._core.upload_archive(
+            create_upload=lambda: ('archive.tar', [b'abc']),
+            key='key',
+            cache=cache,
+            backend=backend,
+        )
+        for _ in range(2)
+    ]
+
+    assert results == [
+        ('https://example.invalid/1', False),
+        ('https://example.invalid/2', False),
+    ]
+    assert len(cache.keys()) == 1
+
+
+class FakeBuild:
+    def __init__(self, id):
+        self.id = id
+        self.url = 'https://example.invalid/builds/{}'.format(id)
+        self.human_url = self.url + '/web'
+
+
+def test_leases_orphaned(tmp_path):
+    leases = romp._cache.Leases(directory=str(tmp_path), duration=0.2)
+
+    lease = leases.acquire(request_url='https://example.invalid/builds')
+    assert leases.orphaned() == []
+
+    time.sleep(0.3)
+    assert [lease['id'] for lease in leases.orphaned()] == [None]
+
+    leases.attach(lease, FakeBuild(id=1))
+    assert [lease['id'] for lease in leases.orphaned()] == [1]
+
+    leases.renew(lease)
+    assert leases.orphaned() == []
+
+    leases.release(lease)
+    time.sleep(0.3)
+    assert leases.orphaned() == []
+
+    # a late renewal does not bring a released lease back
+    leases.renew(lease)
+    assert leases.entries.keys() == []
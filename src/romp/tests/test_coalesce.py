@@ -0,0 +1,360 @@
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+import time
+
+import pytest
+
+import romp._coalesce
+import romp._matrix
+import romp.tests.helpers
+
+
+def synthetic_environments(count):
+    return [
+        '{}-CPython-3.{}-x86_64'.format(platform, minor)
+        for minor in range(count)
+        for platform in romp._matrix.all_platforms
+    ][:count]
+
+
+def lock_file(environment, index):
+    # pip-tools looking lines, mostly shared between the environments
+    lines = []
+    for package in range(200):
+        name = 'package-{}-{}'.format(index, package)
+        digest = hashlib.sha256(name.encode('ascii')).hexdigest()
+        lines.append('{}==1.{} --hash=sha256:{}\n'.format(
+            name,
+            package % 7,
+            digest,
+        ))
+    lines.append('# {}\n'.format(environment))
+
+    return ''.join(lines).encode('ascii')
+
+
+def write_sources(directory, count):
+    return [
+        romp.tests.helpers.write_archive(
+            path=directory / 'artifacts.{}.0.tar.gz'.format(name),
+            files=[
+                (
+                    'requirements/{}.txt'.format(index),
+                    lock_file(environment=name, index=index),
+                )
+                for index in range(20)
+            ],
+        )
+        for name in synthetic_environments(count=count)
+    ]
+
+
+def decompress(compression, data):
+    if compression == 'gzip':
+        return gzip.decompress(data)
+
+    if compression == 'zstd':
+        zstandard = pytest.importorskip('zstandard')
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    return data
+
+
+def coalesce(paths, **kwargs):
+    target = io.BytesIO()
+    start = time.perf_counter()
+    romp._coalesce.coalesce(source_paths=paths, target_file=target, **kwargs)
+
+    return target.getvalue(), time.perf_counter() - start
+
+
+@pytest.mark.parametrize('compression', romp._coalesce.compressions)
+def test_deterministic(tmp_path, compression):
+    paths = write_sources(directory=tmp_path, count=30)
+
+    tarballs = [
+        decompress(
+            compression=compression,
+            data=coalesce(
+                paths=ordered,
+                compression=compression,
+                workers=workers,
+            )[0],
+        )
+        for ordered, workers in (
+            (paths, 1),
+            (list(reversed(paths)), 8),
+        )
+    ]
+
+    assert tarballs[0] == tarballs[1]
+
+    with tarfile.open(fileobj=io.BytesIO(tarballs[0])) as archive:
+        members = archive.getmembers()
+        assert len(members) == 30 * 20
+        first = archive.extractfile(members[0]).read()
+
+    with tarfile.open(sorted(paths)[0]) as archive:
+        assert first == archive.extractfile(archive.getmembers()[0]).read()
+
+
+@pytest.mark.benchmark
+def test_benchmark(tmp_path):
+    # the 30 environment set against the previous fixed gzip level 9 output
+    paths = write_sources(directory=tmp_path, count=30)
+
+    pytest.importorskip('zstandard')
+
+    def best(**kwargs):
+        return min(coalesce(paths=paths, **kwargs)[1] for _ in range(3))
+
+    baseline = best(compression='gzip', compression_level=9)
+    uncompressed = best(compression='none')
+    zstd = best(compression='zstd')
+
+    assert uncompressed < baseline
+    assert zstd < baseline
+
+
+@pytest.mark.benchmark
+def test_parallel_benchmark(tmp_path):
+    # the 30 environment set with larger members so inflating them is most
+    # of the work, the output is left uncompressed so the one writer does
+    # not hide what the workers share
+    paths = [
+        romp.tests.helpers.write_archive(
+            path=tmp_path / 'artifacts.{}.0.tar.gz'.format(name),
+            files=[
+                (
+                    'requirements/{}.txt'.format(index),
+                    lock_file(environment=name, index=index) * 100,
+                )
+                for index in range(2)
+            ],
+        )
+        for name in synthetic_environments(count=30)
+    ]
+    workers = min(8, os.cpu_count() or 1)
+
+    if workers < 2:
+        pytest.skip('a single CPU has nothing to run in parallel')
+
+    def best(workers):
+        return min(
+            coalesce(paths=paths, compression='none', workers=workers)[1]
+            for _ in range(3)
+        )
+
+    serial = best(workers=1)
+    parallel = best(workers=workers)
+
+    assert parallel < serial
+
+
+def test_corrupt_source(tmp_path):
+    paths = write_sources(directory=tmp_path, count=3)
+    with open(paths[1], 'r+b') as f:
+        f.seek(100)
+        f.write(b'\0' * 100)
+
+    with pytest.raises(Exception):
+        coalesce(paths=paths, workers=2)
+
+
+def extract(tmp_path, name, data):
+    directory = tmp_path / name
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        archive.extractall(str(directory))
+
+    return romp.tests.helpers.read_tree(directory)
+
+
+def test_deduplicate(tmp_path):
+    # the same lock files from every environment with the environment in
+    # their names to keep them apart
+    paths = [
+        romp.tests.helpers.write_archive(
+            path=tmp_path / 'artifacts.{}.0.tar.gz'.format(environment),
+            files=[
+                (
+                    'requirements/{}.{}.txt'.format(index, environment),
+                    lock_file(environment='', index=index),
+                )
+                for index in range(20)
+            ],
+        )
+        for environment in synthetic_environments(count=30)
+    ]
+
+    full, _ = coalesce(paths=paths, compression='none')
+    deduplicated, _ = coalesce(
+        paths=paths,
+        compression='none',
+        deduplicate=True,
+    )
+
+    assert len(deduplicated) * 10 < len(full)
+    assert extract(tmp_path, 'full', full) == extract(
+        tmp_path,
+        'deduplicated',
+        deduplicated,
+    )
+
+
+def test_deduplicate_replaced(tmp_path):
+    paths = [
+        romp.tests.helpers.write_archive(
+            tmp_path / 'artifacts.a.0.tar.gz',
+            [('x', b'1')],
+        ),
+        romp.tests.helpers.write_archive(
+            tmp_path / 'artifacts.b.0.tar.gz',
+            [('x', b'2')],
+        ),
+        romp.tests.helpers.write_archive(
+            tmp_path / 'artifacts.c.0.tar.gz',
+            [('y', b'1'), ('z', b'2'), ('x', b'2')],
+        ),
+    ]
+
+    data, _ = coalesce(paths=paths, compression='none', deduplicate=True)
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        assert [
+            (info.name, info.linkname)
+            for info in archive.getmembers()
+        ] == [('x', ''), ('x', ''), ('y', ''), ('z', ''), ('x', 'z')]
+
+    assert extract(tmp_path, 'extracted', data) == {
+        'x': b'2',
+        'y': b'1',
+        'z': b'2',
+    }
+
+
+def test_deduplicate_link_target_replaced(tmp_path):
+    # tarfile opens x.txt again to replace it, a y.txt linked to it would
+    # have been changed with it
+    paths = [
+        romp.tests.helpers.write_archive(
+            tmp_path / 'artifacts.a.0.tar.gz',
+            [('x.txt', b'foo')],
+        ),
+        romp.tests.helpers.write_archive(
+            tmp_path / 'artifacts.b.0.tar.gz',
+            [('y.txt', b'foo'), ('x.txt', b'bar'), ('z.txt', b'foo')],
+        ),
+    ]
+
+    data, _ = coalesce(paths=paths, compression='none', deduplicate=True)
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        assert [
+            (info.name, info.linkname)
+            for info in archive.getmembers()
+        ] == [
+            ('x.txt', ''),
+            ('y.txt', ''),
+            ('x.txt', ''),
+            ('z.txt', 'y.txt'),
+        ]
+
+    assert extract(tmp_path, 'extracted', data) == {
+        'x.txt': b'bar',
+        'y.txt': b'foo',
+        'z.txt': b'foo',
+    }
+
+
+def namespaced_sources(tmp_path):
+    return [
+        romp.tests.helpers.write_archive(
+            tmp_path / 'artifacts.{}.0.tar.gz'.format(environment),
+            [('requirements.txt', data), ('LICENSE', b'license')],
+        )
+        for environment, data in (
+            (romp.tests.helpers.linux, b'penguin'),
+            (romp.tests.helpers.mac, b'apple'),
+        )
+    ] + [
+        romp.tests.helpers.write_archive(
+            tmp_path / 'artifacts.1.tar.gz',
+            [('old.txt', b'old')],
+        ),
+    ]
+
+
+@pytest.mark.parametrize('deduplicate', [False, True])
+def test_namespace(tmp_path, deduplicate):
+    linux = romp.tests.helpers.linux
+    mac = romp.tests.helpers.mac
+    paths = namespaced_sources(tmp_path=tmp_path)
+
+    data, _ = coalesce(
+        paths=paths,
+        compression='none',
+        deduplicate=deduplicate,
+        namespace=True,
+    )
+
+    tree = extract(tmp_path, 'extracted', data)
+    assert tree.pop(romp._coalesce.manifest_name)
+    assert tree == {
+        '1/old.txt': b'old',
+        linux + '/LICENSE': b'license',
+        linux + '/requirements.txt': b'penguin',
+        mac + '/LICENSE': b'license',
+        mac + '/requirements.txt': b'apple',
+    }
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        assert archive.getmembers()[0].name == romp._coalesce.manifest_name
+
+    manifest = romp._coalesce.Manifest.read(fileobj=io.BytesIO(data))
+    assert manifest.environments() == ['1', linux, mac]
+    assert manifest.paths(linux) == ['requirements.txt', 'LICENSE']
+
+    # the offsets point straight at the content in the tar stream
+    for entry in manifest.files:
+        content = data[entry['offset']:entry['offset'] + entry['size']]
+        digest = hashlib.sha256(content).hexdigest()
+        assert digest == entry['digest']
+        assert content == tree[entry['environment'] + '/' + entry['path']]
+
+
+@pytest.mark.parametrize('compression', romp._coalesce.compressions)
+def test_namespace_lookup(tmp_path, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+
+    mac = romp.tests.helpers.mac
+    paths = namespaced_sources(tmp_path=tmp_path)
+
+    data, _ = coalesce(
+        paths=paths,
+        compression=compression,
+        deduplicate=True,
+        namespace=True,
+    )
+
+    manifest = romp._coalesce.Manifest.read(
+        fileobj=io.BytesIO(data),
+        compression=compression,
+    )
+
+    for path, expected in (
+            ('LICENSE', b'license'),
+            ('requirements.txt', b'apple'),
+    ):
+        assert manifest.read_file(
+            fileobj=io.BytesIO(data),
+            environment=mac,
+            path=path,
+            compression=compression,
+        ) == expected
+
+    with pytest.raises(Exception, match='not in the manifest'):
+        manifest.entry(environment=mac, path='old.txt')
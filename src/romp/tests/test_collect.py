@@ -0,0 +1,171 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+import romp._collect
+import romp._core
+import romp.tests.helpers
+
+
+tree = {
+    '.gitignore': b'build/\n*.log\n/top.txt\n!keep.log\n',
+    '.git/HEAD': b'ref',
+    'top.txt': b'',
+    'keep.log': b'',
+    'other.log': b'',
+    'src/top.txt': b'',
+    'src/module.py': b'',
+    'src/__pycache__/module.pyc': b'',
+    'src/build/output': b'',
+    'src/pkg/.rompignore': b'data/**/*.bin\n',
+    'src/pkg/data/a/b/c.bin': b'',
+    'src/pkg/data/a/b/c.txt': b'',
+    'src/pkg/deep/d.py': b'',
+}
+
+
+@pytest.fixture(name='root')
+def root_fixture(tmp_path):
+    romp.tests.helpers.write_files(root=tmp_path, files=tree)
+
+    return str(tmp_path)
+
+
+def relative_paths(root, paths):
+    return sorted(
+        os.path.relpath(path, root).replace(os.sep, '/')
+        for path in paths
+    )
+
+
+def test_walk_ignores(root):
+    collector = romp._collect.Collector(root=root)
+
+    walked = [path for path, _ in collector.walk(root)]
+
+    assert relative_paths(root, walked) == [
+        '.',
+        '.gitignore',
+        'keep.log',
+        'src',
+        'src/module.py',
+        'src/pkg',
+        'src/pkg/.rompignore',
+        'src/pkg/data',
+        'src/pkg/data/a',
+        'src/pkg/data/a/b',
+        'src/pkg/data/a/b/c.txt',
+        'src/pkg/deep',
+        'src/pkg/deep/d.py',
+        'src/top.txt',
+    ]
+
+
+def test_walk_applies_parent_rules(root):
+    collector = romp._collect.Collector(root=root)
+
+    walked = [path for path, _ in collector.walk(os.path.join(root, 'src'))]
+
+    assert 'src/build' not in relative_paths(root, walked)
+
+
+def test_walk_without_ignoring(root):
+    collector = romp._collect.Collector(
+        root=root,
+        patterns=(),
+        use_ignore_files=False,
+    )
+
+    walked = [
+        path
+        for path, is_directory in collector.walk(root)
+        if not is_directory
+    ]
+
+    assert relative_paths(root, walked) == sorted(tree)
+
+
+def test_recursive_glob(root):
+    collector = romp._collect.Collector(root=root)
+
+    matches = collector.glob(os.path.join(root, 'src', '**', '*.py'))
+
+    assert relative_paths(root, matches) == [
+        'src/module.py',
+        'src/pkg/deep/d.py',
+    ]
+
+
+def test_glob_ignores(root):
+    collector = romp._collect.Collector(root=root)
+
+    matches = collector.glob(os.path.join(root, '*.log'))
+
+    assert relative_paths(root, matches) == ['keep.log']
+
+
+def test_glob_without_magic(root):
+    collector = romp._collect.Collector(root=root)
+
+    path = os.path.join(root, 'other.log')
+
+    assert collector.glob(path) == [path]
+    assert collector.glob(path + '.missing') == []
+
+
+def test_recursive_glob_archived_once(root):
+    collector = romp._collect.Collector(root=root)
+
+    data = b''.join(romp._core.iter_tarball_chunks(
+        paths=collector.glob(os.path.join(root, 'src', '**')),
+        paths_root=root,
+        collector=collector,
+    ))
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        names = archive.getnames()
+
+    assert names == [
+        'src/module.py',
+        'src/pkg',
+        'src/pkg/.rompignore',
+        'src/pkg/data',
+        'src/pkg/data/a',
+        'src/pkg/data/a/b',
+        'src/pkg/data/a/b/c.txt',
+        'src/pkg/deep',
+        'src/pkg/deep/d.py',
+        'src/top.txt',
+    ]
+
+
+def test_collapse_duplicates(tmp_path):
+    files = {
+        'a/LICENSE': b'license' * 100,
+        'b/LICENSE': b'license' * 100,
+        'c/empty': b'',
+        'd/empty': b'',
+    }
+    romp.tests.helpers.write_files(root=tmp_path, files=files)
+
+    data = b''.join(romp._core.iter_tarball_chunks(
+        paths=[str(tmp_path)],
+        paths_root=str(tmp_path),
+        reproducible=True,
+        collapse_duplicates=True,
+    ))
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        link = archive.getmember('b/LICENSE')
+        assert link.islnk()
+        assert link.linkname == 'a/LICENSE'
+        assert archive.getmember('d/empty').isreg()
+
+    extracted = tmp_path / 'extracted'
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        archive.extractall(str(extracted))
+
+    with open(str(extracted / 'b' / 'LICENSE'), 'rb') as f:
+        assert f.read() == files['b/LICENSE']
@@ -0,0 +1,343 @@
+import io
+import os
+import tarfile
+import time
+
+import pytest
+import requests
+
+import romp._cache
+import romp._core
+import romp.tests.helpers
+import romp.tests.servers
+
+
+def read_tarball(data):
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:*') as archive:
+        return {
+            info.name: archive.extractfile(info).read()
+            for info in archive.getmembers()
+            if info.isfile()
+        }
+
+
+def test_tarball_chunks_round_trip(tmp_path):
+    files = {
+        'a.txt': b'red',
+        'b/c.txt': b'blue' * 100000,
+    }
+    paths = romp.tests.helpers.write_files(root=tmp_path, files=files)
+
+    chunks = list(romp._core.iter_tarball_chunks(
+        paths=paths,
+        paths_root=str(tmp_path),
+        chunk_size=1024,
+    ))
+
+    assert max(len(chunk) for chunk in chunks) == 1024
+    assert read_tarball(b''.join(chunks)) == files
+
+
+def test_tarball_chunks_abandoned(tmp_path):
+    paths = romp.tests.helpers.write_files(
+        root=tmp_path,
+        files={'a.txt': b'red' * 100000},
+    )
+
+    chunks = romp._core.iter_tarball_chunks(
+        paths=paths,
+        paths_root=str(tmp_path),
+        chunk_size=1024,
+    )
+    next(chunks)
+    chunks.close()
+
+
+def test_tarball_chunks_error(tmp_path):
+    chunks = romp._core.iter_tarball_chunks(
+        paths=[os.path.join(str(tmp_path), 'missing')],
+        paths_root=str(tmp_path),
+    )
+
+    with pytest.raises(OSError):
+        list(chunks)
+
+
+def test_tarball_chunks_memory_flat(tmp_path):
+    tracemalloc = pytest.importorskip('tracemalloc')
+
+    peaks = []
+
+    for size in (4 * 2**20, 64 * 2**20):
+        path = os.path.join(str(tmp_path), '{}.bin'.format(size))
+        with open(path, 'wb') as f:
+            f.truncate(size)
+
+        tracemalloc.start()
+        try:
+            total = 0
+            for chunk in romp._core.iter_tarball_chunks(
+                    paths=[path],
+                    paths_root=str(tmp_path),
+            ):
+                total += len(chunk)
+
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert total > size
+        peaks.append(peak)
+
+    assert max(peaks) < 2 * 2**20
+    assert peaks[1] < 2 * peaks[0]
+
+
+def test_multipart_chunks():
+    body = b''.join(romp._core.iter_multipart_chunks(
+        chunks=[b'abc', b'def'],
+        boundary='xyz',
+        field_name='file',
+        file_name='archive.tar.gz',
+    ))
+
+    assert body == (
+        b'--xyz\r\n'
+        b'Content-Disposition: form-data; name="file";'
+        b' filename="archive.tar.gz"\r\n'
+        b'Content-Type: application/octet-stream\r\n'
+        b'\r\n'
+        b'abcdef'
+        b'\r\n--xyz--\r\n'
+    )
+
+
+@pytest.mark.parametrize('compression', list(romp._core.codecs))
+def test_tarball_compression(tmp_path, compression):
+    files = {'a.txt': b'red ' * 10000}
+    paths = romp.tests.helpers.write_files(root=tmp_path, files=files)
+
+    data = b''.join(romp._core.iter_tarball_chunks(
+        paths=paths,
+        paths_root=str(tmp_path),
+        compression=compression,
+    ))
+
+    if compression == 'zstd':
+        zstandard = pytest.importorskip('zstandard')
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    elif compression != 'none':
+        assert len(data) < 10000
+
+    assert read_tarball(data) == files
+
+
+def test_choose_compression(tmp_path):
+    paths = romp.tests.helpers.write_files(
+        root=tmp_path,
+        files={'a.txt': b'red ' * 100000},
+    )
+
+    slow_name, _ = romp._core.choose_compression(paths=paths, link_speed=1)
+    fast_name, _ = romp._core.choose_compression(paths=paths, link_speed=1e15)
+
+    assert slow_name in ('gzip', 'bz2')
+    assert fast_name == 'none'
+
+
+def test_reproducible_tarball(tmp_path):
+    files = {
+        'a.txt': b'red',
+        'b/c.txt': b'blue',
+        'b/d/e.txt': b'green',
+    }
+
+    archives = []
+    keys = []
+    for index, mtime in enumerate((1000000000, 1500000000)):
+        root = tmp_path / str(index)
+        paths = romp.tests.helpers.write_files(root=root, files=files)
+        for path in paths:
+            os.utime(path, (mtime, mtime))
+
+        paths = [str(root / 'b'), str(root / 'a.txt')]
+        if index == 1:
+            paths.reverse()
+
+        archives.append(b''.join(romp._core.iter_tarball_chunks(
+            paths=paths,
+            paths_root=str(root),
+            compression='gzip',
+            reproducible=True,
+        )))
+        keys.append(romp._core.archive_key(
+            paths=paths,
+            paths_root=str(root),
+            reproducible=True,
+        ))
+
+    assert archives[0] == archives[1]
+    assert keys[0] == keys[1]
+    assert read_tarball(archives[0]) == files
+
+    with tarfile.open(fileobj=io.BytesIO(archives[0]), mode='r:gz') as tar:
+        names = tar.getnames()
+        assert {info.mtime for info in tar.getmembers()} == {0}
+
+    assert names == sorted(names)
+
+
+def test_tarball_hard_links(tmp_path):
+    paths = romp.tests.helpers.write_files(
+        root=tmp_path,
+        files={'a.txt': b'red'},
+    )
+    os.link(paths[0], str(tmp_path / 'b.txt'))
+
+    data = b''.join(romp._core.iter_tarball_chunks(
+        paths=[str(tmp_path / 'a.txt'), str(tmp_path / 'b.txt')],
+        paths_root=str(tmp_path),
+    ))
+
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r') as tar:
+        link = tar.getmember('b.txt')
+        assert link.islnk()
+        assert link.linkname == 'a.txt'
+
+
+@pytest.mark.benchmark
+def test_parallel_read_faster(tmp_path, monkeypatch):
+    files = {
+        'd{}/{}.txt'.format(index % 10, index): str(index).encode('ascii')
+        for index in range(300)
+    }
+    romp.tests.helpers.write_files(root=tmp_path, files=files)
+
+    prefetch_member = romp._core.prefetch_member
+
+    def slow_prefetch_member(*args, **kwargs):
+        # simulate the latency of a network filesystem
+        time.sleep(0.005)
+        return prefetch_member(*args, **kwargs)
+
+    monkeypatch.setattr(romp._core, 'prefetch_member', slow_prefetch_member)
+
+    results = {}
+    for workers in (1, 16):
+        start = time.time()
+        data = b''.join(romp._core.iter_tarball_chunks(
+            paths=[str(tmp_path)],
+            paths_root=str(tmp_path),
+            reproducible=True,
+            read_workers=workers,
+        ))
+        results[workers] = (time.time() - start, data)
+
+    assert results[1][1] == results[16][1]
+    assert read_tarball(results[16][1]) == files
+    assert results[16][0] * 3 < results[1][0]
+
+
+def test_layers_upload_only_changed(tmp_path):
+    root = tmp_path / 'root'
+    romp.tests.helpers.write_files(root=root, files={
+        'dependencies/big.whl': b'wheel' * 100000,
+        'source.py': b'print("red")',
+    })
+    cache = romp._cache.Cache(directory=str(tmp_path / 'cache'))
+
+    with romp.tests.servers.FileStandIn() as server:
+        backend = romp._core.FileIoBackend(
+            session=romp._core.create_session(),
+            url=server.url,
+        )
+
+        for source in (b'print("red")', b'print("blue")'):
+            romp.tests.helpers.write_files(
+                root=root,
+                files={'source.py': source},
+            )
+
+            urls = [
+                romp._core.upload_paths(
+                    paths=[str(root / path)],
+                    paths_root=str(root),
+                    cache=cache,
+                    reproducible=True,
+                    backend=backend,
+                )[0]
+                for path in ('dependencies', 'source.py')
+            ]
+
+            extracted = {}
+            for url in urls:
+                extracted.update(read_tarball(requests.get(url).content))
+
+            assert extracted == {
+                'dependencies/big.whl': b'wheel' * 100000,
+                'source.py': source,
+            }
+
+        sizes = [len(upload) for upload in server.uploads]
+
+    assert len(sizes) == 3
+    assert sizes[2] < sizes[0]
+
+
+def test_git_tree_upload(tmp_path):
+    root = tmp_path / 'root'
+    files = {
+        'requirements.in': b'click\n',
+        'src/module.py': b'print("red")',
+    }
+    romp.tests.helpers.write_files(root=root, files=files)
+    romp.tests.helpers.git(root, 'init', '--quiet')
+    romp.tests.helpers.git(root, 'add', '.')
+    romp.tests.helpers.git(root, 'commit', '--quiet', '--message', 'first')
+    romp.tests.helpers.write_files(root=root, files={
+        'untracked.txt': b'',
+        'src/module.py': b'print("modified")',
+    })
+
+    cache = romp._cache.Cache(directory=str(tmp_path / 'cache'))
+    backend = romp.tests.helpers.FakeBackend()
+
+    results = [
+        romp._core.upload_git_tree(
+            ref='HEAD',
+            directory=str(root),
+            cache=cache,
+            backend=backend,
+        )
+        for _ in range(2)
+    ]
+
+    assert [reused for _, reused in results] == [False, True]
+    assert len(backend.uploads) == 1
+    assert read_tarball(backend.uploads[0]) == files
+
+    # an unchanged tree is recognized without building the archive again
+    romp.tests.helpers.git(
+        root,
+        'commit',
+        '--quiet',
+        '--allow-empty',
+        '--message',
+        'second',
+    )
+    _, reused = romp._core.upload_git_tree(
+        ref='HEAD',
+        directory=str(root),
+        cache=cache,
+        backend=backend,
+    )
+    assert reused
+
+    subdirectory = read_tarball(b''.join(romp._core.iter_git_tarball_chunks(
+        ref='HEAD',
+        directory=str(root / 'src'),
+    )))
+    assert subdirectory == {'module.py': files['src/module.py']}
+    assert romp._core.git_tree_hash(ref='HEAD', directory=str(root)) != (
+        romp._core.git_tree_hash(ref='HEAD', directory=str(root / 'src'))
+    )
@@ -0,0 +1,202 @@
+import io
+import os
+import tarfile
+import time
+
+import pytest
+
+import romp._async
+import romp._coalesce
+import romp._core
+import romp._extract
+import romp.tests.helpers
+import romp.tests.servers
+
+
+link_types = {'sym': tarfile.SYMTYPE, 'link': tarfile.LNKTYPE}
+
+
+def tarball(members):
+    # members are (name, content) with links given as ('sym', target) or
+    # ('link', target) for the content
+    content = io.BytesIO()
+    with tarfile.open(fileobj=content, mode='w:gz') as archive:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.mtime = 1
+            if isinstance(data, tuple):
+                kind, info.linkname = data
+                info.type = link_types[kind]
+                archive.addfile(info)
+            else:
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+
+    return io.BytesIO(content.getvalue())
+
+
+def test_archive_environment():
+    assert romp._coalesce.archive_environment(
+        'artifacts.{}.0c8e1b4c-d8a6-4f8e-a0f0-2d3c0b5e2a11.tar.gz'.format(
+            romp.tests.helpers.linux,
+        ),
+    ) == romp.tests.helpers.linux
+    assert romp._coalesce.archive_environment(
+        'artifacts.0c8e1b4c-d8a6-4f8e-a0f0-2d3c0b5e2a11.tar.gz',
+    ) is None
+
+
+@pytest.mark.parametrize('mode', romp._core.artifact_modes)
+def test_environment_layout(tmp_path, mode):
+    linux_tarball = tarball([('dist/out.txt', b'penguin')]).getvalue()
+    mac_tarball = tarball([('dist/out.txt', b'apple')]).getvalue()
+    linux_name = 'artifacts.{}.1.tar.gz'.format(romp.tests.helpers.linux)
+    mac_name = 'artifacts.{}.2.tar.gz'.format(romp.tests.helpers.mac)
+
+    with romp.tests.servers.BuildStandIn(clock=time.time) as server:
+        server.running = 1
+        server.jobs = [
+            ('romp on Linux CPython 3.7 x86_64', 0, 0.1, 'succeeded'),
+            ('romp on macOS CPython 3.7 x86_64', 0, 0.4, 'succeeded'),
+        ]
+        server.artifacts = [
+            (romp._core.job_artifact_name(romp.tests.helpers.linux), 0.1, {
+                linux_name: linux_tarball,
+            }),
+            (romp._core.job_artifact_name(romp.tests.helpers.mac), 0.4, {
+                mac_name: mac_tarball,
+            }),
+            ('coalesce', 0.4, {
+                linux_name: linux_tarball,
+                mac_name: mac_tarball,
+                '__filler__': b'',
+            }),
+        ]
+
+        engine = romp._async.Engine(session=romp._core.create_session())
+        with engine:
+            romp._async.run(engine.run_build(
+                artifact_mode=mode,
+                artifact_extractor=romp._extract.Extractor(
+                    directory=str(tmp_path),
+                    layout='environment',
+                ),
+                **romp.tests.helpers.build_request(server)
+            ))
+
+    assert romp.tests.helpers.read_tree(tmp_path) == {
+        romp.tests.helpers.linux + '/dist/out.txt': b'penguin',
+        romp.tests.helpers.mac + '/dist/out.txt': b'apple',
+    }
+
+
+def test_flat_layout_replaces(tmp_path):
+    extractor = romp._extract.Extractor(directory=str(tmp_path))
+
+    extractor.extract_tarball(
+        fileobj=tarball([('out.txt', b'penguin'), ('linux.txt', b'')]),
+        environment=romp.tests.helpers.linux,
+    )
+    paths = extractor.extract_tarball(
+        fileobj=tarball([('out.txt', b'apple')]),
+        environment=romp.tests.helpers.mac,
+    )
+
+    assert paths == [str(tmp_path / 'out.txt')]
+    assert romp.tests.helpers.read_tree(tmp_path) == {
+        'out.txt': b'apple',
+        'linux.txt': b'',
+    }
+
+
+@pytest.mark.parametrize('name', [
+    '../escaped.txt',
+    'inner/../../escaped.txt',
+    '/tmp/escaped.txt',
+])
+def test_unsafe_paths_refused(tmp_path, name):
+    extractor = romp._extract.Extractor(directory=str(tmp_path / 'target'))
+
+    with pytest.raises(Exception, match='unsafe artifact path'):
+        extractor.extract_tarball(fileobj=tarball([(name, b'evil')]))
+
+    assert romp.tests.helpers.read_tree(tmp_path) == {}
+
+
+def test_unsafe_links_refused(tmp_path):
+    extractor = romp._extract.Extractor(directory=str(tmp_path / 'target'))
+
+    with pytest.raises(Exception, match='unsafe artifact link'):
+        extractor.extract_tarball(
+            fileobj=tarball([('escape', ('sym', '../..'))]),
+        )
+
+    # a link already in the tree does not redirect writes outside of it
+    os.symlink(str(tmp_path), str(tmp_path / 'target' / 'outside'))
+    with pytest.raises(Exception, match='unsafe artifact path'):
+        extractor.extract_tarball(
+            fileobj=tarball([('outside/escaped.txt', b'evil')]),
+        )
+
+    assert not (tmp_path / 'escaped.txt').exists()
+
+
+def test_links(tmp_path):
+    extractor = romp._extract.Extractor(directory=str(tmp_path))
+
+    extractor.extract_tarball(fileobj=tarball([
+        ('a/LICENSE', b'license'),
+        ('b/LICENSE', ('link', 'a/LICENSE')),
+        ('c/LICENSE', ('sym', '../a/LICENSE')),
+    ]))
+
+    assert romp.tests.helpers.read_tree(tmp_path) == {
+        'a/LICENSE': b'license',
+        'b/LICENSE': b'license',
+        'c/LICENSE': b'license',
+    }
+    assert not os.path.samefile(
+        str(tmp_path / 'a' / 'LICENSE'),
+        str(tmp_path / 'b' / 'LICENSE'),
+    )
+    assert os.path.islink(str(tmp_path / 'c' / 'LICENSE'))
+
+
+def test_skip_unchanged(tmp_path):
+    size = 3 * romp._core.default_chunk_size
+    romp._extract.Extractor(directory=str(tmp_path)).extract_tarball(
+        fileobj=tarball([
+            ('edited.lock', b'a' * size),
+            ('grown.lock', b'a'),
+            ('same.lock', b'same'),
+        ]),
+    )
+    for name in ('edited.lock', 'same.lock'):
+        os.utime(str(tmp_path / name), (5, 5))
+
+    extractor = romp._extract.Extractor(
+        directory=str(tmp_path),
+        skip_unchanged=True,
+    )
+    paths = extractor.extract_tarball(fileobj=tarball([
+        ('edited.lock', b'a' * (size - 1) + b'b'),
+        ('grown.lock', b'ab'),
+        ('new.lock', b'new'),
+        ('same.lock', b'same'),
+    ]))
+
+    changed = [
+        str(tmp_path / name)
+        for name in ('edited.lock', 'grown.lock', 'new.lock')
+    ]
+    assert paths == changed
+    assert extractor.changed == changed
+    assert extractor.unchanged == [str(tmp_path / 'same.lock')]
+    assert romp.tests.helpers.read_tree(tmp_path) == {
+        'edited.lock': b'a' * (size - 1) + b'b',
+        'grown.lock': b'ab',
+        'new.lock': b'new',
+        'same.lock': b'same',
+    }
+    assert os.stat(str(tmp_path / 'same.lock')).st_mtime == 5
+    assert os.stat(str(tmp_path / 'edited.lock')).st_mtime == 1
@@ -0,0 +1,110 @@
+import io
+import os
+import subprocess
+import sys
+import tarfile
+
+import pytest
+
+import romp.tests.helpers
+
+
+# the script deployed with the CI configuration rather than the package so
+# it is only found when testing from a checkout
+script = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.pardir,
+    os.pardir,
+    os.pardir,
+    'deployed_ci',
+    'azure',
+    'extract_archive.py',
+)
+
+pytestmark = pytest.mark.skipif(
+    not os.path.isfile(script),
+    reason='extract_archive.py is not in a checkout next to the package',
+)
+
+
+def write_tarball(path, files, mode='w'):
+    with tarfile.open(str(path), mode=mode) as archive:
+        for name, data in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+    return str(path)
+
+
+def write_zstd_tarball(path, files):
+    zstandard = pytest.importorskip('zstandard')
+
+    plain = write_tarball(path=str(path) + '.plain', files=files)
+
+    with open(plain, 'rb') as source, open(str(path), 'wb') as f:
+        zstandard.ZstdCompressor().copy_stream(source, f)
+
+    return str(path)
+
+
+def extract_archive(target, *paths):
+    return subprocess.run(
+        [sys.executable, script, '--target', str(target)] + list(paths),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+
+@pytest.mark.parametrize(
+    'mode',
+    ['w', 'w:gz', 'w:bz2', 'w:xz', 'zstd'],
+)
+def test_codecs(tmp_path, mode):
+    files = {'a.txt': b'red', 'b/c.txt': b'blue'}
+
+    if mode == 'zstd':
+        path = write_zstd_tarball(path=tmp_path / 'archive.tar', files=files)
+    else:
+        path = write_tarball(
+            path=tmp_path / 'archive.tar',
+            files=files,
+            mode=mode,
+        )
+
+    completed = extract_archive(tmp_path / 'target', path)
+
+    assert completed.returncode == 0, completed.stderr
+    assert romp.tests.helpers.read_tree(tmp_path / 'target') == files
+
+
+def test_later_archives_take_precedence(tmp_path):
+    first = write_tarball(
+        path=tmp_path / 'first.tar.gz',
+        files={'a.txt': b'red', 'b.txt': b'green'},
+        mode='w:gz',
+    )
+    second = write_tarball(
+        path=tmp_path / 'second.tar.xz',
+        files={'a.txt': b'blue'},
+        mode='w:xz',
+    )
+
+    completed = extract_archive(tmp_path / 'target', first, second)
+
+    assert completed.returncode == 0, completed.stderr
+    assert romp.tests.helpers.read_tree(tmp_path / 'target') == {
+        'a.txt': b'blue',
+        'b.txt': b'green',
+    }
+
+
+def test_unknown_format(tmp_path):
+    path = tmp_path / 'archive.zip'
+    path.write_bytes(b'PK\x03\x04 not a tarball')
+
+    completed = extract_archive(tmp_path / 'target', str(path))
+
+    assert completed.returncode == 1
+    assert b'Traceback' not in completed.stderr
+    assert b'unable to extract' in completed.stderr
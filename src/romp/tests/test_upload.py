@@ -0,0 +1,180 @@
+import time
+
+import pytest
+import requests
+
+import romp._cache
+import romp._core
+import romp.tests.servers
+
+
+def test_file_io_backend_reuses_connection():
+    with romp.tests.servers.FileStandIn() as server:
+        backend = romp._core.FileIoBackend(
+            session=romp._core.create_session(),
+            url=server.url,
+        )
+
+        urls = [
+            backend.upload(chunks=[b'red', b'blue'], file_name='archive.tar')
+            for _ in range(3)
+        ]
+        assert all(backend.available(url) for url in urls)
+        assert not backend.available(server.url + '/missing')
+
+        assert len(server.client_ports) == 1
+        assert [requests.get(url).content for url in urls] == [b'redblue'] * 3
+
+
+def test_http_put_backend():
+    with romp.tests.servers.FileStandIn() as server:
+        backend = romp._core.HttpPutBackend(
+            session=romp._core.create_session(),
+            url=server.url + '/uploads/',
+        )
+
+        url = backend.upload(chunks=[b'red', b'blue'], file_name='archive.tar')
+
+        assert url.startswith(server.url + '/uploads/')
+        assert url.endswith('/archive.tar')
+        assert requests.get(url).content == b'redblue'
+
+    assert server.headers[0]['Content-Length'] == '7'
+    assert 'Transfer-Encoding' not in server.headers[0]
+
+
+def test_local_directory_backend(tmp_path):
+    backend = romp._core.LocalDirectoryBackend(
+        directory=str(tmp_path / 'uploads'),
+        url='http://example.invalid/uploads',
+    )
+
+    url = backend.upload(chunks=[b'red', b'blue'], file_name='archive.tar')
+
+    assert backend.available(url)
+    assert not backend.available('http://example.invalid/other/archive.tar')
+    with open(backend.path_from_url(url), 'rb') as f:
+        assert f.read() == b'redblue'
+
+
+def test_measured_link_speed(tmp_path):
+    def create_backend():
+        return romp._core.create_upload_backend(
+            name=romp._core.LocalDirectoryBackend.name,
+            session=None,
+            directory=str(tmp_path / 'uploads'),
+            speeds=romp._cache.Cache(directory=str(tmp_path / 'speeds')),
+        )
+
+    backend = create_backend()
+    assert backend.link_speed() == romp._core.default_link_speed
+
+    # too small to say anything about the link
+    backend.upload(chunks=[b'red'], file_name='archive.tar')
+    assert backend.link_speed() == romp._core.default_link_speed
+
+    chunk = b'\0' * romp._core.link_speed_sample_size
+    backend.upload(chunks=[chunk], file_name='archive.tar')
+
+    assert create_backend().link_speed() != romp._core.default_link_speed
+
+
+def test_upload_deadline(tmp_path):
+    backend = romp._core.LocalDirectoryBackend(directory=str(tmp_path))
+
+    def slow_chunks():
+        yield b'red'
+        time.sleep(0.2)
+        yield b'blue'
+
+    with pytest.raises(romp._core.DeadlineExceeded):
+        backend.upload(
+            chunks=slow_chunks(),
+            file_name='archive.tar',
+            deadline=time.time() + 0.1,
+        )
+
+
+def test_local_directory_backend_file_url(tmp_path):
+    backend = romp._core.LocalDirectoryBackend(directory=str(tmp_path))
+
+    url = backend.upload(chunks=[b'red'], file_name='archive.tar')
+
+    assert url.startswith('file:')
+    assert backend.available(url)
+
+
+def create_chunked_backend(server, cache, retries=3):
+    return romp._core.RangedPutBackend(
+        session=romp._core.create_session(),
+        url=server.url,
+        chunk_size=1000,
+        concurrency=3,
+        retries=retries,
+        backoff=0,
+        checkpoints=cache,
+    )
+
+
+def test_chunked_upload_retries_failed_chunks(tmp_path):
+    content = bytes(bytearray(range(256))) * 40
+    cache = romp._cache.Cache(directory=str(tmp_path))
+
+    with romp.tests.servers.FileStandIn() as server:
+        failed = set()
+
+        def fault(handler):
+            # every third chunk fails once
+            content_range = handler.headers['Content-Range']
+            first = int(content_range.split(' ')[1].split('-')[0])
+            if first % 3000 == 0 and first not in failed:
+                failed.add(first)
+                return True
+
+            return False
+
+        server.fault = fault
+
+        backend = create_chunked_backend(server=server, cache=cache)
+        url = backend.upload(chunks=[content], file_name='archive.tar')
+
+        assert requests.get(url).content == content
+        assert sum(len(upload) for upload in server.uploads) == len(content)
+        # only the four failed chunks were sent again, not the archive
+        puts = [request for request in server.requests if request[0] == 'PUT']
+        assert len(puts) == 11 + 4
+
+        server.fault = lambda handler: True
+        whole = romp._core.HttpPutBackend(
+            session=romp._core.create_session(),
+            url=server.url,
+        )
+        with pytest.raises(requests.HTTPError):
+            whole.upload(chunks=[content], file_name='archive.tar')
+
+    assert cache.keys() == []
+
+
+def test_chunked_upload_resumes(tmp_path):
+    content = bytes(bytearray(range(256))) * 40
+    cache = romp._cache.Cache(directory=str(tmp_path))
+
+    with romp.tests.servers.FileStandIn() as server:
+        # the link goes down part way through
+        server.fault = lambda handler: len(server.requests) > 5
+
+        backend = create_chunked_backend(server=server, cache=cache, retries=0)
+        with pytest.raises(requests.HTTPError):
+            backend.upload(chunks=[content], file_name='archive.tar')
+
+        assert len(cache.keys()) == 1
+        interrupted_requests = len(server.requests)
+
+        server.fault = None
+        url = backend.upload(chunks=[content], file_name='archive.tar')
+
+        assert requests.get(url).content == content
+        resumed_requests = len(server.requests) - interrupted_requests
+
+    assert resumed_requests < 11
+    assert cache.keys() == []